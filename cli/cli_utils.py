@@ -1,6 +1,7 @@
 import pulse.api as pulse
 import pulse.uri_standards as uri_standards
 import pulse.file_utils as fu
+import pulse.database_adapters.json_db as json_db
 try:
     # legacy python 2.7 module
     from ConfigParser import ConfigParser
@@ -213,3 +214,14 @@ def update(args):
         print("work updated to version: " + str(work.version))
     except pulse.PulseError as msg:
         print(msg)
+
+
+def migrate_json_db(args):
+    database = json_db.Database(path=args.path)
+    project_names = args.projects or database.get_projects()
+    for project_name in project_names:
+        if database.get_project_layout(project_name) == json_db.SHARDED_LAYOUT:
+            print(project_name + " already migrated")
+            continue
+        moved_count = database.migrate_project(project_name)
+        print(project_name + " migrated, " + str(moved_count) + " objects moved")
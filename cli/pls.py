@@ -71,6 +71,12 @@ parser_update = subparsers.add_parser('update')
 parser_update.add_argument('uri', type=str)
 parser_update.set_defaults(func=update)
 
+# migrate json database subparser
+parser_migrate_json_db = subparsers.add_parser('migrate_json_db')
+parser_migrate_json_db.add_argument('path', type=str)
+parser_migrate_json_db.add_argument('projects', type=str, nargs='*')
+parser_migrate_json_db.set_defaults(func=migrate_json_db)
+
 cmd_args = parser.parse_args()
 if cmd_args.func:
     cmd_args.func(cmd_args)
@@ -523,38 +523,28 @@ class MainWindow(QMainWindow):
         else:
             self.project_pushButton.setStyleSheet('QPushButton {font-weight: bold;}')
             self.sandbox_pushButton.setStyleSheet('QPushButton {font-weight: normal;}')
-            project_name = self.project_comboBox.currentText()
-            resources = self.connection.db.find_uris(project_name, "Resource", self.get_filter_string())
             try:
-                for resource_uri in resources:
-                    uri_dict = pulse_uri.convert_to_dict(resource_uri)
-                    if not self.filterTemplates_checkBox.isChecked() and uri_dict["entity"] == pulse_cfg.template_name:
+                # read all resources and versions with two bulk requests instead of one per node
+                resources = self.project.get_resources(self.get_filter_string())
+                published_versions = {}
+                for published_version in self.project.get_published_versions(self.get_filter_string() + "@*"):
+                    published_versions.setdefault(published_version.resource.uri, []).append(published_version)
+                local_versions = set(self.project.list_published_versions(local_only=True))
+
+                for resource in resources:
+                    if not self.filterTemplates_checkBox.isChecked() and resource.entity == pulse_cfg.template_name:
                         continue
-                    resource = self.project.get_resource(uri_dict["entity"], uri_dict["resource_type"])
-                    resource_item = PulseItem([resource_uri], resource)
+                    resource_item = PulseItem([resource.uri], resource)
                     self.treeWidget.addTopLevelItem(resource_item)
                     if resource.lock_state:
                         set_tree_item_style(resource_item, "locked")
 
-                    # TODO : get commit products should an api method
-                    for commit_uri in self.connection.db.find_uris(project_name, "Commit", resource_uri + "@*"):
-                        version = commit_uri.split("@")[-1]
-                        commit = resource.get_commit(int(version))
+                    for published_version in published_versions.get(resource.uri, []):
                         # TODO : format version as project preferences
-                        commit_item = PulseItem(["V" + version.zfill(3)], commit)
-                        resource_item.addChild(commit_item)
-
-                        for product_uri in self.connection.db.find_uris(
-                                project_name,
-                                "CommitProduct",
-                                resource_uri + ".*@" + version
-                        ):
-                            product_type = pulse_uri.convert_to_dict(product_uri)["product_type"]
-                            product = pulse.LocalPublishedVersion(commit, product_type)
-                            product_item = PulseItem([product_type], product)
-                            if product.uri in self.project.list_published_versions():
-                                set_tree_item_style(product_item, "downloaded")
-                            commit_item.addChild(product_item)
+                        version_item = PulseItem(["V" + str(published_version.version).zfill(3)], published_version)
+                        if published_version.uri in local_versions:
+                            set_tree_item_style(version_item, "downloaded")
+                        resource_item.addChild(version_item)
             except Exception as ex:
                 print_exception(ex, self)
                 return
@@ -23,6 +23,14 @@ import sys
 import ctypes
 import json
 import subprocess
+from collections import OrderedDict
+from pulse.transfers import TransferScheduler
+from pulse.repository_adapter_interface import supported_arguments
+import pulse.repository_cache as repository_cache
+import pulse.local_products as local_products
+import pulse.object_cache as object_cache
+import pulse.manifest as manifest
+import re
 
 
 class PulseDbObject:
@@ -38,6 +46,8 @@ class PulseDbObject:
         """Store custom attributes, passed to repository - dict"""
         self._storage_vars = []
         """list of attributes name saved in db - list"""
+        self._unloaded_fields = set()
+        """attributes not read from db yet, they are read on their first access - set"""
 
     def _db_update(self, attribute_list):
         """
@@ -48,19 +58,46 @@ class PulseDbObject:
         """
         data = {k: self._storage_vars[k] for k in attribute_list}
         self.project.cnx.db.update(self.project.name, self.__class__.__name__, self.uri, data)
+        self.project.object_cache.invalidate(self.__class__.__name__, self.uri)
 
-    def db_read(self):
+    def db_read(self, fields=None):
         """
             read all object attributes from database.
 
             Will pass if the database have an attribute missing on the object.
             Returns ``None`` if nothing found.
 
+            :param fields: if set, only these attributes are read, the others are read on their first access
             :return: PulseDbObject or None
             :rtype: PulseDbObject
         """
-        data = self.project.cnx.db.read(self.project.name, self.__class__.__name__, self.uri)
-        
+        if fields is None:
+            data = self.project.cnx.db.read(self.project.name, self.__class__.__name__, self.uri)
+        else:
+            data = self.project.cnx.db.read(self.project.name, self.__class__.__name__, self.uri, fields=fields)
+        self.project.object_cache.set(self.__class__.__name__, self.uri, data, fields)
+        return self._db_load(data, fields)
+
+    def _cached_read(self, fields=None):
+        """
+            read all object attributes from the project object cache, or from database if the object is not cached
+            or its entry is expired. See db_read
+
+            :param fields: if set, only these attributes are needed, the others are read on their first access
+            :return: PulseDbObject
+        """
+        data = self.project.object_cache.get(self.__class__.__name__, self.uri, fields)
+        if data is None:
+            return self.db_read(fields)
+        return self._db_load(data, fields)
+
+    def _db_load(self, data, fields=None):
+        """
+            set the object attributes from data already read from database
+
+            :param fields: the attributes read, if set the others are marked to be read on their first access
+            :return: PulseDbObject or None if data is empty
+        """
         # Check data is valid
         if not data:
             return
@@ -69,8 +106,24 @@ class PulseDbObject:
             if k not in self._storage_vars:
                 continue
             self._storage_vars[k] = data[k]
+        self._unloaded_fields = set() if fields is None else set(self._storage_vars) - set(data)
         return self
 
+    def _get_storage_var(self, name):
+        """
+            return an attribute value, the attributes not read yet are read from database first
+
+            :param name: the attribute name
+        """
+        if name in self._unloaded_fields:
+            fields = sorted(self._unloaded_fields)
+            data = self.project.cnx.db.read(self.project.name, self.__class__.__name__, self.uri, fields=fields)
+            self.project.object_cache.set(self.__class__.__name__, self.uri, data, fields)
+            for k in data:
+                self._storage_vars[k] = data[k]
+            self._unloaded_fields = set()
+        return self._storage_vars[name]
+
     def db_create(self):
         """
             initialize the object in database
@@ -80,6 +133,7 @@ class PulseDbObject:
             raise DbError if the object already exists
         """
         self.project.cnx.db.create(self.project.name, self.__class__.__name__, self.uri, self._storage_vars)
+        self.project.object_cache.invalidate(self.__class__.__name__, self.uri)
 
 
 class LocalProduct:
@@ -93,21 +147,13 @@ class LocalProduct:
     def product_directory(self):
         return self.resource.get_products_directory(self.version)
 
-    @property
-    def pulse_product_data_file(self):
-        if isinstance(self, Work):
-            pulse_data_dir = self.project.work_product_data_directory
-        else:
-            pulse_data_dir = self.project.commit_product_data_directory
-        return os.path.normpath(os.path.join(pulse_data_dir, fu.uri_to_json_filename(self.uri)))
-
     def add_product_user(self, user_directory):
         """
         add a local resource or product as product's user
 
         :param user_directory: the resource path
         """
-        fu.json_list_append(self.pulse_product_data_file, user_directory)
+        self.project.local_products.add_user(self.uri, user_directory, work=isinstance(self, Work))
 
     def remove_product_user(self, user_directory):
         """
@@ -115,7 +161,7 @@ class LocalProduct:
 
         :param user_directory: the resource path
         """
-        fu.json_list_remove(self.pulse_product_data_file, user_directory)
+        self.project.local_products.remove_user(self.uri, user_directory, work=isinstance(self, Work))
 
     def get_product_users(self):
         """
@@ -123,7 +169,7 @@ class LocalProduct:
 
         :return: resources filepath list
         """
-        return fu.json_list_get(self.pulse_product_data_file)
+        return self.project.local_products.get_users(self.uri, work=isinstance(self, Work))
 
     def get_unused_time(self):
         """
@@ -137,22 +183,56 @@ class LocalProduct:
         users = self.get_product_users()
         if users:
             return -1
-        if os.path.exists(self.pulse_product_data_file):
-            return time.time() - os.path.getmtime(self.pulse_product_data_file) + 0.01
+        product = self.project.local_products.get_product(self.uri, work=isinstance(self, Work))
+        if product:
+            return time.time() - product["last_access"] + 0.01
         else:
             return time.time() - os.path.getctime(self.product_directory)
 
-    def init_local_product_data(self):
-        if not os.path.exists(self.pulse_product_data_file):
-            fu.json_list_init(self.pulse_product_data_file)
+    def init_local_product_data(self, evict=True):
         # lock files
         fu.lock_directory_content(self.product_directory)
+        if isinstance(self, Work):
+            # work products are not evicted, their size is not tracked
+            self.project.local_products.add(self.uri, self.product_directory, 0, work=True)
+            return
+        # index the new product, and make room for it if the products space is over its quota
+        self.project.local_products.add(
+            self.uri, self.product_directory, fu.get_directory_size(self.product_directory))
+        if evict:
+            self.project.evict_local_products(keep=[self.uri])
+
+
+def remove_local_product(product_directory):
+    """
+    remove a product directory from the user products space.
+    raise a PulseError if the directory is locked by a process
+    """
+    # test the folder can be moved
+    if not fu.test_path_write_access(product_directory):
+        raise PulseError("folder is in used by a process : " + product_directory)
+
+    # make all files writable
+    fu.lock_directory_content(product_directory, lock=False)
+
+    shutil.rmtree(product_directory)
+
+    # remove also the version directory if it's empty now
+    version_dir = os.path.dirname(product_directory)
+    if os.listdir(version_dir) == [cfg.pulse_filename]:
+        shutil.rmtree(version_dir)
+        parent_dir = os.path.dirname(version_dir)
+        if not os.listdir(parent_dir):
+            shutil.rmtree(parent_dir)
 
 
 class PublishedVersion(PulseDbObject, LocalProduct):
     """
         Object created when a resource has been published to database
     """
+    summary_fields = ["version", "comment", "work_inputs"]
+    """attributes read by the project getters, the files and directories lists are read on their first access"""
+
     def __init__(self, resource, version):
         self.uri = resource.uri + "@" + str(version)
         PulseDbObject.__init__(self, resource.project, self.uri)
@@ -165,6 +245,8 @@ class PublishedVersion(PulseDbObject, LocalProduct):
             'work_directories': [],
             'product_directories': []
         }
+        # the files manifest last decoded, as an (encoded, decoded) tuple
+        self._decoded_files = None
         LocalProduct.__init__(self)
         self.directory = self.product_directory
 
@@ -174,7 +256,16 @@ class PublishedVersion(PulseDbObject, LocalProduct):
 
     @property
     def files(self):
-        return self._storage_vars["files"]
+        """
+        the commit files, in the form {relative_path: {"checksum", "algorithm", "size", "mtime"}}. They are stored
+        as an encoded manifest, decoded on first access. Commits written before the manifest are stored as a dict
+        """
+        files = self._get_storage_var("files")
+        if not manifest.is_encoded(files):
+            return files
+        if self._decoded_files is None or self._decoded_files[0] is not files:
+            self._decoded_files = (files, manifest.decode_files(files))
+        return self._decoded_files[1]
 
     @property
     def comment(self):
@@ -186,14 +277,19 @@ class PublishedVersion(PulseDbObject, LocalProduct):
 
     @property
     def work_directories(self):
-        return self._storage_vars["work_directories"]
+        return self._get_storage_var("work_directories")
 
     @property
     def product_directories(self):
-        return self._storage_vars["product_directories"]
+        return self._get_storage_var("product_directories")
 
     def create(self, files, work_directories, product_directories, comment, work_inputs):
-        self._storage_vars["files"] = files
+        try:
+            self._storage_vars["files"] = manifest.encode_files(files)
+            self._decoded_files = (self._storage_vars["files"], files)
+        except ValueError:
+            # entries with custom keys are stored as they are
+            self._storage_vars["files"] = files
         self._storage_vars["work_directories"] = work_directories
         self._storage_vars["product_directories"] = product_directories
         self._storage_vars["comment"] = comment
@@ -202,9 +298,11 @@ class PublishedVersion(PulseDbObject, LocalProduct):
 
     def is_local(self, subpath=""):
         """
-        check if the version exists in local products
+        check if the version exists in local products.
+        The product data are only written once a download is complete, an interrupted download is not local
         """
-        return os.path.exists(os.path.join(self.product_directory, subpath))
+        return os.path.exists(os.path.join(self.product_directory, subpath)) and \
+            self.project.local_products.get_product(self.uri) is not None
 
     def remove_from_local_products(self):
         """
@@ -214,27 +312,10 @@ class PublishedVersion(PulseDbObject, LocalProduct):
         """
         if len(self.get_product_users()) > 0:
             raise PulseError("Can't remove a product still in use")
+        remove_local_product(self.product_directory)
+        self.project.local_products.remove(self.uri)
 
-        # test the folder can be moved
-        if not fu.test_path_write_access(self.product_directory):
-            raise PulseError("folder is in used by a process : " + self.product_directory)
-
-        # make all files writable
-        fu.lock_directory_content(self.product_directory, lock=False)
-
-        shutil.rmtree(self.product_directory)
-
-        # remove also the version directory if it's empty now
-        version_dir = os.path.dirname(self.product_directory)
-        if os.listdir(version_dir) == [cfg.pulse_filename]:
-            shutil.rmtree(version_dir)
-            parent_dir = os.path.dirname(version_dir)
-            if not os.listdir(parent_dir):
-                shutil.rmtree(parent_dir)
-
-        os.remove(self.pulse_product_data_file)
-
-    def download(self, resolve_conflict="error", subpath="", destination_folder=None):
+    def download(self, resolve_conflict="error", subpath="", destination_folder=None, evict=True):
         """
         download the resource_version to local pulse cache if it doesn't already exists.
         Since the downloaded version could be currently worked by the user, this could
@@ -243,30 +324,39 @@ class PublishedVersion(PulseDbObject, LocalProduct):
         :return: the local published version
         :param resolve_conflict: behaviour if there's already a local work product with the same uri
         :param subpath: only download a part of the commit
-        :param destination_folder: download to a custom directory
+        :param destination_folder: download to a custom directory, its files will be writable
+        :param evict: make room for the product if the products space is over its quota. Disabled when the
+         products downloaded together have to be linked first, see Project.evict_local_products
         """
         # remove leading slash in subpath
         if subpath.startswith("/"):
             subpath = subpath[1:]
 
+        # only the local products are read only, and can be linked to the repository files
+        writable = destination_folder is not None
         if not destination_folder:
             destination_folder = os.path.join(self.product_directory, subpath)
 
         if self.project.resolve_local_product_conflict(self.uri, resolve_conflict):
-            # recreate the directory structure
-            for rel_dir in self.product_directories:
-                if subpath != "":
-                    if subpath not in rel_dir:
-                        continue
-                abs_path = os.path.normpath(os.path.join(destination_folder, rel_dir[1:]))
-
-                if not os.path.exists(abs_path):
-                    os.makedirs(abs_path)
-
-            # download files
-            self.project.cnx.repositories[self.resource.repository].download_product(
-                self.project.name, self.uri, subpath=subpath, destination_folder=destination_folder)
-            self.init_local_product_data()
+            # a new directory is only renamed to its destination once complete
+            with fu.staging_directory(destination_folder) as staging_folder:
+                # recreate the directory structure
+                for rel_dir in self.product_directories:
+                    if subpath != "":
+                        if subpath not in rel_dir:
+                            continue
+                    abs_path = os.path.normpath(os.path.join(staging_folder, rel_dir[1:]))
+
+                    if not os.path.exists(abs_path):
+                        os.makedirs(abs_path)
+
+                # download files
+                repository = self.project.cnx.repositories[self.resource.repository]
+                repository.download_product(
+                    self.project.name, self.uri, subpath=subpath, destination_folder=staging_folder,
+                    **supported_arguments(repository.download_product, writable=writable)
+                )
+            self.init_local_product_data(evict)
 
         return self.product_directory
 
@@ -284,6 +374,7 @@ class Work(LocalProduct):
         self._resource = None
         self.version = None
         self.data_file = os.path.join(self.project.work_data_directory, fu.uri_to_json_filename(self.resource.uri))
+        self.checksum_cache_file = os.path.join(self.project.work_data_directory, self.resource.uri + ".cache")
         self.input_directory = os.path.join(self.directory, cfg.work_input_dir)
         self.output_directory = os.path.join(self.directory, cfg.work_output_dir)
         LocalProduct.__init__(self)
@@ -304,7 +395,7 @@ class Work(LocalProduct):
 
     def _get_trash_directory(self):
         date_time = datetime.now().strftime("%d%m%Y_%H%M%S")
-        path = os.path.join(self.project.abs_work_user_root, self.project.name, "TRASH") + os.sep
+        path = self.project.get_trash_path() + os.sep
         path += uri_standards.uri_to_filename(self.uri) + "-" + date_time
         index = 0
         path_base = path
@@ -314,14 +405,20 @@ class Work(LocalProduct):
         return path
 
     def _get_work_files(self):
-        files_dict = {}
-        excluded_path = [cfg.work_output_dir, cfg.work_input_dir]
-        for root, dirs, files in os.walk(self.directory, topdown=True):
-            dirs[:] = [d for d in dirs if d not in excluded_path]
-            for f in files:
-                filepath = os.path.join(root, f)
-                relative_path = filepath[len(self.directory):]
-                files_dict[relative_path.replace(os.sep, "/")] = {"checksum": fu.md5(filepath)}
+        """
+        return the work files with their checksum.
+        Only the files whose stat changed since the last call are hashed, thanks to the work checksum cache
+        """
+        checksum_cache = fu.read_checksum_cache(self.checksum_cache_file)
+        previous_cache = dict(checksum_cache)
+        files_dict = fu.get_file_list(
+            self.directory,
+            [cfg.work_output_dir, cfg.work_input_dir],
+            checksum_cache,
+            self.project.hash_algorithm
+        )
+        if checksum_cache != previous_cache:
+            fu.write_checksum_cache(self.checksum_cache_file, checksum_cache)
         return files_dict
 
     def get_inputs(self):
@@ -379,9 +476,7 @@ class Work(LocalProduct):
             raise PulseError("input already exists : " + input_name)
 
         # save input entry to disk
-        inputs[input_name] = uri
-        with open(self.products_inputs_file, "w") as write_file:
-            json.dump(inputs, write_file, indent=4, sort_keys=True)
+        self._write_input_entry(input_name, uri)
 
         return self.update_input(input_name, uri, consider_work_product)
 
@@ -401,6 +496,61 @@ class Work(LocalProduct):
         :param resolve_conflict: if the new product already exists as a local work, will give the resolve strategy
         :return: return the new product found for the input
         """
+        product, subpath = self._resolve_input(input_name, uri, consider_work_product)
+        if isinstance(product, PublishedVersion):
+            # if it's a commit version, download it
+            # check there's no conflict with a local product
+            product.download(resolve_conflict, subpath=subpath)
+        return self._link_input(input_name, product, subpath, uri)
+
+    def update_inputs(self, uris=None, consider_work_product=False, resolve_conflict="error",
+                      progress_callback=None):
+        """
+        update several work inputs, as update_input does.
+        All the inputs products are found first, then the missing ones are downloaded concurrently.
+
+        :param uris: dict of the inputs to update, with the uri to give to each one, or None to use the last
+         registered uri. If not set, all the work inputs are updated
+        :param consider_work_product: if set to True, update will look for local work product
+        :param resolve_conflict: if a new product already exists as a local work, will give the resolve strategy
+        :param progress_callback: called after each product download, see transfers.TransferScheduler
+        :return: dict of the new product found for each input
+        """
+        if uris is None:
+            uris = {x: None for x in self.get_inputs()}
+        resolved = OrderedDict()
+        for input_name, uri in uris.items():
+            resolved[input_name] = self._resolve_input(input_name, uri, consider_work_product)
+
+        # download each published version once, its subpaths one after the other
+        downloads = OrderedDict()
+        for product, subpath in resolved.values():
+            if isinstance(product, PublishedVersion):
+                product_downloads = downloads.setdefault(product.uri, (product, []))
+                if subpath not in product_downloads[1]:
+                    product_downloads[1].append(subpath)
+        scheduler = self.project.cnx.get_transfer_scheduler(progress_callback)
+        for product, subpaths in downloads.values():
+            scheduler.add(
+                product.resource.repository,
+                lambda p=product, s=subpaths: [p.download(resolve_conflict, subpath=x, evict=False) for x in s],
+                product.uri
+            )
+        scheduler.run()
+
+        linked_inputs = {
+            name: self._link_input(name, product, subpath, uris[name]) for name, (product, subpath) in resolved.items()
+        }
+        # the products are only evicted once they are all linked, a download can't evict another input
+        self.project.evict_local_products(keep=[product.uri for product, subpath in resolved.values()])
+        return linked_inputs
+
+    def _resolve_input(self, input_name, uri=None, consider_work_product=False):
+        """
+        find the product an input should use, without downloading it
+
+        :return: the product, a Work or a PublishedVersion, and the input subpath
+        """
         # abort if input doesn't exist
         inputs = self.get_inputs()
 
@@ -425,19 +575,24 @@ class Work(LocalProduct):
 
         # get the published product, and compare to work product version to get the last one
         product = self.project.get_published_version(uri)
-        if product:
-            if work and product.version < work.version:
-                product = work
-            else:
-                # if it's a commit version, download it
-                # check there's no conflict with a local product
-                product.download(resolve_conflict, subpath=uri_standards.convert_to_dict(uri)["subpath"])
-                if not os.path.exists(os.path.join(product.directory, subpath)):
-                    product = None
+        if product and work and product.version < work.version:
+            product = work
 
         if not product:
             raise PulseMissingNode("No product found for :" + uri)
+        return product, subpath
+
+    def _link_input(self, input_name, product, subpath, uri=None):
+        """
+        link a resolved input product to the work, and register the work as its user
+
+        :return: the product
+        """
+        if isinstance(product, PublishedVersion) and not os.path.exists(os.path.join(product.directory, subpath)):
+            raise PulseMissingNode("No product found for :" + (uri or product.uri + "/" + subpath))
 
+        inputs = self.get_inputs()
+        old_uri = inputs[input_name]
         # add a linked directory
         if self.project.use_linked_input_directories:
             if not os.path.exists(self.input_directory):
@@ -452,14 +607,25 @@ class Work(LocalProduct):
         # updated input data entry to disk if needed
         new_uri = product.uri + "/" + subpath
         if new_uri != old_uri:
-            inputs[input_name] = new_uri
-            with open(self.products_inputs_file, "w") as write_file:
-                json.dump(inputs, write_file, indent=4, sort_keys=True)
+            self._write_input_entry(input_name, new_uri)
 
         product.add_product_user(self.directory)
 
         return product
 
+    def _write_input_entry(self, input_name, uri):
+        """
+        write an input entry to the inputs file, or remove it if uri is None.
+        The lock is taken on the work data file, a lock file in the work directory would be a work file
+        """
+        with fu.file_lock(self.data_file):
+            inputs = self.get_inputs()
+            if uri is None:
+                inputs.pop(input_name, None)
+            else:
+                inputs[input_name] = uri
+            fu.write_data(self.products_inputs_file, inputs)
+
     def remove_input(self, input_name):
         """
         remove a product from inputs list
@@ -471,9 +637,7 @@ class Work(LocalProduct):
             raise PulseError("input does not exist : " + input_name)
 
         uri = inputs[input_name]
-        inputs.pop(input_name, None)
-        with open(self.products_inputs_file, "w") as write_file:
-            json.dump(inputs, write_file, indent=4, sort_keys=True)
+        self._write_input_entry(input_name, None)
 
         product = self.project.get_work(uri)
         if not product:
@@ -486,9 +650,11 @@ class Work(LocalProduct):
         if os.path.exists(input_directory):
             os.remove(input_directory)
 
-    def write(self):
+    def write(self, work_files=None):
         """
         write the work object to user workspace
+
+        :param work_files: the work files checksums, if they are already known
         """
         # create work folder if needed
         if not os.path.exists(self.directory):
@@ -500,7 +666,7 @@ class Work(LocalProduct):
             "entity": self.resource.entity,
             "resource_type": self.resource.resource_type,
             "outputs": [],
-            "work_files": self._get_work_files()
+            "work_files": work_files if work_files is not None else self._get_work_files()
             })
 
         # create work product directory
@@ -545,17 +711,44 @@ class Work(LocalProduct):
         """
         self._check_exists_in_user_workspace()
         # check current the user permission
+        self.resource.db_read()
         if self.resource.user_needs_lock():
             raise PulseError("resource is locked by another user : " + self.resource.lock_user)
 
-        # check the work is up to date
+        # lock the resource to prevent concurrent commit. The lock is only changed if nobody changed it since it has
+        # been read, two concurrent publishes can't both get it
+        db = self.project.cnx.db
+        previous_lock = {'lock_state': self.resource.lock_state, 'lock_user': self.resource.lock_user}
+        commit_lock = {'lock_state': True, 'lock_user': self.project.cnx.user_name + "_commit"}
+        if not db.compare_and_set(self.project.name, "Resource", self.resource.uri, previous_lock, commit_lock):
+            self.resource.db_read()
+            raise PulseError("resource is locked by another user : " + self.resource.lock_user)
+        self.project.object_cache.invalidate("Resource", self.resource.uri)
+
+        try:
+            published_version = self._publish(comment, restore_template_products)
+        finally:
+            # restore the resource lock state
+            db.compare_and_set(self.project.name, "Resource", self.resource.uri, commit_lock, previous_lock)
+            self.project.object_cache.invalidate("Resource", self.resource.uri)
+            self.resource._storage_vars.update(previous_lock)
+
+        published_version.init_local_product_data()
+        return published_version
+
+    def _publish(self, comment, restore_template_products):
+        """publish the work, the resource commit lock has to be held"""
+        # check the work is up to date, the last version is read again under the commit lock
         last_version = self.resource.get_last_version()
         expected_version = last_version + 1
         if not self.version == expected_version:
             raise PulseError("Your version is deprecated, it should be based on " + str(last_version))
 
+        # hash the work files once, the result is shared by the status check, the commit and the new work data
+        work_files = self._get_work_files()
+
         # check the work status
-        if not self.status():
+        if not self._get_status(work_files):
             raise PulseError("no file change to commit")
 
         # check all inputs are registered
@@ -565,25 +758,14 @@ class Work(LocalProduct):
             except PulseDatabaseMissingObject:
                 raise PulseError("Input should be commit first : " + input_uri)
 
-        # lock the resource to prevent concurrent commit
-        lock_state = self.resource.lock_state
-        lock_user = self.resource.lock_user
-        self.resource.set_lock(True, self.project.cnx.user_name + "_commit", steal=True)
-
-        # copy work files to a new version in repository
-        work_files = fu.get_file_list(self.directory, [cfg.work_output_dir, cfg.work_input_dir])
-        product_files = fu.get_file_list(self.product_directory)
-
+        product_files = fu.get_file_list(self.product_directory, algorithm=self.project.hash_algorithm)
         published_version = PublishedVersion(self.resource, self.version)
-        published_version.create(
-            files=self._get_work_files(),
-            work_directories=fu.get_directory_list(self.directory, [cfg.work_output_dir, cfg.work_input_dir]),
-            product_directories=fu.get_directory_list(self.product_directory),
-            comment=comment,
-            work_inputs=self.get_inputs()
-        )
 
-        published_version.project.cnx.repositories[self.resource.repository].upload_resource_commit(
+        # copy work files to a staging location in repository. The version is recorded in the database only once
+        # its files are uploaded, then they are made visible. A publish interrupted in between is finished or
+        # cleaned by Project.recover_interrupted_publishes
+        repository = self.project.cnx.repositories[self.resource.repository]
+        repository.stage_resource_commit(
             self.project.name,
             published_version.uri,
             self.directory,
@@ -591,13 +773,29 @@ class Work(LocalProduct):
             published_version.directory,
             product_files
             )
+        try:
+            published_version.create(
+                files=fu.add_file_stats(work_files, self.directory),
+                work_directories=fu.get_directory_list(self.directory, [cfg.work_output_dir, cfg.work_input_dir]),
+                product_directories=fu.get_directory_list(self.product_directory),
+                comment=comment,
+                work_inputs=self.get_inputs()
+            )
+        except BaseException:
+            repository.discard_resource_commit(self.project.name, published_version.uri)
+            raise
+        self.resource._storage_vars['last_version'] = self.version
+        self.resource._db_update(['last_version'])
 
         # remove work product data
-        os.remove(self.pulse_product_data_file)
+        self.project.local_products.remove(self.uri, work=True)
 
-        # increment the work and the products files
+        # increment the work and the products files. It's done before the promotion, if the promotion fails the
+        # version is already published for the database
         self.version += 1
-        self.write()
+        self.write(work_files)
+
+        repository.promote_resource_commit(self.project.name, published_version.uri)
 
         # restore template products if needed and possible
         if restore_template_products:
@@ -605,11 +803,6 @@ class Work(LocalProduct):
                 self.restore_template_products()
             except PulseDatabaseMissingObject:
                 pass
-
-        # restore the resource lock state
-        self.resource.set_lock(lock_state, lock_user, steal=True)
-
-        published_version.init_local_product_data()
         return published_version
 
     def restore_template_products(self):
@@ -633,10 +826,8 @@ class Work(LocalProduct):
 
         :return: True on success
         """
-        # trash the current content
-        self.trash(no_backup=True)
-        # checkout the last work commit version
-        self.resource.checkout(index=self.version - 1)
+        # checkout the last work commit version, over the current content
+        self._checkout_again(self._get_work_files(), index=self.version - 1)
         return True
 
     def update(self, force=False):
@@ -646,16 +837,30 @@ class Work(LocalProduct):
 
         :return: True on success
         """
+        work_files = self._get_work_files()
         # test there's no changes that could be lost
         if not force:
-            if self.status():
+            if self._get_status(work_files):
                 raise PulseError("local changes detected, you should commit or revert your work first")
-        # delete the work
-        self.trash(no_backup=True)
         # checkout the last resource commit version
-        self.resource.checkout()
+        self._checkout_again(work_files)
         return True
 
+    def _checkout_again(self, work_files, index="last"):
+        """
+        replace the work by a commit checkout. The work is moved aside, its files matching a commit file content
+        are reused instead of being downloaded again
+
+        :param work_files: the current work files checksums, as returned by _get_work_files
+        """
+        checksum_cache = fu.read_checksum_cache(self.checksum_cache_file)
+        trash_directory = self._move_to_trash()
+        try:
+            self.resource.checkout(
+                index=index, reused_work=(os.path.join(trash_directory, "work"), work_files, checksum_cache))
+        finally:
+            shutil.rmtree(trash_directory)
+
     def trash_products_content(self):
         """
         remove the work product content from user workspace
@@ -695,6 +900,17 @@ class Work(LocalProduct):
         :param no_backup: if False, the work folder is moved to trash directory. If True, it is removed from disk
         :return: True on success
         """
+        trash_directory = self._move_to_trash()
+        if no_backup:
+            shutil.rmtree(trash_directory)
+        return True
+
+    def _move_to_trash(self):
+        """
+        move the work and its products to a new trash directory, and forget the work data
+
+        :return: the trash directory path
+        """
         self._check_exists_in_user_workspace()
         # test the work and products folder are movable
         for path in [self.directory, self.product_directory]:
@@ -702,10 +918,8 @@ class Work(LocalProduct):
                 raise PulseError("Aborted. Can't move folder " + path)
 
         # unregister from products
-        for input_name, uri in self.get_inputs().items():
-            input_product = self.project.get_published_version(uri)
-            if os.path.exists(input_product.product_directory):
-                input_product.remove_product_user(self.directory)
+        for uri, work in self.project.local_products.get_used_products(self.directory):
+            self.project.local_products.remove_user(uri, self.directory, work)
 
         # create the trash work directory
         trash_directory = self._get_trash_directory()
@@ -725,14 +939,13 @@ class Work(LocalProduct):
         # move work files
         shutil.move(self.directory, trash_directory + "/work")
 
-        if no_backup:
-            shutil.rmtree(trash_directory)
-
         # remove work data file
         os.remove(self.data_file)
-        os.remove(self.pulse_product_data_file)
+        self.project.local_products.remove(self.uri, work=True)
+        if os.path.exists(self.checksum_cache_file):
+            os.remove(self.checksum_cache_file)
 
-        return True
+        return trash_directory
 
     def status(self):
         """
@@ -740,11 +953,10 @@ class Work(LocalProduct):
 
         :return: a list a tuple with the filepath and the edit type (edited, removed, added)
         """
+        return self._get_status(self._get_work_files())
 
-        diff = fu.compare_directory_content(
-            fu.get_file_list(self.directory, [cfg.work_output_dir, cfg.work_input_dir]),
-            fu.read_data(self.data_file)["work_files"]
-        )
+    def _get_status(self, work_files):
+        diff = fu.compare_directory_content(work_files, fu.read_data(self.data_file)["work_files"], self.directory)
 
         products_directory = self.resource.get_products_directory(self.version)
         for root, subdirectories, files in os.walk(products_directory):
@@ -773,6 +985,7 @@ class Resource(PulseDbObject):
             'lock_user': '',
             'repository': None,
             'resource_template': None,
+            'last_version': 0,
             'metas': {}
         }
 
@@ -785,8 +998,12 @@ class Resource(PulseDbObject):
         return self._storage_vars["lock_user"]
 
     def get_last_version(self):
-        versions = self.project.list_published_versions(uri_pattern=(self.uri + "*"))
-        return len(versions)
+        """
+        return the last published version number, 0 if the resource has never been published
+
+        :return: integer
+        """
+        return self.project.cnx.db.get_last_version(self.project.name, self.uri)
 
     @property
     def resource_type(self):
@@ -859,14 +1076,15 @@ class Resource(PulseDbObject):
                     raise PulseError("unsupported version name")
         return version_name
 
-    def get_commit(self, version):
+    def get_commit(self, version, fields=None):
         """
         get the commit object from the given version number
 
         :param version: integer
+        :param fields: if set, only these attributes are read, the others are read on their first access
         :return: Commit
         """
-        return PublishedVersion(self, self.get_index(version)).db_read()
+        return PublishedVersion(self, self.get_index(version))._cached_read(fields)
 
     def get_work(self):
         """
@@ -880,7 +1098,8 @@ class Resource(PulseDbObject):
         except PulseError:
             return None
 
-    def checkout(self, index="last", destination_folder=None, restore_products="template", resolve_conflict="error"):
+    def checkout(self, index="last", destination_folder=None, restore_products="template", resolve_conflict="error",
+                 progress_callback=None, reused_work=None):
         """
         Download the resource work files in the user work space.
         Download related dependencies if they are not available in user products space
@@ -890,6 +1109,10 @@ class Resource(PulseDbObject):
         :param destination_folder: where the resource will be checkout, if not set, project config is used
         :param index: the commit index to checkout. If not set, the last one will be used
         :param resolve_conflict: can be "error", "mine", or "theirs" depending how Pulse should resolve the conflict.
+        :param progress_callback: called after each input product download, see transfers.TransferScheduler
+        :param reused_work: a previous copy of the work, as a (directory, work files checksums, checksum cache)
+         tuple. Its files matching a commit file content are moved in place instead of being downloaded. If not set,
+         the files of the last trashed copy of the work are copied instead
         """
         if not os.path.exists(self.project.abs_work_user_root):
             self.project.initialize_sandbox()
@@ -949,8 +1172,18 @@ class Resource(PulseDbObject):
                 if not os.path.exists(absolute_dir):
                     os.makedirs(absolute_dir)
 
-            self.project.cnx.repositories[source_resource.repository].download_work(
-                self.project.name, source_commit.uri, destination_folder)
+            trashed_work = None if reused_work else self._get_trashed_work()
+            if reused_work:
+                self._reuse_work_files(work, source_resource, source_commit, destination_folder, *reused_work)
+            elif trashed_work:
+                self._reuse_work_files(
+                    work, source_resource, source_commit, destination_folder, *trashed_work, move=False)
+            else:
+                repository = self.project.cnx.repositories[source_resource.repository]
+                repository.download_work(
+                    self.project.name, source_commit.uri, destination_folder,
+                    **supported_arguments(repository.download_work, checksums=source_commit.files)
+                )
 
         work.write()
         # recreate last commit products from known template or from last commit
@@ -962,12 +1195,75 @@ class Resource(PulseDbObject):
         elif source_commit == "last" and source_commit:
             source_commit.download(destination_folder=work.product_directory)
 
-        # download requested input products if needed
-        for input_name, input_uri in work.get_inputs().items():
-            work.update_input(input_name, uri=input_uri, resolve_conflict=resolve_conflict)
+        # download requested input products if needed, concurrently
+        work.update_inputs(work.get_inputs(), resolve_conflict=resolve_conflict, progress_callback=progress_callback)
 
         return work
 
+    def _get_trashed_work(self):
+        """
+        return the last trashed copy of the resource work, as a (directory, work files checksums, checksum cache)
+        tuple, or None if there's none
+        """
+        trash_path = self.project.get_trash_path()
+        if not os.path.isdir(trash_path):
+            return None
+        # the trash directories are named after the work uri and the trash date, see Work._get_trash_directory
+        pattern = re.compile(re.escape(uri_standards.uri_to_filename(self.uri)) + r"@\d+-\d{8}_\d{6}(_\d+)?$")
+        trashed_works = [
+            os.path.join(x.path, "work") for x in os.scandir(trash_path)
+            if pattern.match(x.name) and os.path.isdir(os.path.join(x.path, "work"))
+        ]
+        if not trashed_works:
+            return None
+        directory = max(trashed_works, key=os.path.getmtime)
+        files = fu.get_file_list(
+            directory, [cfg.work_output_dir, cfg.work_input_dir], algorithm=self.project.hash_algorithm)
+        return directory, files, {}
+
+    def _reuse_work_files(self, work, source_resource, source_commit, destination_folder, reused_directory,
+                          reused_files, checksum_cache, move=True):
+        """
+        rebuild a commit work from a previous copy of it : the files whose content didn't change are moved,
+        only the others are downloaded. The checksum cache entries of the moved files are kept
+
+        :param move: if False, the files are copied and the previous copy is left untouched
+        """
+        # index the previous files by content, so a renamed file is reused too
+        reused_paths = {}
+        for filepath_rel, entry in reused_files.items():
+            reused_paths.setdefault(fu.checksum_key(entry), filepath_rel)
+
+        missing_files = []
+        moved_paths = {}
+        new_cache = {}
+        for filepath_rel, entry in source_commit.files.items():
+            key = fu.checksum_key(entry)
+            destination = destination_folder + filepath_rel
+            if key in moved_paths:
+                # the same content is used several times, copy the file already moved
+                fu.copy_file(moved_paths[key], destination)
+            elif key in reused_paths and not move:
+                fu.copy_file(reused_directory + reused_paths[key], destination, "reflink")
+                moved_paths[key] = destination
+            elif key in reused_paths:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.replace(reused_directory + reused_paths[key], destination)
+                moved_paths[key] = destination
+                if reused_paths[key] in checksum_cache:
+                    new_cache[filepath_rel] = checksum_cache[reused_paths[key]]
+            else:
+                missing_files.append(filepath_rel)
+
+        if missing_files:
+            repository = self.project.cnx.repositories[source_resource.repository]
+            repository.download_work(
+                self.project.name, source_commit.uri, destination_folder,
+                **supported_arguments(repository.download_work, files=missing_files, checksums=source_commit.files)
+            )
+        if new_cache:
+            fu.write_checksum_cache(work.checksum_cache_file, new_cache)
+
     def set_lock(self, state, user=None, steal=False):
         """
         change the lock state, and the lock user.
@@ -977,18 +1273,34 @@ class Resource(PulseDbObject):
         :param user: string
         :param steal: boolean
         """
-        # abort if the resource is locked by someone else and the user doesn't want to steal the lock
-        if not steal:
-            self.db_read()
-            if self.user_needs_lock(user):
-                return
-
-        self._storage_vars['lock_state'] = state
         if not user:
-            self._storage_vars['lock_user'] = self.project.cnx.user_name
+            user = self.project.cnx.user_name
+        if steal:
+            self._storage_vars['lock_state'] = state
+            self._storage_vars['lock_user'] = user
+            self._db_update(['lock_user', 'lock_state'])
+            return
+
+        # the lock is checked and changed by the database in one operation, it can't be taken by two users
+        # abort if the resource is locked by someone else
+        db = self.project.cnx.db
+        if state:
+            changed = db.try_lock(self.project.name, self.uri, user)
         else:
+            self.db_read()
+            changed = not self.user_needs_lock(user) and db.compare_and_set(
+                self.project.name,
+                "Resource",
+                self.uri,
+                {'lock_state': self.lock_state, 'lock_user': self.lock_user},
+                {'lock_state': False, 'lock_user': user}
+            )
+        if changed:
+            self.project.object_cache.invalidate("Resource", self.uri)
+            self._storage_vars['lock_state'] = state
             self._storage_vars['lock_user'] = user
-        self._db_update(['lock_user', 'lock_state'])
+        else:
+            self.db_read()
 
     def set_repository(self, new_repository):
         """
@@ -1040,10 +1352,15 @@ class Project(PulseDbObject):
             "product_user_root": None,
             "default_repository": None,
             "use_linked_output_directory": True,
-            "use_linked_input_directories": True
+            "use_linked_input_directories": True,
+            "hash_algorithm": fu.DEFAULT_HASH_ALGORITHM
         }
         self._abs_work_user_root = ""
         self._abs_product_user_root = ""
+        self._local_products = None
+        self._local_products_filepath = None
+        self.object_cache = object_cache.ObjectCache(connection.object_cache_ttl)
+        """read through cache of the database objects, see object_cache.ObjectCache"""
 
     @property
     def abs_work_user_root(self):
@@ -1073,6 +1390,10 @@ class Project(PulseDbObject):
     def use_linked_input_directories(self):
         return self._storage_vars["use_linked_input_directories"]
 
+    @property
+    def hash_algorithm(self):
+        return self._storage_vars["hash_algorithm"]
+
     def _update_local_roots_path(self):
         self._abs_work_user_root = os.path.expandvars(self.work_user_root)
         self._abs_product_user_root = os.path.expandvars(self.product_user_root)
@@ -1080,12 +1401,17 @@ class Project(PulseDbObject):
     def get_sandbox_path(self, uri):
         return os.path.join(self.abs_work_user_root, self.name, uri)
 
+    def get_trash_path(self):
+        """return the directory where the trashed works are moved"""
+        return os.path.join(self.abs_work_user_root, self.name, "TRASH")
+
     def create(self,
                default_repository,
                work_user_root,
                product_user_root,
                use_linked_output_directory,
-               use_linked_input_directories):
+               use_linked_input_directories,
+               hash_algorithm=fu.DEFAULT_HASH_ALGORITHM):
         """
         initialize the project configuration and save it to database
         """
@@ -1094,6 +1420,7 @@ class Project(PulseDbObject):
         self._storage_vars['product_user_root'] = product_user_root
         self._storage_vars['use_linked_output_directory'] = use_linked_output_directory
         self._storage_vars['use_linked_input_directories'] = use_linked_input_directories
+        self._storage_vars['hash_algorithm'] = hash_algorithm
         self.db_create()
         self._update_local_roots_path()
 
@@ -1121,7 +1448,8 @@ class Project(PulseDbObject):
         """
         return the resource version corresponding of the given uri
         @last or no version return the last version
-        raise a PulseError if the uri is not found in the project
+        raise a PulseError if the uri is not found in the project.
+        The version files and directories lists are read on their first access
         :param uri_string: a pulse product uri
         :return: PublishedVersion
         """
@@ -1129,23 +1457,17 @@ class Project(PulseDbObject):
         uri_string = uri_string.split("/", 1)[0]
         uri_dict = uri_standards.convert_to_dict(uri_string)
         resource = Resource(self, uri_dict['entity'], uri_dict['resource_type'])
-        resource.db_read()
+        resource._cached_read()
 
         if not uri_dict['version'] or uri_dict['version'] == "last":
-            commits = self.cnx.db.find_uris(
-                self.name,
-                "PublishedVersion",
-                uri_standards.edit(uri_string, {"version": "*"})
-            )
-            if not commits:
+            last_version = resource.get_last_version()
+            if not last_version:
                 raise PulseMissingNode("No published version found for :" + uri_string)
-            commits.sort()
-            last_version = uri_standards.convert_to_dict(commits[-1])["version"]
-            return resource.get_commit(last_version)
+            return resource.get_commit(last_version, PublishedVersion.summary_fields)
 
         else:
             index = resource.get_index(uri_dict['version'])
-            return resource.get_commit(index)
+            return resource.get_commit(index, PublishedVersion.summary_fields)
 
     def list_published_versions(self, uri_pattern="*", local_only=False):
         """
@@ -1157,14 +1479,51 @@ class Project(PulseDbObject):
         :return: uri list
         """
         if local_only:
-            if not os.path.exists(self.commit_product_data_directory):
-                return []
-            path_list = glob.glob(os.path.join(self.commit_product_data_directory, uri_pattern) + ".json")
-            file_list = [os.path.basename(x) for x in path_list]
-            return [fu.json_filename_to_uri(filename) for filename in file_list]
+            return self.local_products.list_uris(uri_pattern)
 
         return self.cnx.db.find_uris(self.name, "PublishedVersion", uri_pattern)
 
+    def get_resources(self, uri_pattern="*"):
+        """
+        return the project resources matching the uri pattern, read with a single database request.
+        The pattern should be in the glob search type
+
+        :param uri_pattern: string
+        :return: Resource list, sorted by uri
+        """
+        resources = []
+        for uri, data in sorted(self.cnx.db.list_objects(self.name, "Resource", uri_pattern).items()):
+            uri_dict = uri_standards.convert_to_dict(uri)
+            resources.append(Resource(self, uri_dict["entity"], uri_dict["resource_type"])._db_load(data))
+        return resources
+
+    def get_published_versions(self, uri_pattern="*"):
+        """
+        return the published versions matching the uri pattern, with their resources.
+        Versions and resources are each read with a single database request, the versions files and directories
+        lists are read on their first access
+
+        :param uri_pattern: string
+        :return: PublishedVersion list, sorted by resource uri and version number
+        """
+        versions_data = self.cnx.db.list_objects(
+            self.name, "PublishedVersion", uri_pattern, PublishedVersion.summary_fields)
+        resources = {}
+        resource_uris = set(uri.split("@")[0] for uri in versions_data)
+        for uri, data in self.cnx.db.read_many(self.name, "Resource", resource_uris).items():
+            uri_dict = uri_standards.convert_to_dict(uri)
+            resources[uri] = Resource(self, uri_dict["entity"], uri_dict["resource_type"])._db_load(data)
+
+        published_versions = []
+        for uri, data in versions_data.items():
+            resource_uri, version = uri.split("@")
+            if resource_uri not in resources:
+                continue
+            published_versions.append(
+                PublishedVersion(resources[resource_uri], version)._db_load(data, PublishedVersion.summary_fields))
+        published_versions.sort(key=lambda x: (x.resource.uri, x.version))
+        return published_versions
+
     def list_works(self, uri_pattern="*"):
         """
         return the list of work resource in user sandbox
@@ -1178,7 +1537,8 @@ class Project(PulseDbObject):
 
     def purge_unused_local_products(self, unused_days=0, resource_filter=None, dry_mode=False):
         """
-        remove unused products from the user product space, based on a unused time
+        remove unused products from the user product space, based on a unused time.
+        The products are found from the local products index, the database is not read
 
         :param unused_days: for how many days this products have not been used by the user
         :param resource_filter: affect only products with the uri starting by the given string
@@ -1186,18 +1546,131 @@ class Project(PulseDbObject):
         :return: purge products list
         """
         purged_products = []
-        for uri in self.list_published_versions(local_only=True):
+        now = time.time()
+        for product in self.local_products.get_products(unused_only=True):
             if resource_filter:
-                if not uri.startswith(resource_filter.uri):
+                if not product["uri"].startswith(resource_filter.uri):
                     continue
-
-            product = self.get_published_version(uri)
-            if product.get_unused_time() > (unused_days*86400):
-                purged_products.append(product.uri)
-                if not dry_mode:
-                    product.remove_from_local_products()
+            if now - product["last_access"] < unused_days * 86400:
+                continue
+            purged_products.append(product["uri"])
+            if not dry_mode:
+                remove_local_product(product["directory"])
+                self.local_products.remove(product["uri"])
         return purged_products
 
+    def recover_interrupted_publishes(self, stale_hours=24, dry_mode=False):
+        """
+        finish or clean the publishes interrupted after their files have been staged in a repository, as by a crash.
+        A staged commit already recorded in the database is promoted, so its version can be downloaded.
+        Otherwise it is discarded, once it's older than stale_hours : a younger one can belong to a running publish
+
+        :param stale_hours: age of the staged commits missing from the database to discard
+        :param dry_mode: do not change the repositories
+        :return: dict in the form {"promoted": uris list, "discarded": uris list}
+        """
+        recovered_commits = {"promoted": [], "discarded": []}
+        now = time.time()
+        for repository in self.cnx.repositories.values():
+            staged_commits = repository.list_staged_commits(self.name)
+            if not staged_commits:
+                continue
+            published_versions = self.cnx.db.read_many(self.name, "PublishedVersion", staged_commits)
+            for uri in sorted(staged_commits):
+                if uri in published_versions:
+                    recovered_commits["promoted"].append(uri)
+                    if not dry_mode:
+                        repository.promote_resource_commit(self.name, uri)
+                elif now - staged_commits[uri] >= stale_hours * 3600:
+                    recovered_commits["discarded"].append(uri)
+                    if not dry_mode:
+                        repository.discard_resource_commit(self.name, uri)
+        return recovered_commits
+
+    def evict_local_products(self, quota=None, keep=()):
+        """
+        remove the least recently used products from the user product space, until its size is under the quota.
+        Products used by a work, or locked by a process, are kept. The database is not read.
+        The evictions of the threads and processes sharing the products space run one after the other
+
+        :param quota: size limit in bytes, the connection local_products_quota if not set.
+         Nothing is evicted if there's no quota
+        :param keep: uris of products which must not be evicted
+        :return: the evicted products uris
+        """
+        if quota is None:
+            quota = self.cnx.local_products_quota
+        if quota is None:
+            return []
+        evicted_products = []
+        with fu.file_lock(self.local_products.filepath):
+            total_size = self.local_products.get_total_size()
+            for product in self.local_products.get_products(unused_only=True):
+                if total_size <= quota:
+                    break
+                # a product can have been linked since the products have been listed
+                if product["uri"] in keep or self.local_products.get_users(product["uri"]):
+                    continue
+                if os.path.exists(product["directory"]):
+                    try:
+                        remove_local_product(product["directory"])
+                    except PulseError:
+                        continue
+                self.local_products.remove(product["uri"])
+                total_size -= product["size"]
+                evicted_products.append(product["uri"])
+        return evicted_products
+
+    @property
+    def local_products(self):
+        """
+        the index of the products in the user product space, with their users
+
+        :return: LocalProductIndex
+        """
+        product_root = os.path.join(self.abs_product_user_root, self.name)
+        filepath = os.path.join(product_root, cfg.pulse_data_dir, local_products.INDEX_FILENAME)
+        if self._local_products is None or self._local_products_filepath != filepath:
+            self._local_products = local_products.LocalProductIndex(filepath)
+            self._local_products_filepath = filepath
+            if self._local_products.created:
+                self._index_local_products()
+        return self._local_products
+
+    def _index_local_products(self):
+        """
+        register the products recorded before the index existed, with their users.
+        Their json users lists are removed once indexed. The works inputs are registered as users too, the index
+        can have been deleted after the json lists
+        """
+        for data_directory, work in [(self.commit_product_data_directory, False),
+                                     (self.work_product_data_directory, True)]:
+            for data_file in glob.glob(os.path.join(data_directory, "*.json")):
+                uri = fu.json_filename_to_uri(data_file)
+                resource_uri, version = uri.split("@")
+                uri_dict = uri_standards.convert_to_dict(resource_uri)
+                resource = Resource(self, uri_dict["entity"], uri_dict["resource_type"])
+                directory = resource.get_products_directory(version)
+                if os.path.exists(directory):
+                    for user_directory in fu.json_list_get(data_file):
+                        self._local_products.add_user(uri, user_directory, work)
+                    size = 0 if work else fu.get_directory_size(directory)
+                    self._local_products.add(uri, directory, size, work, os.path.getmtime(data_file))
+                os.remove(data_file)
+
+        for work_uri in self.list_works():
+            work_directory = self.get_sandbox_path(work_uri)
+            inputs_file = os.path.join(work_directory, cfg.input_data_filename)
+            if not os.path.exists(inputs_file):
+                continue
+            for input_uri in fu.read_data(inputs_file).values():
+                product_uri = input_uri.split("/")[0]
+                # an input is only resolved to a version once its product is linked
+                if "@" not in product_uri:
+                    continue
+                work = self._local_products.get_product(product_uri, work=True) is not None
+                self._local_products.add_user(product_uri, work_directory, work)
+
     @property
     def work_directory(self):
         return os.path.join(self.abs_work_user_root, self.name)
@@ -1234,8 +1707,7 @@ class Project(PulseDbObject):
         # write connexion path and settings to local project settings
         json_path = os.path.join(self.work_directory, cfg.pulse_data_dir, cfg.project_settings)
         data = {'connection': self.cnx.get_settings()}
-        with open(json_path, "w") as write_file:
-            json.dump(data, write_file, indent=4, sort_keys=True)
+        fu.write_data(json_path, data)
 
     def get_resource(self, uri):
         """
@@ -1247,7 +1719,7 @@ class Project(PulseDbObject):
         """
         uri_dict = uri_standards.convert_to_dict(uri)
         try:
-            resource = Resource(self, uri_dict["entity"], uri_dict["resource_type"]).db_read()
+            resource = Resource(self, uri_dict["entity"], uri_dict["resource_type"])._cached_read()
         except PulseDatabaseMissingObject:
             return
         return resource
@@ -1308,7 +1780,30 @@ class Connection:
     """
         connection instance to a Pulse database
     """
-    def __init__(self, adapter, path="", username="", password="", **settings):
+    def __init__(self, adapter, path="", username="", password="", max_workers=None, cache_path=None,
+                 cache_quota=repository_cache.DEFAULT_QUOTA, local_products_quota=None,
+                 object_cache_ttl=object_cache.DEFAULT_TTL, **settings):
+        """
+        :param adapter: the database adapter name
+        :param max_workers: number of files hashed or copied concurrently, if not set file_utils default is kept.
+         The thread pool is shared by the connections of the process, its size can't change once it has started
+        :param cache_path: directory of a workstation cache for the downloaded files, shared by all the projects
+         and repositories. If not set, downloads always go to the repositories. See repository_cache
+        :param cache_quota: the cache size limit in bytes
+        :param local_products_quota: size limit in bytes of each project user product space. Beyond, the least
+         recently used products are removed when a new one is downloaded, see Project.evict_local_products
+        :param object_cache_ttl: seconds a resource read from the database is reused by a project, 0 to always read
+         the database. Published versions never change, they are always reused. See object_cache
+        :param settings: database adapter settings
+        """
+        if max_workers:
+            try:
+                fu.set_max_workers(max_workers)
+            except ValueError as ex:
+                raise PulseError(str(ex))
+        self.local_products_quota = local_products_quota
+        self.object_cache_ttl = object_cache_ttl
+        self.cache = repository_cache.get_cache(cache_path, cache_quota) if cache_path else None
         self.db = import_adapter("database", adapter).Database(path, username, password, settings)
         self.path = path
         self.user_name = self.db.get_user_name()
@@ -1316,20 +1811,46 @@ class Connection:
         self._adapter = adapter
         self._settings = settings
 
+    @property
+    def max_workers(self):
+        return fu.get_max_workers()
+
     def get_settings(self):
         return {'path': self.path, 'settings': self._settings, 'adapter': self._adapter}
 
+    def get_transfer_scheduler(self, progress_callback=None):
+        """
+        return a scheduler to run transfers concurrently.
+        The simultaneous transfers for each repository are limited by its max_transfers setting
+
+        :param progress_callback: see transfers.TransferScheduler
+        :return: TransferScheduler
+        """
+        repository_limits = {}
+        for name, repository in self.repositories.items():
+            if repository.settings and "max_transfers" in repository.settings:
+                repository_limits[name] = int(repository.settings["max_transfers"])
+        return TransferScheduler(repository_limits=repository_limits, progress_callback=progress_callback)
+
     def get_repositories(self):
         repositories = {}
         db_repositories = self.db.get_repositories()
         for name in db_repositories:
             db_repo = db_repositories[name]
-            repositories[name] = import_adapter("repository", db_repo['adapter']).Repository(
+            repositories[name] = self._build_repository(
+                db_repo['adapter'],
                 db_repo['login'],
                 db_repo['password'],
                 db_repo['settings'])
         return repositories
 
+    def _build_repository(self, adapter, login, password, settings):
+        repository = import_adapter("repository", adapter).Repository(
+            settings=settings, login=login, password=password)
+        if self.cache:
+            repository = repository_cache.CachedRepository(repository, self.cache)
+        return repository
+
     def get_projects(self):
         return self.db.get_projects()
 
@@ -1339,7 +1860,8 @@ class Connection:
                        default_repository,
                        product_user_root,
                        use_linked_output_directory=True,
-                       use_linked_input_directories=True
+                       use_linked_input_directories=True,
+                       hash_algorithm=fu.DEFAULT_HASH_ALGORITHM
                        ):
         """
         create a new project in the connexion database
@@ -1354,12 +1876,16 @@ class Connection:
          product
         :param use_linked_input_directories: create a input directory in each work directory containing
          linked directories pointing to the input products
+        :param hash_algorithm: the algorithm used for files checksums, one of file_utils.HASH_ALGORITHMS.
+         "blake2b" is faster than the default "md5", "xxh3_128" and "blake3" even more when their module are installed
         :return: the new pulse Project
         """
         work_user_root = work_user_root.replace("\\", "/")
         product_user_root = product_user_root.replace("\\", "/")
         if work_user_root in product_user_root or product_user_root in work_user_root:
             raise PulseError("work user root and product user root should be independent")
+        if hash_algorithm not in fu.HASH_ALGORITHMS:
+            raise PulseError("unsupported hash algorithm : " + hash_algorithm)
 
         project = Project(self, project_name)
         self.db.create_project(project_name)
@@ -1368,7 +1894,8 @@ class Connection:
             work_user_root,
             product_user_root,
             use_linked_output_directory,
-            use_linked_input_directories
+            use_linked_input_directories,
+            hash_algorithm
         )
 
         return project
@@ -1389,6 +1916,10 @@ class Connection:
 
     def delete_project(self, project_name):
         self.db.delete_project(project_name)
+        # a project created again with the same name will have other commits
+        for repository in self.repositories.values():
+            if isinstance(repository, repository_cache.CachedRepository):
+                repository.forget_manifests(project_name)
 
     def add_repository(self, name, adapter, login="", password="", **settings):
         """
@@ -1403,7 +1934,7 @@ class Connection:
         if name in self.repositories:
             raise PulseError("Repository already exists : " + name)
         # test valid settings
-        repository = import_adapter("repository", adapter).Repository(settings=settings, login=login, password=password)
+        repository = self._build_repository(adapter, login, password, settings)
         repository.test_settings()
         # write repo settings to db config
         self.repositories[name] = repository
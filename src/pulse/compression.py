@@ -0,0 +1,190 @@
+import os
+import zlib
+import lzma
+import pulse.file_utils as fu
+
+COMPRESSED_SUFFIX = ".pulse_z"
+"""suffix of the files stored compressed in a repository"""
+MAGIC = b"PULSEZ"
+"""first bytes of a compressed file, followed by the codec name length on one byte, and the codec name"""
+
+CODECS = {
+    "zlib": (lambda: zlib.compressobj(6), zlib.decompressobj),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor)
+}
+"""compressor and decompressor factories, by codec name. Optional ones are registered only if their module is
+ installed"""
+try:
+    import zstandard
+    CODECS["zstd"] = (
+        lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+        lambda: zstandard.ZstdDecompressor().decompressobj()
+    )
+except ImportError:
+    pass
+DEFAULT_CODEC = "zstd" if "zstd" in CODECS else "zlib"
+"""codec used when a repository compression setting is "auto\""""
+
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".bz2", ".gz", ".rar", ".xz", ".zip", ".zst",
+    ".gif", ".heic", ".jp2", ".jpeg", ".jpg", ".png", ".webp",
+    ".aac", ".avi", ".flac", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".webm"
+}
+"""extensions of file types already compressed, they are stored as is"""
+MIN_COMPRESSED_SIZE = 512
+"""smaller files are stored as is, the compression can't save much"""
+SAMPLE_SIZE = 64 * 1024
+"""bytes read at the beginning of a file to guess if it's worth compressing"""
+MAX_SAMPLE_RATIO = 0.9
+"""if the sample doesn't compress under this ratio, its data entropy is already high, the file is stored as is"""
+
+
+def get_codec(setting):
+    """
+    return the codec name to use for a repository compression setting, None if the compression is disabled.
+    raise a ValueError if the codec is not available
+    """
+    if not setting:
+        return None
+    codec = DEFAULT_CODEC if setting == "auto" else setting
+    if codec not in CODECS:
+        raise ValueError("compression codec not available : " + codec)
+    return codec
+
+
+def is_worth_compressing(filepath):
+    """
+    guess if a file would be smaller compressed, from its extension, its size, and the compression ratio of
+    a sample from its beginning
+    """
+    if os.path.splitext(filepath)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    if os.path.getsize(filepath) < MIN_COMPRESSED_SIZE:
+        return False
+    with open(filepath, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_SAMPLE_RATIO
+
+
+def build_header(codec):
+    codec_name = codec.encode("ascii")
+    return MAGIC + bytes([len(codec_name)]) + codec_name
+
+
+class CompressedReader:
+    """
+    file like object returning the compressed content of a file, compressed on the fly while it's read.
+    The content starts with the header naming the codec
+    """
+    def __init__(self, source_file, codec):
+        self._source_file = source_file
+        self._compressor = CODECS[codec][0]()
+        self._buffer = build_header(codec)
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._source_file.read(fu.BUFFER_SIZE)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+
+class DecompressingWriter:
+    """
+    file like object decompressing the data written to it, as they come.
+    The codec is read from the header of the data
+    """
+    def __init__(self, destination_file):
+        self._destination_file = destination_file
+        self._decompressor = None
+        self._header = b""
+
+    def write(self, data):
+        if self._decompressor is None:
+            self._header += data
+            header_size = len(MAGIC) + 1
+            if len(self._header) < header_size or len(self._header) < header_size + self._header[len(MAGIC)]:
+                return
+            if not self._header.startswith(MAGIC):
+                raise ValueError("not a pulse compressed file")
+            codec_end = header_size + self._header[len(MAGIC)]
+            codec = self._header[header_size:codec_end].decode("ascii")
+            if codec not in CODECS:
+                raise ValueError("compression codec not available : " + codec)
+            self._decompressor = CODECS[codec][1]()
+            data = self._header[codec_end:]
+        self._destination_file.write(self._decompressor.decompress(data))
+
+    def close(self):
+        if self._decompressor is None:
+            raise ValueError("truncated pulse compressed file")
+        flush = getattr(self._decompressor, "flush", None)
+        if flush:
+            self._destination_file.write(flush())
+
+
+def compress_file(source, destination, codec):
+    """compress a file, the destination is written under a temporary name and renamed once complete"""
+    partial_path = destination + fu.PARTIAL_SUFFIX
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(source, "rb") as source_file, open(partial_path, "wb") as destination_file:
+        reader = CompressedReader(source_file, codec)
+        chunk = reader.read(fu.BUFFER_SIZE)
+        while chunk:
+            destination_file.write(chunk)
+            chunk = reader.read(fu.BUFFER_SIZE)
+    os.replace(partial_path, destination)
+
+
+def decompress_file(source, destination):
+    """decompress a file, the destination is written under a temporary name and renamed once complete"""
+    partial_path = destination + fu.PARTIAL_SUFFIX
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    with open(source, "rb") as source_file, open(partial_path, "wb") as destination_file:
+        writer = DecompressingWriter(destination_file)
+        chunk = source_file.read(fu.BUFFER_SIZE)
+        while chunk:
+            writer.write(chunk)
+            chunk = source_file.read(fu.BUFFER_SIZE)
+        writer.close()
+    os.replace(partial_path, destination)
+
+
+def store_file(source, destination, codec=None, strategy="copy"):
+    """
+    copy a file to a repository. If a codec is given and the file is worth it, it's stored compressed, with
+    the compressed suffix added to the destination name
+
+    :return: the stored file path
+    """
+    if codec and is_worth_compressing(source):
+        destination += COMPRESSED_SUFFIX
+        compress_file(source, destination, codec)
+    else:
+        fu.copy_file(source, destination, strategy)
+    return destination
+
+
+def restore_file(source, destination, strategy="copy"):
+    """
+    copy a file from a repository, decompressing it if it has the compressed suffix.
+    The suffix is removed from the destination name, an existing destination file is kept
+
+    :return: the restored file path
+    """
+    if source.endswith(COMPRESSED_SUFFIX):
+        if destination.endswith(COMPRESSED_SUFFIX):
+            destination = destination[:-len(COMPRESSED_SUFFIX)]
+        if not os.path.exists(destination):
+            decompress_file(source, destination)
+    else:
+        fu.copy_file(source, destination, strategy)
+    return destination
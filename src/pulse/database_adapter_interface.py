@@ -21,19 +21,21 @@ class PulseDatabase:
     }
 
     project_tables = {
-        'Config': [
+        'Project': [
             "work_user_root VARCHAR(255)",
             "product_user_root VARCHAR(255)",
             "default_repository VARCHAR(255)",
-            "version_padding SMALLINT",
-            "version_prefix VARCHAR(255)"
+            "use_linked_output_directory BOOLEAN",
+            "use_linked_input_directories BOOLEAN",
+            "hash_algorithm VARCHAR(255)"
         ],
-        'Commit': [
+        'PublishedVersion': [
             "version INT",
-            "products LONGTEXT",
             "files LONGTEXT",
             "comment VARCHAR(255)",
-            "products_inputs LONGTEXT"
+            "work_inputs LONGTEXT",
+            "work_directories LONGTEXT",
+            "product_directories LONGTEXT"
         ],
         'Resource': [
             "lock_state BOOLEAN",
@@ -41,11 +43,9 @@ class PulseDatabase:
             "resource_type VARCHAR(255)",
             "entity VARCHAR(255)",
             "repository VARCHAR(255)",
+            "resource_template VARCHAR(255)",
+            "last_version INT",
             "metas LONGTEXT"
-        ],
-        'CommitProduct': [
-            "product_type VARCHAR(255)",
-            "products_inputs LONGTEXT"
         ]
     }
     adapter_version = '0.0.1'
@@ -63,13 +63,101 @@ class PulseDatabase:
         pass
 
     def find_uris(self, project_name, entity_type, uri_pattern):
+        """
+        return the uris matching a glob pattern, sorted by resource uri and version number : "anna-mdl@2" comes
+        before "anna-mdl@10". A pattern without wildcard only matches its own uri
+        """
         pass
 
+    def get_last_version(self, project_name, resource_uri):
+        """
+        return the highest published version number of a resource, 0 if it has never been published.
+        This default implementation lists all the versions, adapters should override it with a direct lookup
+        """
+        versions = self.find_uris(project_name, "PublishedVersion", resource_uri + "@*")
+        return max([int(uri.split("@")[1]) for uri in versions] or [0])
+
     def get_user_name(self):
         pass
 
     def write(self, project_name, entity_type, uri, data_dict):
         pass
 
-    def read(self, project_name, entity_type, uri):
+    def read(self, project_name, entity_type, uri, fields=None):
+        """
+        read an object. raise a PulseDatabaseMissingObject if it doesn't exist
+
+        :param fields: if set, only these attributes are returned
+        :return: the object data dict
+        """
         pass
+
+    def compare_and_set(self, project_name, entity_type, uri, expected, data_dict):
+        """
+        update an object only if its attributes still have the expected values. The check and the update are a
+        single operation for the database, two concurrent calls expecting the same values can't both succeed
+
+        :param expected: dict of the attributes values the object should have
+        :param data_dict: dict of the attributes to update
+        :return: True if the object has been updated, False if an attribute has another value
+        """
+        pass
+
+    def try_lock(self, project_name, resource_uri, user):
+        """
+        lock a resource for a user, if it's not locked or already locked by this user.
+        This default implementation reads the lock and sets it with compare_and_set, adapters can override it
+        with a single conditional update
+
+        :return: True if the user holds the lock, False if another user does
+        """
+        while True:
+            data = self.read(project_name, "Resource", resource_uri)
+            if data["lock_state"] and data["lock_user"] != user:
+                return False
+            expected = {"lock_state": data["lock_state"], "lock_user": data["lock_user"]}
+            if self.compare_and_set(
+                    project_name, "Resource", resource_uri, expected, {"lock_state": True, "lock_user": user}):
+                return True
+
+    def read_many(self, project_name, entity_type, uris, fields=None):
+        """
+        read several objects at once. Adapters should override it with a single request
+
+        :param fields: if set, only these attributes are returned
+        :return: dict in the form {uri: data}, missing objects are skipped
+        """
+        objects = {}
+        for uri in uris:
+            try:
+                objects[uri] = self.read(project_name, entity_type, uri)
+            except PulseDatabaseMissingObject:
+                continue
+        return select_fields(objects, fields)
+
+    def list_objects(self, project_name, entity_type, uri_pattern="*", fields=None):
+        """
+        read all the objects matching a glob pattern. Adapters should override it with a single request
+
+        :param fields: if set, only these attributes are returned
+        :return: dict in the form {uri: data}
+        """
+        uris = self.find_uris(project_name, entity_type, uri_pattern)
+        return self.read_many(project_name, entity_type, uris, fields)
+
+
+def select_fields(objects, fields):
+    """
+    keep only the given attributes in a {uri: data} dict. Return the objects unchanged if fields is None
+    """
+    if fields is None:
+        return objects
+    return {uri: {k: v for k, v in data.items() if k in fields} for uri, data in objects.items()}
+
+
+def uri_sort_key(uri):
+    """
+    return a key sorting uris by resource uri, then by version number
+    """
+    resource_uri, _, version = uri.partition("@")
+    return (resource_uri, int(version) if version.isdigit() else -1, version)
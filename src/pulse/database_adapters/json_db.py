@@ -2,7 +2,25 @@ import json
 import os
 import glob
 import shutil
+import hashlib
+import fnmatch
+import re
 from pulse.database_adapter_interface import *
+import pulse.file_utils as fu
+
+LAYOUT_FILENAME = "layout.json"
+"""file of a project directory recording its layout, projects without it use the flat layout"""
+FLAT_LAYOUT = 1
+"""all the objects of an entity type are in a single directory"""
+SHARDED_LAYOUT = 2
+"""the objects are spread in fan-out directories, the published versions are grouped by resource"""
+FAN_OUT_LENGTH = 2
+"""hexadecimal characters of the fan-out directories names, 2 gives 256 directories"""
+INDEX_FILENAME = "index"
+"""file of a sharded entity type directory listing its uris, one per line, in their creation order"""
+DIRECTORY_LOCK_NAME = "objects"
+"""name of the file locked to write the objects of a directory, a single lock file is shared by the directory"""
+_WILDCARDS = re.compile(r"[*?\[]")
 
 
 class Database(PulseDatabase):
@@ -17,6 +35,8 @@ class Database(PulseDatabase):
         self._projects_path = os.path.join(self._root, "Project")
         self.config_name = "_Config"
         self.repo_filepath = os.path.join(self._root, self.config_name, "Repository")
+        # layouts of the projects already read, by project name
+        self._layouts = {}
 
     def get_repositories(self):
         repositories = {}
@@ -37,30 +57,155 @@ class Database(PulseDatabase):
 
     def create_repository(self, name, adapter, login, password, settings):
         json_filepath = os.path.join(self.repo_filepath, name + ".json")
-        if os.path.exists(json_filepath):
-            raise PulseDatabaseError("repository already exists:" + name)
-
-        with open(json_filepath, "w") as write_file:
+        with fu.file_lock(_directory_lock_filepath(json_filepath)):
+            if os.path.exists(json_filepath):
+                raise PulseDatabaseError("repository already exists:" + name)
             data = {"name": name, "adapter": adapter, "login": login, "password": password, "settings": settings}
-            json.dump(data, write_file, indent=4, sort_keys=True)
+            fu.write_data(json_filepath, data)
 
     def delete_project(self, project_name):
         project_directory = self._get_project_filepath(project_name)
         if not os.path.exists(project_directory):
             raise PulseDatabaseMissingObject("project missing : " + project_name)
         shutil.rmtree(project_directory)
+        self._layouts.pop(project_name, None)
 
     def create_project(self, project_name):
         project_directory = self._get_project_filepath(project_name)
         if os.path.exists(project_directory):
             raise PulseDatabaseError("project already exists")
         os.makedirs(project_directory)
+        fu.write_data(os.path.join(project_directory, LAYOUT_FILENAME), {"layout": SHARDED_LAYOUT})
+        self._layouts[project_name] = SHARDED_LAYOUT
 
-    def find_uris(self, project_name, entity_type, uri_pattern):
+    def get_project_layout(self, project_name):
+        """return the layout of a project directory, FLAT_LAYOUT or SHARDED_LAYOUT"""
+        if project_name not in self._layouts:
+            layout_filepath = os.path.join(self._get_project_filepath(project_name), LAYOUT_FILENAME)
+            if not os.path.exists(layout_filepath):
+                return FLAT_LAYOUT
+            self._layouts[project_name] = fu.read_data(layout_filepath)["layout"]
+        return self._layouts[project_name]
+
+    def migrate_project(self, project_name):
+        """
+        convert a project written with the flat layout to the sharded layout. The objects files are moved to their
+        fan-out directories, then the entity types indexes are rebuilt.
+        No client should use the project during the migration. An interrupted migration can be run again.
+
+        :return: the number of objects moved
+        """
+        project_directory = self._get_project_filepath(project_name)
+        if not os.path.isdir(project_directory):
+            raise PulseDatabaseMissingObject("project missing : " + project_name)
+        moved_count = 0
+        for entity_type in sorted(os.listdir(project_directory)):
+            entity_directory = os.path.join(project_directory, entity_type)
+            if not os.path.isdir(entity_directory):
+                continue
+            for entry in list(os.scandir(entity_directory)):
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(".json"):
+                    uri = entry.name[:-len(".json")].replace("%", ":")
+                    json_filepath = self._get_sharded_filepath(project_name, entity_type, uri)
+                    os.makedirs(os.path.dirname(json_filepath), exist_ok=True)
+                    os.replace(entry.path, json_filepath)
+                    moved_count += 1
+                elif entry.name.endswith(fu.LOCK_SUFFIX) and entry.name != INDEX_FILENAME + fu.LOCK_SUFFIX:
+                    # the lock files of the moved objects are not used anymore
+                    os.remove(entry.path)
+            self.rebuild_index(project_name, entity_type)
+        fu.write_data(os.path.join(project_directory, LAYOUT_FILENAME), {"layout": SHARDED_LAYOUT})
+        self._layouts[project_name] = SHARDED_LAYOUT
+        return moved_count
+
+    def rebuild_index(self, project_name, entity_type):
+        """
+        write again the index of a sharded entity type from its directory content. An object is missing from the
+        index if its creation has been interrupted after writing its file
+        """
+        entity_directory = os.path.join(self._get_project_filepath(project_name), entity_type)
         uris = []
-        for path in glob.glob(self._get_json_filepath(project_name, entity_type, uri_pattern)):
-            uris.append((os.path.splitext(os.path.basename(path))[0]).replace("%", ":"))
-        return uris
+        for root, dirs, files in os.walk(entity_directory):
+            dirs.sort()
+            relative_root = os.path.relpath(root, entity_directory).split(os.sep)
+            for filename in sorted(files):
+                if relative_root == ["."] or not filename.endswith(".json"):
+                    continue
+                name = filename[:-len(".json")]
+                # the published versions are in a directory named after their resource
+                if len(relative_root) == 2:
+                    name = relative_root[1] + "@" + name
+                uris.append(name.replace("%", ":"))
+        index_filepath = os.path.join(entity_directory, INDEX_FILENAME)
+        with fu.file_lock(index_filepath):
+            temp_path = index_filepath + ".tmp" + str(os.getpid())
+            with open(temp_path, "w", encoding="utf-8") as write_file:
+                write_file.write("".join(x + "\n" for x in uris))
+                write_file.flush()
+                os.fsync(write_file.fileno())
+            os.replace(temp_path, index_filepath)
+
+    def find_uris(self, project_name, entity_type, uri_pattern):
+        return sorted(self._find_uris(project_name, entity_type, uri_pattern), key=uri_sort_key)
+
+    def _find_uris(self, project_name, entity_type, uri_pattern):
+        if self.get_project_layout(project_name) == FLAT_LAYOUT:
+            uris = []
+            for path in glob.glob(self._get_json_filepath(project_name, entity_type, uri_pattern)):
+                uris.append((os.path.splitext(os.path.basename(path))[0]).replace("%", ":"))
+            return uris
+
+        if not _WILDCARDS.search(uri_pattern):
+            if os.path.exists(self._get_json_filepath(project_name, entity_type, uri_pattern)):
+                return [uri_pattern]
+            return []
+        resource_uri, separator, version_pattern = uri_pattern.rpartition("@")
+        if entity_type == "PublishedVersion" and separator and not _WILDCARDS.search(resource_uri):
+            # the versions of a single resource are listed from its directory
+            resource_directory = os.path.dirname(self._get_json_filepath(project_name, entity_type, uri_pattern))
+            return [
+                resource_uri + "@" + os.path.basename(x)[:-len(".json")]
+                for x in glob.glob(os.path.join(resource_directory, version_pattern + ".json"))
+            ]
+        # other patterns are matched against the index, starting with the text before the first wildcard
+        prefix = uri_pattern[:_WILDCARDS.search(uri_pattern).start()]
+        return [
+            x for x in self._read_index(project_name, entity_type)
+            if x.startswith(prefix) and fnmatch.fnmatchcase(x, uri_pattern)
+        ]
+
+    def _read_index(self, project_name, entity_type):
+        index_filepath = os.path.join(self._get_project_filepath(project_name), entity_type, INDEX_FILENAME)
+        try:
+            with open(index_filepath, "r", encoding="utf-8") as read_file:
+                return list(dict.fromkeys(read_file.read().splitlines()))
+        except FileNotFoundError:
+            return []
+
+    def _add_to_index(self, project_name, entity_type, uri):
+        index_filepath = os.path.join(self._get_project_filepath(project_name), entity_type, INDEX_FILENAME)
+        with fu.file_lock(index_filepath):
+            with open(index_filepath, "a", encoding="utf-8") as write_file:
+                write_file.write(uri + "\n")
+                write_file.flush()
+                os.fsync(write_file.fileno())
+
+    def get_last_version(self, project_name, resource_uri):
+        # the resource record caches the last version number, it is checked against the next version file
+        # so a publish which could not update the counter is still seen
+        resource_filepath = self._get_json_filepath(project_name, "Resource", resource_uri)
+        last_version = None
+        if os.path.exists(resource_filepath):
+            with open(resource_filepath, "r") as read_file:
+                last_version = json.load(read_file).get("last_version")
+        if last_version is None:
+            return PulseDatabase.get_last_version(self, project_name, resource_uri)
+        while os.path.exists(self._get_json_filepath(
+                project_name, "PublishedVersion", resource_uri + "@" + str(last_version + 1))):
+            last_version += 1
+        return last_version
 
     def get_user_name(self):
         return os.environ.get('USERNAME')
@@ -70,35 +215,113 @@ class Database(PulseDatabase):
         if os.path.exists(json_filepath):
             raise PulseDatabaseError("node already exists:" + uri)
 
-        json_folder = os.path.dirname(json_filepath)
-        if not os.path.exists(json_folder):
-            os.makedirs(json_folder)
-
-        with open(json_filepath, "w") as write_file:
-            json.dump(data, write_file, indent=4, sort_keys=True)
+        # the check is done again under the lock, two processes could create the same node
+        with fu.file_lock(_directory_lock_filepath(json_filepath)):
+            if os.path.exists(json_filepath):
+                raise PulseDatabaseError("node already exists:" + uri)
+            fu.write_data(json_filepath, data)
+            if self.get_project_layout(project_name) == SHARDED_LAYOUT:
+                self._add_to_index(project_name, entity_type, uri)
 
     def update(self, project_name, entity_type, uri, data_dict):
         json_filepath = self._get_json_filepath(project_name, entity_type, uri)
         if not os.path.exists(json_filepath):
             raise PulseDatabaseMissingObject(uri)
 
-        with open(json_filepath, "r") as read_file:
-            data = json.load(read_file)
-        for k in data_dict:
-            data[k] = data_dict[k]
-        with open(json_filepath, "w") as write_file:
-            json.dump(data, write_file, indent=4, sort_keys=True)
+        # the file is read and written back under its lock, a concurrent update can't be lost
+        with fu.file_lock(_directory_lock_filepath(json_filepath)):
+            data = fu.read_data(json_filepath)
+            for k in data_dict:
+                data[k] = data_dict[k]
+            fu.write_data(json_filepath, data)
 
-    def read(self, project_name, entity_type, uri):
+    def compare_and_set(self, project_name, entity_type, uri, expected, data_dict):
+        json_filepath = self._get_json_filepath(project_name, entity_type, uri)
+        if not os.path.exists(json_filepath):
+            raise PulseDatabaseMissingObject(uri)
+
+        with fu.file_lock(_directory_lock_filepath(json_filepath)):
+            data = fu.read_data(json_filepath)
+            if any(data.get(k) != v for k, v in expected.items()):
+                return False
+            for k in data_dict:
+                data[k] = data_dict[k]
+            fu.write_data(json_filepath, data)
+        return True
+
+    def try_lock(self, project_name, resource_uri, user):
+        json_filepath = self._get_json_filepath(project_name, "Resource", resource_uri)
+        if not os.path.exists(json_filepath):
+            raise PulseDatabaseMissingObject(resource_uri)
+
+        with fu.file_lock(_directory_lock_filepath(json_filepath)):
+            data = fu.read_data(json_filepath)
+            if data["lock_state"] and data["lock_user"] != user:
+                return False
+            data["lock_state"] = True
+            data["lock_user"] = user
+            fu.write_data(json_filepath, data)
+        return True
+
+    def read_many(self, project_name, entity_type, uris, fields=None):
+        objects = {}
+        for uri in uris:
+            json_filepath = self._get_json_filepath(project_name, entity_type, uri)
+            try:
+                with open(json_filepath, "r") as read_file:
+                    objects[uri] = json.load(read_file)
+            except FileNotFoundError:
+                continue
+        return select_fields(objects, fields)
+
+    def list_objects(self, project_name, entity_type, uri_pattern="*", fields=None):
+        if self.get_project_layout(project_name) == SHARDED_LAYOUT:
+            return self.read_many(project_name, entity_type, self.find_uris(project_name, entity_type, uri_pattern),
+                                  fields)
+        # read the files found by a single directory scan, without checking them again one by one
+        objects = {}
+        for path in glob.glob(self._get_json_filepath(project_name, entity_type, uri_pattern)):
+            uri = (os.path.splitext(os.path.basename(path))[0]).replace("%", ":")
+            with open(path, "r") as read_file:
+                objects[uri] = json.load(read_file)
+        return select_fields(objects, fields)
+
+    def read(self, project_name, entity_type, uri, fields=None):
         json_filepath = self._get_json_filepath(project_name, entity_type, uri)
         if not os.path.exists(json_filepath):
             raise PulseDatabaseMissingObject("no data for : " + project_name + ", " + entity_type + ", " + uri)
         with open(json_filepath, "r") as read_file:
             data = json.load(read_file)
-        return data
+        return select_fields({uri: data}, fields)[uri]
 
     def _get_project_filepath(self, project_name):
         return os.path.join(self._projects_path, project_name)
 
     def _get_json_filepath(self, project_name, entity_type, uri):
+        if self.get_project_layout(project_name) == SHARDED_LAYOUT:
+            return self._get_sharded_filepath(project_name, entity_type, uri)
         return os.path.join(self._get_project_filepath(project_name), entity_type,  uri.replace(":", "%") + ".json")
+
+    def _get_sharded_filepath(self, project_name, entity_type, uri):
+        # the published versions of a resource share its directory, named after the resource
+        if entity_type == "PublishedVersion" and "@" in uri:
+            resource_uri, _, version = uri.rpartition("@")
+            return os.path.join(
+                self._get_project_filepath(project_name),
+                entity_type,
+                _fan_out(resource_uri),
+                resource_uri.replace(":", "%"),
+                version + ".json"
+            )
+        return os.path.join(
+            self._get_project_filepath(project_name), entity_type, _fan_out(uri), uri.replace(":", "%") + ".json")
+
+
+def _directory_lock_filepath(json_filepath):
+    """return the file to lock to write an object, the objects of a directory share their lock"""
+    return os.path.join(os.path.dirname(json_filepath), DIRECTORY_LOCK_NAME)
+
+
+def _fan_out(name):
+    """return the fan-out directory of an object, from its name hash"""
+    return hashlib.md5(name.encode("utf-8")).hexdigest()[:FAN_OUT_LENGTH]
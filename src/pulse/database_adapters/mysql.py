@@ -1,38 +1,273 @@
 import json
-from pulse.database_adapters.interface_class import *
+import fnmatch
+import queue
+import threading
+import time
+from collections import OrderedDict
+from pulse.database_adapter_interface import *
+import pulse.manifest as manifest
 import mysql.connector as mariadb
+from mysql.connector import errorcode
+from mysql.connector.constants import ClientFlag
 # This adapter has been checked with mariadb 5
 
+DEFAULT_POOL_SIZE = 8
+POOL_TIMEOUT = 60
+# an idle session is pinged before being reused, the server may have closed it (wait_timeout)
+IDLE_PING_DELAY = 60
+# prepared cursors kept open by each session, the least recently used are closed beyond. The statements embed the
+# project name, the server limits the prepared statements count (max_prepared_stmt_count)
+MAX_PREPARED_CURSORS = 64
+SQL_VARIABLES_CHUNK = 500
+# schema versions of the projects, the projects written by the first one have no uri columns, see upgrade_project
+ADAPTER_VERSION = "0.0.2"
+UNSTRUCTURED_ADAPTER_VERSION = "0.0.1"
+# columns holding the uris parts, with the composite index used by find_uris. Resources already store their parts
+URI_COLUMNS = {
+    "PublishedVersion": ["entity VARCHAR(255)", "resource_type VARCHAR(255)"],
+    "Resource": []
+}
+URI_INDEXES = {
+    "PublishedVersion": ["entity", "resource_type", "version"],
+    "Resource": ["entity", "resource_type"]
+}
+# errors meaning the connection is lost, an idempotent statement is replayed once on a new connection
+CONNECTION_LOST_ERRORS = (
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.CR_CONNECTION_ERROR
+)
+# errors raised before the statement is sent to the server, any statement can be replayed after them. Once sent, a
+# statement may have been applied by the server before the connection was lost
+UNSENT_ERRORS = (errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_CONN_HOST_ERROR, errorcode.CR_CONNECTION_ERROR)
+
+
+class _Session:
+    """
+    a server connection owned by the pool, keeping its cursors open between statements.
+    The recently used statements keep their own prepared cursor, so they are not parsed again by the server
+    """
+    def __init__(self, connect):
+        self._connect = connect
+        self.connection = connect()
+        self._cursors = OrderedDict()
+        self.last_use = time.time()
+
+    def cursor(self, statement=None):
+        """return the prepared cursor of a statement, or the session plain cursor if no statement is given"""
+        cursor = self._cursors.get(statement)
+        if cursor is not None:
+            self._cursors.move_to_end(statement)
+            return cursor
+        cursor = self.connection.cursor(prepared=statement is not None)
+        self._cursors[statement] = cursor
+        if len(self._cursors) > MAX_PREPARED_CURSORS:
+            # closing the cursor releases its statement on the server
+            try:
+                self._cursors.popitem(last=False)[1].close()
+            except mariadb.Error:
+                pass
+        return cursor
+
+    def check(self):
+        """reconnect the session if it has been idle long enough to be closed by the server"""
+        if time.time() - self.last_use > IDLE_PING_DELAY:
+            try:
+                self.connection.ping(reconnect=False)
+            except mariadb.Error:
+                self.reconnect()
+
+    def reconnect(self):
+        self.close()
+        self.connection = self._connect()
+
+    def close(self):
+        # prepared statements are released with the connection
+        self._cursors = OrderedDict()
+        try:
+            self.connection.close()
+        except mariadb.Error:
+            pass
+
 
 class Database(PulseDatabase):
+    """
+    mysql or mariadb server database. Each project is a mysql database, the repositories and the projects list are
+    stored in a config database.
+
+    Statements are run through a pool of connections, so the adapter can be shared between threads. The pool size
+    can be set with the "pool_size" setting. An idempotent statement interrupted by a lost connection is replayed once
+    on a new connection. The other statements first check if the server has applied them.
+
+    The uris parts are stored in their own indexed columns : find_uris translates glob patterns to conditions on them,
+    and sorts versions by number.
+    """
+    adapter_version = ADAPTER_VERSION
+
     def __init__(self, path="", username="", password="", settings=None):
-        PulseDatabase.__init__(self, path, username, password, settings)
-        self.connection = None
+        PulseDatabase.__init__(self, path, username, password, settings or {})
         self.config_name = "_Pulse_config"
-        self.cursor = None
-        self.update_connection()
-
-    def update_connection(self):
-        self.connection = mariadb.connect(
-            host=self.path,
-            port=self.settings['port'],
-            user=self.username,
-            password=self.password
-        )
-        self.cursor = self.connection.cursor()
-        # set config db if does not exists yet
+        # schema versions of the projects already read, by project name
+        self._project_versions = {}
+        self._pool_size = int(self.settings.get("pool_size", DEFAULT_POOL_SIZE))
+        self._sessions = queue.LifoQueue()
+        self._sessions_count = 0
+        self._pool_lock = threading.Lock()
+        self._initialize_config()
+
+    def _connect(self):
+        try:
+            return mariadb.connect(
+                host=self.path,
+                port=self.settings.get('port', 3306),
+                user=self.username,
+                password=self.password,
+                autocommit=True,
+                # an update counts the matched rows, even if their values don't change
+                client_flags=[ClientFlag.FOUND_ROWS]
+            )
+        except mariadb.Error as ex:
+            raise PulseDatabaseError("can't connect to mysql server " + self.path + " : " + str(ex))
+
+    def _acquire(self):
         try:
-            self.cursor.execute("USE " + self.config_name)
-        except mariadb.errors.DatabaseError:
-            self.cursor.execute("CREATE DATABASE " + self.config_name)
-            self.cursor.execute("USE " + self.config_name)
-            for table in self.config_tables:
-                cmd = "CREATE TABLE " + table + " (name VARCHAR(255) PRIMARY KEY"
-                for field in self.config_tables[table]:
-                    cmd += ", " + field
-                cmd += ")"
-                self.cursor.execute(cmd)
-            self.connection.publish()
+            session = self._sessions.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._sessions_count < self._pool_size
+                if can_open:
+                    self._sessions_count += 1
+            if can_open:
+                try:
+                    return _Session(self._connect)
+                except PulseDatabaseError:
+                    with self._pool_lock:
+                        self._sessions_count -= 1
+                    raise
+            try:
+                session = self._sessions.get(timeout=POOL_TIMEOUT)
+            except queue.Empty:
+                raise PulseDatabaseError("no mysql connection available after " + str(POOL_TIMEOUT) + "s")
+        try:
+            session.check()
+        except PulseDatabaseError:
+            self._discard(session)
+            raise
+        return session
+
+    def _release(self, session):
+        session.last_use = time.time()
+        self._sessions.put(session)
+
+    def _discard(self, session):
+        session.close()
+        with self._pool_lock:
+            self._sessions_count -= 1
+
+    def _run(self, operation, idempotent=True, recover=None):
+        """
+        call the operation with a pooled session, and return its result.
+        If the connection is lost, the session reconnects and the operation is called again, once. An operation which
+        is not idempotent is only called again if its statement has not been sent. Otherwise, recover is called
+        instead, with the new session and the operation : it finds out if the server has applied the statement, and
+        returns the operation result. A PulseDatabaseError is raised if there's no recover function
+
+        :param idempotent: False if the operation changes the data again when it's called twice
+        :param recover: function called with the new session and the operation, when a statement which is not
+         idempotent may have been applied
+        """
+        session = self._acquire()
+        try:
+            try:
+                result = operation(session)
+            except (mariadb.OperationalError, mariadb.InterfaceError) as ex:
+                if ex.errno not in CONNECTION_LOST_ERRORS:
+                    raise
+                session.reconnect()
+                if idempotent or ex.errno in UNSENT_ERRORS:
+                    result = operation(session)
+                elif recover:
+                    result = recover(session, operation)
+                else:
+                    raise PulseDatabaseError("connection lost, the statement may have been applied : " + str(ex))
+        except (mariadb.OperationalError, mariadb.InterfaceError):
+            self._discard(session)
+            raise
+        except (mariadb.Error, PulseDatabaseError):
+            # the statement has been refused, or its result is unknown, the session is still usable
+            self._release(session)
+            raise
+        except BaseException:
+            # the session state is unknown, don't give it back to the pool
+            self._discard(session)
+            raise
+        self._release(session)
+        return result
+
+    def _execute(self, cmd, parameters=(), prepared=True, idempotent=True, recover=None):
+        """run a statement and return its rows as dictionaries, see _run for the idempotent and recover arguments"""
+        def operation(session):
+            return _fetch(session.cursor(cmd if prepared else None), cmd, parameters)
+        return self._run(operation, idempotent, recover)
+
+    def _execute_update(self, cmd, parameters=(), idempotent=True, recover=None):
+        """run a statement and return the number of rows it matched"""
+        def operation(session):
+            cursor = session.cursor(cmd)
+            cursor.execute(cmd, parameters)
+            return cursor.rowcount
+        return self._run(operation, idempotent, recover)
+
+    def _execute_many(self, commands, idempotent=True):
+        """run several statements on the same connection, for the statements depending on each other"""
+        def operation(session):
+            cursor = session.cursor()
+            for cmd in commands:
+                cursor.execute(cmd)
+        return self._run(operation, idempotent)
+
+    def _holds(self, session, project_name, entity_type, uri, data):
+        """
+        read an object row with a session, to find out if a statement writing it has been applied
+
+        :param data: encoded values, by column
+        :return: None if the object doesn't exist, else True if its columns hold the data values
+        """
+        cmd = "SELECT " + ", ".join([_quote(k) for k in data]) + " FROM " + self._table(project_name, entity_type) \
+              + " WHERE " + self._key(project_name) + " = %s"
+        rows = _fetch(session.cursor(), cmd, (uri,))
+        if not rows:
+            return None
+        return all(rows[0][k] == v for k, v in data.items())
+
+    def _table(self, project_name, entity_type):
+        """return the fully qualified name of a table, so no statement depends on the current database"""
+        if project_name in ("_Config", self.config_name):
+            project_name = self.config_name
+        return _quote(project_name) + "." + _quote(entity_type)
+
+    def _key(self, project_name):
+        return "name" if project_name in ("_Config", self.config_name) else "uri"
+
+    def _initialize_config(self):
+        commands = ["CREATE DATABASE IF NOT EXISTS " + _quote(self.config_name)]
+        for table in self.config_tables:
+            commands.append(
+                "CREATE TABLE IF NOT EXISTS " + self._table(self.config_name, table)
+                + " (name VARCHAR(255) PRIMARY KEY, " + ", ".join(self.config_tables[table]) + ")"
+            )
+        self._execute_many(commands)
+
+    def close(self):
+        """close all the pooled connections, the adapter will open new ones if it's used again"""
+        while True:
+            try:
+                session = self._sessions.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(session)
 
     def create_repository(self, name, adapter, login, password, settings):
         data = {
@@ -40,133 +275,374 @@ class Database(PulseDatabase):
             "adapter": adapter,
             "login": login,
             "password": password,
-            "settings": json.dumps(settings)
+            "settings": settings
         }
-        self.cursor.execute("USE " + self.config_name)
-        placeholders = ', '.join(['%s'] * len(data))
-        columns = ', '.join(data.keys())
-        cmd = "INSERT INTO %s ( %s ) VALUES ( %s )" % ("Repository", columns, placeholders)
         try:
-            self.cursor.execute(cmd, list(data.values()))
+            self._insert(self.config_name, "Repository", data)
         except mariadb.IntegrityError:
             raise PulseDatabaseError("node already exists:" + name)
-        self.connection.publish()
 
     def get_repositories(self):
-        self.cursor.execute("USE " + self.config_name)
-        self.cursor.execute("SELECT * FROM Repository")
-        table = [self.cursor.fetchall()][0]
         repositories_dict = {}
-        for row in table:
-            repositories_dict[row[0]] = {}
-            repositories_dict[row[0]]["adapter"] = row[1]
-            repositories_dict[row[0]]["login"] = row[2]
-            repositories_dict[row[0]]["password"] = row[3]
-            repositories_dict[row[0]]["settings"] = json.loads(row[4])
+        for row in self._execute("SELECT * FROM " + self._table(self.config_name, "Repository")):
+            repositories_dict[row["name"]] = {
+                "adapter": row["adapter"],
+                "login": row["login"],
+                "password": row["password"],
+                "settings": json.loads(row["settings"])
+            }
         return repositories_dict
 
     def get_projects(self):
-        self.cursor.execute("USE " + self.config_name)
-        self.cursor.execute("SELECT * FROM Project")
-        table = [self.cursor.fetchall()][0]
-        projects = []
-        for row in table:
-            projects.append(row[0])
-        return projects
+        return [row["name"] for row in self._execute("SELECT name FROM " + self._table(self.config_name, "Project"))]
 
     def create_project(self, project_name):
         if project_name == self.config_name:
             raise PulseDatabaseError("project name reserved by config : " + project_name)
-        # test if the projects table exists
+        commands = [
+            "CREATE DATABASE " + _quote(project_name),
+            # save the adapter version
+            "CREATE TABLE " + self._table(project_name, "version") + " (number VARCHAR(255) NOT NULL)",
+            "INSERT INTO " + self._table(project_name, "version") + " (number) VALUES ('" + self.adapter_version + "')"
+        ]
+        for table in self.project_tables:
+            columns = self.project_tables[table] + URI_COLUMNS.get(table, [])
+            if table in URI_INDEXES:
+                columns = columns + ["INDEX uri_parts (" + ", ".join(URI_INDEXES[table]) + ")"]
+            commands.append(
+                "CREATE TABLE " + self._table(project_name, table)
+                + " (uri VARCHAR(255) PRIMARY KEY, " + ", ".join(columns) + ")"
+            )
         try:
-            self.cursor.execute("CREATE DATABASE " + project_name)
-        except mariadb.errors.DatabaseError as ex:
+            self._execute_many(commands, idempotent=False)
+        except mariadb.DatabaseError as ex:
             raise PulseDatabaseError("project creation failed" + str(ex))
+        self._project_versions[project_name] = self.adapter_version
+        # register project to config table
+        self._insert(self.config_name, "Project", {"name": project_name, "created_by": self.username})
 
-        self.cursor.execute("USE " + project_name)
+    def delete_project(self, project_name):
+        self._execute_many(["DROP DATABASE IF EXISTS " + _quote(project_name)])
+        self._execute(
+            "DELETE FROM " + self._table(self.config_name, "Project") + " WHERE name = %s", (project_name,))
+        self._project_versions.pop(project_name, None)
 
-        # save the adapter version
-        cmd = "CREATE TABLE version (number VARCHAR(255) NOT NULL)"
-        self.cursor.execute(cmd)
-        self.cursor.execute("INSERT into version (number) VALUE ('" + self.adapter_version + "')")
-        self.connection.publish()
-        for table in self.project_tables:
-            # id int(11) NOT NULL AUTO_INCREMENT,
-            cmd = "CREATE TABLE " + table + " (uri VARCHAR(255) PRIMARY KEY"
-            for field in self.project_tables[table]:
-                cmd += ", " + field
-            cmd += ")"
-            self.cursor.execute(cmd)
+    def _is_structured(self, project_name):
+        """return True if the project tables have the uri columns"""
+        if project_name not in self._project_versions:
+            try:
+                rows = self._execute("SELECT number FROM " + self._table(project_name, "version"))
+            except mariadb.ProgrammingError:
+                raise PulseDatabaseMissingObject("missing project :" + project_name)
+            self._project_versions[project_name] = rows[0]["number"] if rows else UNSTRUCTURED_ADAPTER_VERSION
+        return self._project_versions[project_name] != UNSTRUCTURED_ADAPTER_VERSION
 
-        # register project to config table
-        data = {
-            "name": project_name,
-            "created_by": self.username
-        }
+    def upgrade_project(self, project_name):
+        """
+        add the uri columns and their indexes to a project created by a previous adapter version, and fill them.
+        No client should write to the project during the upgrade. Until then, find_uris matches the uri column only.
 
-        self.cursor.execute("USE " + self.config_name)
-        placeholders = ', '.join(['%s'] * len(data))
-        columns = ', '.join(data.keys())
-        cmd = "INSERT INTO %s ( %s ) VALUES ( %s )" % ("Project", columns, placeholders)
-        self.cursor.execute(cmd, list(data.values()))
-        self.connection.publish()
+        :return: True if the project has been upgraded, False if it was already up to date
+        """
+        if self._is_structured(project_name):
+            return False
+        commands = []
+        for table in URI_INDEXES:
+            table_name = self._table(project_name, table)
+            for column in URI_COLUMNS[table]:
+                commands.append("ALTER TABLE " + table_name + " ADD COLUMN " + column)
+            # the resource uri is "entity-resource_type", followed by "@version" for the published versions.
+            # The parts are split at the first "-", as by _split_resource_uri
+            resource_uri = "SUBSTRING_INDEX(uri, '@', 1)"
+            commands.append(
+                "UPDATE " + table_name + " SET entity = SUBSTRING_INDEX(" + resource_uri + ", '-', 1), "
+                "resource_type = SUBSTRING(" + resource_uri + ", LOCATE('-', " + resource_uri + ") + 1) "
+                "WHERE entity IS NULL OR resource_type IS NULL"
+            )
+            commands.append(
+                "ALTER TABLE " + table_name + " ADD INDEX uri_parts (" + ", ".join(URI_INDEXES[table]) + ")")
+        commands.append(
+            "UPDATE " + self._table(project_name, "version") + " SET number = '" + self.adapter_version + "'")
+        self._execute_many(commands, idempotent=False)
+        self._project_versions[project_name] = self.adapter_version
+        return True
 
-    def delete_project(self, project_name):
-        self.cursor.execute("DROP DATABASE IF EXISTS " + project_name)
+    def _uri_condition(self, project_name, entity_type, uri_pattern):
+        """
+        translate a glob pattern to a where clause, as a (clause, parameters) tuple.
+        The resources and published versions patterns are split in conditions on the uri parts columns, the other
+        patterns give a LIKE condition. The LIKE conditions can't express the glob character sets, their results
+        have to be filtered again with match_uris
+        """
+        if entity_type in URI_INDEXES and self._is_structured(project_name) and "[" not in uri_pattern:
+            resource_pattern, separator, version_pattern = uri_pattern.partition("@")
+            if entity_type == "Resource" and separator:
+                return "FALSE", []
+            if "-" in resource_pattern and (separator or entity_type == "Resource") and "@" not in version_pattern:
+                entity_pattern, resource_type_pattern = _split_resource_uri(resource_pattern)
+                conditions = []
+                parameters = []
+                if _has_wildcards(entity_pattern):
+                    # a wildcard can match the first "-" of a uri, as "*-mdl" matches "a-b-mdl" : the resource uri
+                    # is matched as a whole
+                    conditions.append("uri LIKE %s")
+                    parameters.append(_glob_to_like(resource_pattern) + ("@%" if separator else ""))
+                else:
+                    conditions.append("entity = %s")
+                    parameters.append(entity_pattern)
+                    if not _has_wildcards(resource_type_pattern):
+                        conditions.append("resource_type = %s")
+                        parameters.append(resource_type_pattern)
+                    elif resource_type_pattern != "*":
+                        conditions.append("resource_type LIKE %s")
+                        parameters.append(_glob_to_like(resource_type_pattern))
+                if version_pattern.isdigit() and str(int(version_pattern)) == version_pattern:
+                    conditions.append("version = %s")
+                    parameters.append(int(version_pattern))
+                elif version_pattern not in ("", "*"):
+                    conditions.append("uri LIKE %s")
+                    parameters.append(_glob_to_like(uri_pattern))
+                return " AND ".join(conditions) or "TRUE", parameters
+        if not _has_wildcards(uri_pattern):
+            return "uri = %s", [uri_pattern]
+        return "uri LIKE %s", [_glob_to_like(uri_pattern)]
+
+    def _order(self, project_name, entity_type):
+        """return the order clause sorting an entity type objects by resource uri and version number"""
+        if entity_type == "PublishedVersion":
+            if self._is_structured(project_name):
+                return " ORDER BY " + ", ".join(URI_INDEXES[entity_type])
+            return " ORDER BY SUBSTRING_INDEX(uri, '@', 1), version"
+        return " ORDER BY uri"
 
     def find_uris(self, project_name, entity_type, uri_pattern):
-        self.cursor.execute("USE " + project_name)
-        param = '{}%'.format(uri_pattern.replace("*", "%").replace("_", "\\_").replace("?", "_"))
-        cmd = "SELECT uri FROM " + entity_type + " WHERE uri LIKE %s"
-        self.cursor.execute(cmd, (param,))
-        return [x[0] for x in self.cursor.fetchall()]
+        condition, parameters = self._uri_condition(project_name, entity_type, uri_pattern)
+        cmd = "SELECT uri FROM " + self._table(project_name, entity_type) + " WHERE " + condition \
+              + self._order(project_name, entity_type)
+        return match_uris([row["uri"] for row in self._execute(cmd, parameters)], uri_pattern)
+
+    def get_last_version(self, project_name, resource_uri):
+        if self._is_structured(project_name) and "-" in resource_uri and not _has_wildcards(resource_uri):
+            entity, resource_type = _split_resource_uri(resource_uri)
+            cmd = "SELECT MAX(version) AS version FROM " + self._table(project_name, "PublishedVersion") \
+                  + " WHERE entity = %s AND resource_type = %s"
+            rows = self._execute(cmd, (entity, resource_type))
+        else:
+            param = _glob_to_like(resource_uri) + "@%"
+            rows = self._execute(
+                "SELECT MAX(version) AS version FROM " + self._table(project_name, "PublishedVersion")
+                + " WHERE uri LIKE %s",
+                (param,)
+            )
+        return rows[0]["version"] or 0
 
     def get_user_name(self):
         return self.username
 
-    def create(self, project_name, entity_type, uri, data):
-        self.cursor.execute("USE " + project_name)
+    def _insert(self, project_name, entity_type, data):
+        data = _encode_row(data)
+        cmd = "INSERT INTO %s ( %s ) VALUES ( %s )" % (
+            self._table(project_name, entity_type),
+            ', '.join([_quote(k) for k in data]),
+            ', '.join(['%s'] * len(data))
+        )
+        uri = data[self._key(project_name)]
 
-        for k in data:
-            if isinstance(data[k], dict) or isinstance(data[k], list):
-                data[k] = json.dumps(data[k])
+        def recover(session, operation):
+            # the row can have been inserted before the connection was lost
+            inserted = self._holds(session, project_name, entity_type, uri, data)
+            if inserted is None:
+                return operation(session)
+            if not inserted:
+                raise mariadb.IntegrityError(msg="duplicate entry : " + uri)
+            return []
+        self._execute(cmd, list(data.values()), idempotent=False, recover=recover)
 
-        data['uri'] = uri
-        placeholders = ', '.join(['%s'] * len(data))
-        columns = ', '.join(data.keys())
-        cmd = "INSERT INTO %s ( %s ) VALUES ( %s )" % (entity_type, columns, placeholders)
+    def create(self, project_name, entity_type, uri, data):
+        data = dict(data)
+        data[self._key(project_name)] = uri
+        if project_name != self.config_name and entity_type in URI_INDEXES and self._is_structured(project_name):
+            data.update(_uri_parts(uri, data))
         try:
-            self.cursor.execute(cmd, list(data.values()))
+            self._insert(project_name, entity_type, data)
         except mariadb.IntegrityError:
             raise PulseDatabaseError("node already exists:" + uri)
-        self.connection.publish()
 
     def update(self, project_name, entity_type, uri, data):
-        self.cursor.execute("USE " + project_name)
-        for k in data:
-            if isinstance(data[k], dict) or isinstance(data[k], list):
-                data[k] = json.dumps(data[k])
+        data = _encode_row(data)
+        cmd = 'UPDATE ' + self._table(project_name, entity_type) + ' SET {}'.format(
+            ', '.join('{}=%s'.format(_quote(k)) for k in data))
+        cmd += " WHERE " + self._key(project_name) + " = %s"
+        self._execute(cmd, list(data.values()) + [uri])
+
+    def compare_and_set(self, project_name, entity_type, uri, expected, data_dict):
+        # the condition is checked by the server in the update statement, it can't interleave with another client
+        data = _encode_row(data_dict)
+        expected = _encode_row(expected)
+        cmd = 'UPDATE ' + self._table(project_name, entity_type) + ' SET {}'.format(
+            ', '.join('{}=%s'.format(_quote(k)) for k in data))
+        cmd += " WHERE " + self._key(project_name) + " = %s"
+        cmd += "".join(" AND {} <=> %s".format(_quote(k)) for k in expected)
 
-        cmd = 'UPDATE ' + entity_type + ' SET {}'.format(', '.join('{}=%s'.format(k) for k in data))
-        cmd += " WHERE uri = '" + uri + "'"
-        self.cursor.execute(cmd, list(data.values()))
-        self.connection.publish()
+        def recover(session, operation):
+            # the update can have been applied before the connection was lost, it wouldn't match anymore
+            if self._holds(session, project_name, entity_type, uri, data):
+                return 1
+            return operation(session)
+        if self._execute_update(
+                cmd, list(data.values()) + [uri] + list(expected.values()), idempotent=False, recover=recover):
+            return True
+        # nothing matched, tell a missing object from a changed one
+        self.read(project_name, entity_type, uri)
+        return False
 
-    def read(self, project_name, entity_type, uri):
-        self.connection.publish()
-        cursor = self.connection.cursor(dictionary=True)
+    def try_lock(self, project_name, resource_uri, user):
+        cmd = "UPDATE " + self._table(project_name, "Resource") \
+              + " SET lock_state = 1, lock_user = %s WHERE uri = %s AND (lock_state = 0 OR lock_user = %s)"
+        if self._execute_update(cmd, (user, resource_uri, user)):
+            return True
+        self.read(project_name, "Resource", resource_uri)
+        return False
+
+    def read(self, project_name, entity_type, uri, fields=None):
         try:
-            cursor.execute("USE " + project_name)
+            rows = self._execute(
+                "SELECT " + _columns(fields) + " FROM " + self._table(project_name, entity_type) + " WHERE uri = %s",
+                (uri,)
+            )
         except mariadb.ProgrammingError:
             raise PulseDatabaseMissingObject("missing project :" + project_name)
-
-        cursor.execute("SELECT * FROM " + entity_type + " WHERE uri = '" + uri + "'")
-        data = cursor.fetchone()
-        if not data:
+        if not rows:
             raise PulseDatabaseMissingObject("no data for : " + project_name + ", " + entity_type + ", " + uri)
+        return select_fields({uri: self._decode_row(entity_type, rows[0])}, fields)[uri]
 
+    def _decode_row(self, entity_type, data):
+        # the uri parts columns are only used to find objects, they are not objects attributes
+        for column in URI_COLUMNS.get(entity_type, []):
+            data.pop(column.split(" ")[0], None)
         for k in data:
             for attr in self.project_tables[entity_type]:
-                if attr == k + " LONGTEXT":
+                # the commits files manifests are stored as they are encoded, they are not json
+                if attr == k + " LONGTEXT" and data[k] is not None and not manifest.is_encoded(data[k]):
                     data[k] = json.loads(data[k])
         return data
+
+    def read_many(self, project_name, entity_type, uris, fields=None):
+        uris = list(uris)
+        objects = {}
+        for index in range(0, len(uris), SQL_VARIABLES_CHUNK):
+            chunk = uris[index:index + SQL_VARIABLES_CHUNK]
+            cmd = "SELECT " + _columns(fields) + " FROM " + self._table(project_name, entity_type) \
+                  + " WHERE uri IN (" + ", ".join(["%s"] * len(chunk)) + ")"
+            # the statement changes with the chunk length, it's not worth preparing it
+            for row in self._execute(cmd, chunk, prepared=False):
+                objects[row["uri"]] = self._decode_row(entity_type, row)
+        return select_fields(objects, fields)
+
+    def list_objects(self, project_name, entity_type, uri_pattern="*", fields=None):
+        condition, parameters = self._uri_condition(project_name, entity_type, uri_pattern)
+        rows = self._execute(
+            "SELECT " + _columns(fields) + " FROM " + self._table(project_name, entity_type) + " WHERE " + condition
+            + self._order(project_name, entity_type),
+            parameters,
+            prepared=fields is None
+        )
+        uris = set(match_uris([row["uri"] for row in rows], uri_pattern))
+        objects = {row["uri"]: self._decode_row(entity_type, row) for row in rows if row["uri"] in uris}
+        return select_fields(objects, fields)
+
+
+def _quote(name):
+    """quote a database, table or column name"""
+    return "`" + name.replace("`", "``") + "`"
+
+
+def _columns(fields):
+    """return the columns to select for some fields, the uri column is always selected"""
+    if fields is None:
+        return "*"
+    return ", ".join([_quote(k) for k in ["uri"] + [x for x in fields if x != "uri"]])
+
+
+def _has_wildcards(pattern):
+    return any(x in pattern for x in "*?[")
+
+
+def _glob_to_like(pattern):
+    """
+    translate a glob pattern to a LIKE pattern. A glob characters set matches any character, the LIKE results have
+    to be filtered with match_uris
+    """
+    like = ""
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        index += 1
+        if character == "*":
+            like += "%"
+        elif character == "?":
+            like += "_"
+        elif character == "[" and _set_end(pattern, index) != -1:
+            index = _set_end(pattern, index) + 1
+            like += "_"
+        elif character in "%_\\":
+            like += "\\" + character
+        else:
+            like += character
+    return like
+
+
+def _set_end(pattern, index):
+    """return the index of the "]" closing a glob characters set starting at index, -1 if it's not closed"""
+    # as for fnmatch, a set can be negated by "!", and a "]" starting it is a member of the set
+    if index < len(pattern) and pattern[index] == "!":
+        index += 1
+    if index < len(pattern) and pattern[index] == "]":
+        index += 1
+    return pattern.find("]", index)
+
+
+def match_uris(uris, uri_pattern):
+    """
+    keep the uris matching a glob pattern, in their order. The server comparisons ignore the case, glob doesn't
+    """
+    return [x for x in uris if fnmatch.fnmatchcase(x, uri_pattern)]
+
+
+def _split_resource_uri(resource_uri):
+    """
+    return the entity and the resource type of a resource uri, or of a pattern. The resource type is everything after
+    the first "-", the uri parts columns sort as the uris then
+    """
+    entity, _, resource_type = resource_uri.partition("-")
+    return entity, resource_type
+
+
+def _uri_parts(uri, data):
+    """return the uri parts columns of a resource or a published version, the data values come first"""
+    resource_uri, _, version = uri.partition("@")
+    entity, resource_type = _split_resource_uri(resource_uri)
+    parts = {"entity": data.get("entity", entity), "resource_type": data.get("resource_type", resource_type)}
+    if version.isdigit() and "version" not in data:
+        parts["version"] = int(version)
+    return parts
+
+
+def _fetch(cursor, cmd, parameters):
+    """run a statement with a cursor and return its rows as dictionaries"""
+    cursor.execute(cmd, parameters)
+    if not cursor.description:
+        return []
+    columns = cursor.column_names
+    return [dict(zip(columns, [_decode_value(value) for value in row])) for row in cursor.fetchall()]
+
+
+def _encode_row(data):
+    return {k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in data.items()}
+
+
+def _decode_value(value):
+    # prepared cursors return text columns as bytes
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8")
+    return value
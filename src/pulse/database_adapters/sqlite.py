@@ -0,0 +1,245 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pulse.database_adapter_interface import *
+
+DATABASE_FILENAME = "pulse.sqlite"
+SQL_VARIABLES_CHUNK = 500
+
+
+class Database(PulseDatabase):
+    """
+    single file database, for a workstation or a small team sharing a reliable file system.
+
+    Every object is stored as a json document in one table, indexed by project, entity type and uri, plus the
+    resource and the version number extracted from the uri to resolve versions without scanning.
+    The path can be the database file, or a directory where a pulse.sqlite file will be created.
+    """
+    def __init__(self, path="", username="", password="", settings=None):
+        PulseDatabase.__init__(self, path, username, password, settings)
+        if os.path.isdir(self.path):
+            self._filepath = os.path.join(self.path, DATABASE_FILENAME)
+        else:
+            self._filepath = self.path
+        directory = os.path.dirname(os.path.abspath(self._filepath))
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                raise PulseDatabaseError("can't create sqlite database :" + self._filepath)
+        self.config_name = "_Config"
+        self._lock = threading.RLock()
+        # transactions are explicitly opened, the connection is shared between threads behind the lock
+        self.connection = sqlite3.connect(self._filepath, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS Project (name TEXT PRIMARY KEY, created_by TEXT)")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS Object ("
+                "project TEXT NOT NULL, "
+                "entity_type TEXT NOT NULL, "
+                "uri TEXT NOT NULL, "
+                "resource TEXT, "
+                "version INTEGER, "
+                "data TEXT, "
+                "PRIMARY KEY (project, entity_type, uri))")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS Object_resource_version ON Object (project, entity_type, resource, version)")
+
+    @contextmanager
+    def _transaction(self):
+        """
+        run statements in a write transaction. The database is locked for writing as soon as it starts,
+        so a read followed by an update can't interleave with another process
+        """
+        with self._lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def _query(self, cmd, parameters=()):
+        with self._lock:
+            return self.connection.execute(cmd, parameters).fetchall()
+
+    @staticmethod
+    def _split_uri(uri):
+        """return the resource and the version number of an uri, version is None if it's not a number"""
+        resource, _, version = uri.partition("@")
+        try:
+            return resource, int(version)
+        except ValueError:
+            return resource, None
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def create_repository(self, name, adapter, login, password, settings):
+        data = {"name": name, "adapter": adapter, "login": login, "password": password, "settings": settings}
+        try:
+            self.create(self.config_name, "Repository", name, data)
+        except PulseDatabaseError:
+            raise PulseDatabaseError("repository already exists:" + name)
+
+    def get_repositories(self):
+        rows = self._query(
+            "SELECT uri, data FROM Object WHERE project = ? AND entity_type = 'Repository'", (self.config_name,))
+        return {uri: json.loads(data) for uri, data in rows}
+
+    def get_projects(self):
+        return [row[0] for row in self._query("SELECT name FROM Project ORDER BY name")]
+
+    def create_project(self, project_name):
+        if project_name == self.config_name:
+            raise PulseDatabaseError("project name reserved by config : " + project_name)
+        try:
+            with self._transaction() as cursor:
+                cursor.execute("INSERT INTO Project (name, created_by) VALUES (?, ?)", (project_name, self.username))
+        except sqlite3.IntegrityError:
+            raise PulseDatabaseError("project already exists")
+
+    def delete_project(self, project_name):
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM Project WHERE name = ?", (project_name,))
+            if not cursor.rowcount:
+                raise PulseDatabaseMissingObject("project missing : " + project_name)
+            cursor.execute("DELETE FROM Object WHERE project = ?", (project_name,))
+
+    def find_uris(self, project_name, entity_type, uri_pattern):
+        # sqlite GLOB has the same wildcards as glob, and uses the primary key index for the pattern prefix
+        rows = self._query(
+            "SELECT uri FROM Object WHERE project = ? AND entity_type = ? AND uri GLOB ? ORDER BY resource, version",
+            (project_name, entity_type, uri_pattern)
+        )
+        return [row[0] for row in rows]
+
+    def get_last_version(self, project_name, resource_uri):
+        rows = self._query(
+            "SELECT MAX(version) FROM Object WHERE project = ? AND entity_type = 'PublishedVersion' AND resource = ?",
+            (project_name, resource_uri)
+        )
+        return rows[0][0] or 0
+
+    def get_user_name(self):
+        return os.environ.get('USERNAME')
+
+    def create(self, project_name, entity_type, uri, data):
+        resource, version = self._split_uri(uri)
+        try:
+            with self._transaction() as cursor:
+                cursor.execute(
+                    "INSERT INTO Object (project, entity_type, uri, resource, version, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    (project_name, entity_type, uri, resource, version, json.dumps(data))
+                )
+        except sqlite3.IntegrityError:
+            raise PulseDatabaseError("node already exists:" + uri)
+
+    def update(self, project_name, entity_type, uri, data_dict):
+        with self._transaction() as cursor:
+            row = cursor.execute(
+                "SELECT data FROM Object WHERE project = ? AND entity_type = ? AND uri = ?",
+                (project_name, entity_type, uri)
+            ).fetchone()
+            if not row:
+                raise PulseDatabaseMissingObject(uri)
+            data = json.loads(row[0])
+            for k in data_dict:
+                data[k] = data_dict[k]
+            cursor.execute(
+                "UPDATE Object SET data = ? WHERE project = ? AND entity_type = ? AND uri = ?",
+                (json.dumps(data), project_name, entity_type, uri)
+            )
+
+    def compare_and_set(self, project_name, entity_type, uri, expected, data_dict):
+        # the write transaction is started before the read, so no other process can change the object in between
+        with self._transaction() as cursor:
+            row = cursor.execute(
+                "SELECT data FROM Object WHERE project = ? AND entity_type = ? AND uri = ?",
+                (project_name, entity_type, uri)
+            ).fetchone()
+            if not row:
+                raise PulseDatabaseMissingObject(uri)
+            data = json.loads(row[0])
+            if any(data.get(k) != v for k, v in expected.items()):
+                return False
+            for k in data_dict:
+                data[k] = data_dict[k]
+            cursor.execute(
+                "UPDATE Object SET data = ? WHERE project = ? AND entity_type = ? AND uri = ?",
+                (json.dumps(data), project_name, entity_type, uri)
+            )
+        return True
+
+    def try_lock(self, project_name, resource_uri, user):
+        with self._transaction() as cursor:
+            row = cursor.execute(
+                "SELECT data FROM Object WHERE project = ? AND entity_type = 'Resource' AND uri = ?",
+                (project_name, resource_uri)
+            ).fetchone()
+            if not row:
+                raise PulseDatabaseMissingObject(resource_uri)
+            data = json.loads(row[0])
+            if data["lock_state"] and data["lock_user"] != user:
+                return False
+            data["lock_state"] = True
+            data["lock_user"] = user
+            cursor.execute(
+                "UPDATE Object SET data = ? WHERE project = ? AND entity_type = 'Resource' AND uri = ?",
+                (json.dumps(data), project_name, resource_uri)
+            )
+        return True
+
+    def read(self, project_name, entity_type, uri, fields=None):
+        data_column, data_parameters = _data_projection(fields)
+        rows = self._query(
+            "SELECT " + data_column + " FROM Object WHERE project = ? AND entity_type = ? AND uri = ?",
+            data_parameters + [project_name, entity_type, uri]
+        )
+        if not rows:
+            raise PulseDatabaseMissingObject("no data for : " + project_name + ", " + entity_type + ", " + uri)
+        return json.loads(rows[0][0])
+
+    def read_many(self, project_name, entity_type, uris, fields=None):
+        uris = list(uris)
+        objects = {}
+        data_column, data_parameters = _data_projection(fields)
+        # stay under the sqlite variables limit
+        for index in range(0, len(uris), SQL_VARIABLES_CHUNK):
+            chunk = uris[index:index + SQL_VARIABLES_CHUNK]
+            rows = self._query(
+                "SELECT uri, " + data_column + " FROM Object WHERE project = ? AND entity_type = ? AND uri IN ("
+                + ", ".join(["?"] * len(chunk)) + ")",
+                data_parameters + [project_name, entity_type] + chunk
+            )
+            objects.update({uri: json.loads(data) for uri, data in rows})
+        return objects
+
+    def list_objects(self, project_name, entity_type, uri_pattern="*", fields=None):
+        data_column, data_parameters = _data_projection(fields)
+        rows = self._query(
+            "SELECT uri, " + data_column + " FROM Object WHERE project = ? AND entity_type = ? AND uri GLOB ? "
+            "ORDER BY resource, version",
+            data_parameters + [project_name, entity_type, uri_pattern]
+        )
+        return {uri: json.loads(data) for uri, data in rows}
+
+
+def _data_projection(fields):
+    """
+    return the sql expression selecting the data column, restricted to some fields if they are given, and its
+    parameters. The other fields are left in the database, they are neither sent nor parsed
+    """
+    if fields is None:
+        return "data", []
+    # json_each gives the booleans as integers, they are turned back to json
+    return "(SELECT json_group_object(key, CASE type WHEN 'true' THEN json('true') WHEN 'false' THEN json('false') " \
+           "ELSE value END) FROM json_each(data) WHERE key IN (" + ", ".join(["?"] * len(fields)) + "))", list(fields)
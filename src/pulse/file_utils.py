@@ -4,24 +4,277 @@ import hashlib
 import shutil
 import sys
 import subprocess
-from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWUSR
+import errno
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWUSR, S_IWGRP, S_IWOTH
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+BUFFER_SIZE = 1024 * 1024
+"""read size used to hash and copy files"""
+DEFAULT_MAX_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+"""default number of files hashed or copied concurrently"""
+DEFAULT_HASH_ALGORITHM = "md5"
+"""algorithm assumed for checksums which are not tagged with one"""
+
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16)
+}
+"""checksum algorithms available, by name. Optional ones are registered only if their module is installed"""
+
+MATERIALIZATION_FALLBACKS = {
+    "copy": ["copy"],
+    "reflink": ["reflink", "copy"],
+    "hardlink": ["hardlink", "reflink", "copy"],
+    "symlink": ["symlink", "hardlink", "reflink", "copy"]
+}
+"""strategies tried in order to create a file from another one, for each materialization strategy"""
+FICLONE = 0x40049409
+"""linux ioctl sharing the extents of a file with another one, on copy on write filesystems (btrfs, xfs...)"""
+PARTIAL_SUFFIX = ".pulse_part"
+"""suffix of a file being transferred, it is renamed to its final name once complete"""
+STAGING_SUFFIX = ".pulse_staging"
+"""suffix of a directory being transferred, it is renamed to its final name once complete"""
+LOCK_SUFFIX = ".lock"
+"""suffix of the files holding the advisory locks, see file_lock"""
+try:
+    import xxhash
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
+    if hasattr(xxhash, "xxh3_128"):
+        HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+except ImportError:
+    pass
+try:
+    import blake3
+    HASH_ALGORITHMS["blake3"] = blake3.blake3
+except ImportError:
+    pass
+
+
+CHECKSUM_CACHE_RACY_DELAY = 2.0
+"""files modified more recently than this delay (in seconds) are not cached, their mtime could still change
+ without being noticed by the filesystem timestamp resolution"""
+
+
+_max_workers = DEFAULT_MAX_WORKERS
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def set_max_workers(max_workers):
+    """
+    set the number of files hashed or copied concurrently by the shared thread pool.
+    1 disables the parallelism. The pool is shared by all the connections of the process : its size is fixed once
+    it has started, a transfer could still be submitting to it.
+    raise a ValueError if the pool has already started with another size
+
+    :param max_workers: integer
+    """
+    global _max_workers
+    if max_workers < 1:
+        raise ValueError("max workers should be at least 1")
+    with _executor_lock:
+        if max_workers == _max_workers:
+            return
+        if _executor:
+            raise ValueError("the thread pool has already started with " + str(_max_workers) + " workers")
+        _max_workers = max_workers
+
+
+def get_max_workers():
+    return _max_workers
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if not _executor:
+            _executor = ThreadPoolExecutor(max_workers=_max_workers)
+        return _executor
+
+
+def map_parallel(function, items):
+    """
+    call function on each item with the shared thread pool, and return the results in the items order.
+    The function should only do file I/O, it must not call map_parallel itself or the pool could starve
+
+    :param function: a callable taking one item as argument
+    :param items: iterable
+    :return: results list
+    """
+    items = list(items)
+    if len(items) < 2 or _max_workers < 2:
+        return [function(item) for item in items]
+    return list(_get_executor().map(function, items))
 
 
 def md5(filepath):
-    hash_md5 = hashlib.md5()
+    return file_checksum(filepath, "md5")
+
+
+def file_checksum(filepath, algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    return the hexadecimal checksum of a file content
+
+    :param filepath: the file to hash
+    :param algorithm: a key of HASH_ALGORITHMS
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError("unsupported hash algorithm : " + algorithm)
+    hash_object = HASH_ALGORITHMS[algorithm]()
     with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+def checksum_entry(checksum, algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    build the checksum entry stored for each file in work data and commits
+    """
+    return {"checksum": checksum, "algorithm": algorithm}
+
+
+def get_checksum_algorithm(entry):
+    """
+    return the algorithm of a checksum entry. Entries written before algorithms were tagged are md5
+    """
+    return entry.get("algorithm", DEFAULT_HASH_ALGORITHM)
+
+
+def checksum_key(entry):
+    """
+    return a string identifying a file content, unique across algorithms.
+    md5 keys are the bare checksum to stay compatible with untagged data
+    """
+    algorithm = get_checksum_algorithm(entry)
+    if algorithm == DEFAULT_HASH_ALGORITHM:
+        return entry["checksum"]
+    return algorithm + "-" + entry["checksum"]
+
+
+def reflink_file(source, destination):
+    """
+    clone a file with the FICLONE ioctl, the data blocks are shared until one of the files is modified.
+    raise an OSError if the platform or the filesystem doesn't support it
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform")
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+
+
+def copy_file(source, destination, strategy="copy"):
+    """
+    copy a file, creating the destination directory if needed.
+    The strategy can be "copy", "reflink", "hardlink" or "symlink", if it fails the next cheaper one is tried
+    until a plain copy (see MATERIALIZATION_FALLBACKS). Links should only be used for read only destinations, and
+    are only made to read only sources : writing the destination would change the source
+
+    :return: the strategy finally used
+    """
+    linkable = is_read_only(source)
+    destination_directory = os.path.dirname(destination)
+    if destination_directory:
+        os.makedirs(destination_directory, exist_ok=True)
+    # the file is created under a temporary name, an existing destination file is always complete. The name is
+    # unique to the thread, as the same destination can be written concurrently, as a repository cache blob
+    partial_path = destination + "." + str(os.getpid()) + "_" + str(threading.get_ident()) + PARTIAL_SUFFIX
+    for method in MATERIALIZATION_FALLBACKS[strategy]:
+        if method in ["symlink", "hardlink"] and not linkable:
+            continue
+        if os.path.lexists(partial_path):
+            os.remove(partial_path)
+        try:
+            if method == "symlink":
+                os.symlink(os.path.abspath(source), partial_path)
+            elif method == "hardlink":
+                os.link(source, partial_path)
+            elif method == "reflink":
+                reflink_file(source, partial_path)
+            else:
+                shutil.copyfile(source, partial_path)
+        except (OSError, NotImplementedError):
+            if method == "copy":
+                raise
+            continue
+        os.replace(partial_path, destination)
+        return method
+
 
+def is_read_only(filepath):
+    """return True if nobody can write the file, following the symbolic links"""
+    return not os.stat(filepath).st_mode & (S_IWUSR | S_IWGRP | S_IWOTH)
 
-def compare_directory_content(current_work_data, past_work_data):
+
+def set_read_only(filepath):
+    os.chmod(filepath, S_IREAD | S_IRGRP | S_IROTH)
+
+
+def remove_file(filepath):
+    """remove a file, even a read only one on Windows"""
+    try:
+        os.remove(filepath)
+    except PermissionError:
+        os.chmod(filepath, S_IWUSR | S_IREAD)
+        os.remove(filepath)
+
+
+def remove_tree(directory):
+    """remove a directory tree, even holding read only files on Windows"""
+    def make_writable(function, path, exc_info):
+        if function not in [os.remove, os.unlink]:
+            raise exc_info[1]
+        os.chmod(path, S_IWUSR | S_IREAD)
+        function(path)
+    shutil.rmtree(directory, onerror=make_writable)
+
+
+def copy_files(file_pairs, strategy="copy"):
+    """
+    copy files concurrently with the shared thread pool
+
+    :param file_pairs: list of (source, destination) tuples
+    :param strategy: see copy_file
+    """
+    map_parallel(lambda pair: copy_file(pair[0], pair[1], strategy), file_pairs)
+
+
+def compare_directory_content(current_work_data, past_work_data, directory=None):
+    """
+    compare two files checksums dict, and return the changes in the form {relative_path: "added"|"edited"|"removed"}
+
+    :param current_work_data: the current files checksums
+    :param past_work_data: the reference files checksums, this dict is consumed
+    :param directory: the directory of the current files. If set, a file whose checksums were computed with
+     different algorithms is hashed again with the past algorithm, instead of being reported as edited
+    """
     file_changes = {}
     for filepath in current_work_data:
         if filepath.endswith(".pipe"):
             continue
         if filepath in past_work_data:
-            if current_work_data[filepath]['checksum'] != past_work_data[filepath]['checksum']:
+            current_entry = current_work_data[filepath]
+            past_entry = past_work_data[filepath]
+            past_algorithm = get_checksum_algorithm(past_entry)
+            if get_checksum_algorithm(current_entry) != past_algorithm and directory:
+                current_entry = checksum_entry(file_checksum(directory + filepath, past_algorithm), past_algorithm)
+            if checksum_key(current_entry) != checksum_key(past_entry):
                 file_changes[filepath] = "edited"
             past_work_data.pop(filepath)
         else:
@@ -44,7 +297,7 @@ def get_directory_content(directory, ignore_list=None):
         for f in files:
             filepath = os.path.join(root, f)
             relative_path = filepath[len(directory):]
-            files_dict[relative_path] = {"checksum": md5(filepath)}
+            files_dict[relative_path] = checksum_entry(md5(filepath))
     return files_dict
 
 
@@ -63,29 +316,82 @@ def read_data(filepath):
 
 
 def write_data(filepath, data):
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    """
+    write data to a json file. The data is written to a temporary file, flushed to disk, then renamed over the
+    destination : a reader or a crash never finds a partially written file
+    """
     directory = os.path.dirname(filepath)
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
-    with open(filepath, "w") as write_file:
-        json.dump(data, write_file, indent=4, sort_keys=True)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp_path = filepath + ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+    try:
+        with open(temp_path, "w") as write_file:
+            json.dump(data, write_file, indent=4, sort_keys=True)
+            write_file.flush()
+            os.fsync(write_file.fileno())
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def file_lock(filepath):
+    """
+    hold an exclusive advisory lock on a file, across threads and processes, while the context is open.
+    The lock is taken on a LOCK_SUFFIX sidecar file, the locked file itself can be replaced by write_data
+
+    :param filepath: the file to lock, it doesn't have to exist
+    """
+    lock_path = filepath + LOCK_SUFFIX
+    directory = os.path.dirname(lock_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(lock_path, "a+b") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            # LK_LOCK gives up after 10 seconds
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def update_data(filepath, update_function, default=None):
+    """
+    read, modify and write back a json file while holding its lock, so concurrent updates are never lost
+
+    :param filepath: the json file
+    :param update_function: called with the file data, or default if the file doesn't exist. Returns the new data
+    :param default: the data of a missing file
+    :return: the new data
+    """
+    with file_lock(filepath):
+        data = read_data(filepath) if os.path.exists(filepath) else default
+        data = update_function(data)
+        write_data(filepath, data)
+    return data
 
 
 def json_list_remove(json_path, item):
-    json_list = read_data(json_path)
-    json_list.remove(item)
-    write_data(json_path, json_list)
+    update_data(json_path, lambda json_list: [x for x in json_list if x != item])
 
 
 def json_list_append(json_path, item):
-    if not os.path.exists(json_path):
-        json_list = []
-    else:
-        json_list = read_data(json_path)
-    if item not in json_list:
-        json_list.append(item)
-        write_data(json_path, json_list)
+    update_data(json_path, lambda json_list: json_list if item in json_list else json_list + [item], [])
 
 
 def json_list_init(json_path):
@@ -117,31 +423,49 @@ def remove_empty_parents_directory(directory, root_dirs=[]):
             break
 
 
-def copytree(src, dst, ignore=None):
+def copytree(src, dst, ignore=None, strategy="copy", copy_function=None):
     """
-    based on shutil.copytree but using the copyfile function to avoid permission error on linux
-    could be removed on python 3 since there's the copy_function argument with shutil.copytree
+    based on shutil.copytree but using the copyfile function to avoid permission error on linux.
+    Existing destination files are kept. Files are copied concurrently with the shared thread pool,
+    with the given copy_file strategy, or with copy_function(source, destination) if it's set
     """
-    names = os.listdir(src)
-    if ignore is not None:
-        ignored_names = ignore(src, names)
+    file_pairs = []
+    for root, dirs, files in os.walk(src, topdown=True, followlinks=True):
+        if ignore is not None:
+            ignored_names = ignore(root, dirs + files)
+            dirs[:] = [d for d in dirs if d not in ignored_names]
+            files = [f for f in files if f not in ignored_names]
+        destination_root = os.path.join(dst, root[len(src):].lstrip(os.sep))
+        if not os.path.exists(destination_root):
+            os.makedirs(destination_root)
+        for name in files:
+            destination = os.path.join(destination_root, name)
+            if not os.path.exists(destination):
+                file_pairs.append((os.path.join(root, name), destination))
+    if copy_function:
+        map_parallel(lambda pair: copy_function(pair[0], pair[1]), file_pairs)
     else:
-        ignored_names = set()
+        copy_files(file_pairs, strategy)
 
-    if not os.path.exists(dst):
-        os.makedirs(dst)
 
-    for name in names:
-        if name in ignored_names:
-            continue
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, name)
+@contextmanager
+def staging_directory(destination):
+    """
+    yield the directory a transfer should fill, renamed to destination once the transfer is done.
+    This way destination never shows a partial content : an interrupted transfer leaves its staging directory,
+    and the next transfer to the same destination resumes from the files already there.
+    If destination already exists, it is filled in place
 
-        if os.path.isdir(srcname):
-            copytree(srcname, dstname, ignore)
-        else:
-            if not os.path.exists(dstname):
-                shutil.copyfile(srcname, dstname)
+    :param destination: the directory path
+    """
+    destination = os.path.normpath(destination)
+    if os.path.exists(destination):
+        yield destination
+        return
+    staging_path = destination + STAGING_SUFFIX
+    os.makedirs(staging_path, exist_ok=True)
+    yield staging_path
+    os.rename(staging_path, destination)
 
 
 def move_file(src_path, dst_path):
@@ -166,25 +490,105 @@ def make_directory_link(source, destination):
 
 
 def lock_directory_content(directory, lock=True):
+    """
+    make the directory files read only, or writable again.
+    Symbolic links are ignored, and linked files are never made writable since they are shared with a repository
+    """
     for root, directories, files in os.walk(directory):
         for f in files:
+            filepath = os.path.join(root, f)
+            if os.path.islink(filepath):
+                continue
             if lock:
-                os.chmod(os.path.join(root, f), S_IREAD | S_IRGRP | S_IROTH)
-            else:
-                os.chmod(os.path.join(root, f), S_IWUSR | S_IREAD)
+                set_read_only(filepath)
+            elif os.stat(filepath).st_nlink < 2:
+                os.chmod(filepath, S_IWUSR | S_IREAD)
 
 
-def get_file_list(root_directory, excluded_patterns=[]):
+def get_file_list(root_directory, excluded_patterns=[], checksum_cache=None, algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    return the files found under root directory, with their checksum
+
+    :param root_directory: the directory to walk through
+    :param excluded_patterns: directories name which won't be walked through
+    :param checksum_cache: dict of previously computed checksums, as returned by read_checksum_cache.
+     Files whose size, modification time and inode did not change are not hashed again.
+     The dict is updated in place.
+    :param algorithm: the checksum algorithm, a key of HASH_ALGORITHMS
+    :return: dict in the form {relative_path: {"checksum": checksum, "algorithm": algorithm}}
+    """
     files_dict = {}
+    # files to hash, as (filepath, relative path, stat signature) tuples
+    to_hash = []
+    now = time.time()
     for root, dirs, files in os.walk(root_directory, topdown=True):
         dirs[:] = [d for d in dirs if d not in excluded_patterns]
         for f in files:
             filepath = os.path.join(root, f)
-            relative_path = filepath[len(root_directory):]
-            files_dict[relative_path.replace(os.sep, "/")] = {"checksum": md5(filepath)}
+            relative_path = filepath[len(root_directory):].replace(os.sep, "/")
+            if checksum_cache is None:
+                to_hash.append((filepath, relative_path, None))
+                continue
+            stat = os.stat(filepath)
+            signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            entry = checksum_cache.get(relative_path)
+            # entries cached before algorithms were tagged are md5
+            if entry and entry[:3] == signature and (entry[4:] or [DEFAULT_HASH_ALGORITHM])[0] == algorithm:
+                files_dict[relative_path] = checksum_entry(entry[3], algorithm)
+            else:
+                to_hash.append((filepath, relative_path, signature))
+
+    checksums = map_parallel(lambda item: file_checksum(item[0], algorithm), to_hash)
+    for (filepath, relative_path, signature), checksum in zip(to_hash, checksums):
+        files_dict[relative_path] = checksum_entry(checksum, algorithm)
+        if checksum_cache is None:
+            continue
+        # do not trust a recent modification time, it could change again without being noticed
+        if signature[1] < (now - CHECKSUM_CACHE_RACY_DELAY) * 1e9:
+            checksum_cache[relative_path] = signature + [checksum, algorithm]
+        else:
+            checksum_cache.pop(relative_path, None)
+
+    if checksum_cache is not None:
+        for relative_path in [x for x in checksum_cache if x not in files_dict]:
+            checksum_cache.pop(relative_path)
     return files_dict
 
 
+def add_file_stats(files, root_directory):
+    """
+    return a copy of a files checksums dict, with the size and the modification time of each file
+
+    :param files: dict in the form {relative_path: checksum entry}, as returned by get_file_list
+    :param root_directory: the directory holding the files
+    :return: dict in the form {relative_path: {"checksum": checksum, "algorithm": algorithm, "size": bytes,
+     "mtime": nanoseconds}}
+    """
+    files_stats = {}
+    for relative_path, entry in files.items():
+        stat = os.stat(root_directory + relative_path)
+        files_stats[relative_path] = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+    return files_stats
+
+
+def read_checksum_cache(filepath):
+    """
+    read a checksum cache file. Return an empty cache if the file is missing or unreadable
+
+    :return: dict in the form {relative_path: [size, mtime_ns, inode, checksum, algorithm]}
+    """
+    if not os.path.exists(filepath):
+        return {}
+    try:
+        return read_data(filepath)
+    except ValueError:
+        return {}
+
+
+def write_checksum_cache(filepath, checksum_cache):
+    write_data(filepath, checksum_cache)
+
+
 def path_join(a, *args):
     path = os.path.join(a, *args)
     return path.replace("\\", "/")
@@ -200,3 +604,12 @@ def get_directory_list(root_directory, excluded_patterns=[]):
             directory_list.append(relative_path.replace(os.sep, "/"))
 
     return directory_list
+
+
+def get_directory_size(directory):
+    """return the size in bytes of the files under a directory, links are not followed"""
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            size += os.lstat(os.path.join(root, f)).st_size
+    return size
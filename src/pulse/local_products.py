@@ -0,0 +1,176 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+INDEX_FILENAME = "local_products.sqlite"
+INDEX_VERSION = 1
+"""version of the index tables, recorded in the sqlite user_version"""
+PRODUCT_FIELDS = ["uri", "work", "directory", "size", "last_access"]
+
+
+class LocalProductIndex:
+    """
+    index of the products available in a user products space : the published versions and the works products,
+    with their directory, size, last access time and users. The products space can be kept under a quota from it,
+    without reading the database.
+    The index is a sqlite file, each change is a transaction : it can be shared by the processes of the workstation.
+
+    :param filepath: the index file, created if needed
+    """
+    def __init__(self, filepath):
+        directory = os.path.dirname(filepath)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.filepath = filepath
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(filepath, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as cursor:
+            # the users were kept in json lists before the index existed, a new index has to import them.
+            # An index written by a later version is used as is, its upgrades only add to the tables
+            self.created = cursor.execute("PRAGMA user_version").fetchone()[0] == 0
+            if self.created:
+                _create_tables(cursor)
+                cursor.execute("PRAGMA user_version = " + str(INDEX_VERSION))
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def _query(self, cmd, parameters=()):
+        with self._lock:
+            return self.connection.execute(cmd, parameters).fetchall()
+
+    def add(self, uri, directory, size, work=False, last_access=None):
+        """
+        register a local product, or update its entry. Its users are kept
+
+        :param uri: the product uri
+        :param directory: the product directory
+        :param size: the product size in bytes
+        :param work: True for a work product, False for a published version
+        :param last_access: the last time the product has been used, now if not set
+        """
+        with self._transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO Product (uri, work, directory, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (uri, int(work), directory, size, last_access if last_access is not None else time.time())
+            )
+
+    def touch(self, uri, work=False):
+        """mark a product as used now"""
+        with self._transaction() as cursor:
+            _touch(cursor, uri, work)
+
+    def remove(self, uri, work=False):
+        """unregister a product and its users"""
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM Product WHERE uri = ? AND work = ?", (uri, int(work)))
+            cursor.execute("DELETE FROM ProductUser WHERE uri = ? AND work = ?", (uri, int(work)))
+
+    def get_product(self, uri, work=False):
+        """return a product entry as a dict, see get_products. None if the product is not registered"""
+        rows = self._query(
+            "SELECT " + ", ".join(PRODUCT_FIELDS) + " FROM Product WHERE uri = ? AND work = ?", (uri, int(work)))
+        return _product_entry(rows[0]) if rows else None
+
+    def get_products(self, work=False, unused_only=False):
+        """
+        return the registered products, the least recently used first
+
+        :param work: True to get the works products, False for the published versions
+        :param unused_only: only return the products without users
+        :return: list of dict with the uri, work, directory, size and last_access keys
+        """
+        cmd = "SELECT " + ", ".join(PRODUCT_FIELDS) + " FROM Product WHERE work = ?"
+        if unused_only:
+            cmd += " AND NOT EXISTS (SELECT 1 FROM ProductUser " \
+                   "WHERE ProductUser.uri = Product.uri AND ProductUser.work = Product.work)"
+        return [_product_entry(row) for row in self._query(cmd + " ORDER BY last_access", (int(work),))]
+
+    def list_uris(self, uri_pattern="*", work=False):
+        """return the uris of the registered products matching a glob pattern"""
+        rows = self._query(
+            "SELECT uri FROM Product WHERE work = ? AND uri GLOB ? ORDER BY uri", (int(work), uri_pattern))
+        return [row[0] for row in rows]
+
+    def get_total_size(self, work=False):
+        return self._query("SELECT COALESCE(SUM(size), 0) FROM Product WHERE work = ?", (int(work),))[0][0]
+
+    def add_user(self, uri, user_directory, work=False):
+        """register a work directory as a product user, and mark the product as used now"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "INSERT OR IGNORE INTO ProductUser (uri, work, user_directory) VALUES (?, ?, ?)",
+                (uri, int(work), user_directory)
+            )
+            _touch(cursor, uri, work)
+
+    def remove_user(self, uri, user_directory, work=False):
+        """unregister a product user, and mark the product as used now"""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM ProductUser WHERE uri = ? AND work = ? AND user_directory = ?",
+                (uri, int(work), user_directory)
+            )
+            _touch(cursor, uri, work)
+
+    def get_users(self, uri, work=False):
+        """return the directories of the works using a product"""
+        rows = self._query(
+            "SELECT user_directory FROM ProductUser WHERE uri = ? AND work = ? ORDER BY user_directory",
+            (uri, int(work))
+        )
+        return [row[0] for row in rows]
+
+    def get_used_products(self, user_directory):
+        """
+        return the products used by a work directory
+
+        :return: list of (uri, work) tuples
+        """
+        rows = self._query(
+            "SELECT uri, work FROM ProductUser WHERE user_directory = ? ORDER BY uri", (user_directory,))
+        return [(row[0], bool(row[1])) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def _create_tables(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS Product ("
+        "uri TEXT NOT NULL, "
+        "work INTEGER NOT NULL, "
+        "directory TEXT NOT NULL, "
+        "size INTEGER NOT NULL, "
+        "last_access REAL NOT NULL, "
+        "PRIMARY KEY (uri, work))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS Product_last_access ON Product (last_access)")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS ProductUser ("
+        "uri TEXT NOT NULL, "
+        "work INTEGER NOT NULL, "
+        "user_directory TEXT NOT NULL, "
+        "PRIMARY KEY (uri, work, user_directory))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ProductUser_user_directory ON ProductUser (user_directory)")
+
+
+def _touch(cursor, uri, work):
+    cursor.execute("UPDATE Product SET last_access = ? WHERE uri = ? AND work = ?", (time.time(), uri, int(work)))
+
+
+def _product_entry(row):
+    entry = dict(zip(PRODUCT_FIELDS, row))
+    entry["work"] = bool(entry["work"])
+    return entry
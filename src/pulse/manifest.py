@@ -0,0 +1,224 @@
+import array
+import base64
+import bisect
+import sys
+import zlib
+from collections.abc import Mapping, ItemsView, ValuesView
+from itertools import accumulate
+
+FORMAT_PREFIX = "pulse-files-"
+"""prefix of the encoded files manifests, followed by the format version and a colon"""
+FORMAT_VERSION = 1
+FORMAT_TAG = FORMAT_PREFIX + str(FORMAT_VERSION) + ":"
+"""tag starting the manifests written in the current format, followed by their base64 data"""
+ENTRY_KEYS = {"checksum", "algorithm", "size", "mtime"}
+"""keys a files entry can hold to be encoded"""
+
+_FLAG_HEX_CHECKSUM = 1
+_FLAG_SIZE = 2
+_FLAG_MTIME = 4
+# paths can't hold a null character, it separates them
+_PATH_SEPARATOR = "\0"
+# the columns of integers, in their order in the manifest, with their array type code. The manifests are shared
+# between platforms : only the type codes having the same size everywhere are used, "L" is 4 bytes on Windows and 8
+# on Linux. Each column has a value for every file, the flags tell if the size and mtime are set
+_COLUMNS = [
+    ("algorithms", "H"),
+    ("flags", "B"),
+    ("checksum_lengths", "I"),
+    ("sizes", "Q"),
+    ("mtimes", "q")
+]
+# the text blobs, before the columns
+_BLOBS = ["algorithms_table", "paths", "checksums"]
+# the fastest zlib level, the sorted paths and the columns compress well even with it
+_COMPRESSION_LEVEL = 1
+
+
+def is_encoded(value):
+    """return True if the value is an encoded files manifest"""
+    return isinstance(value, str) and value.startswith(FORMAT_PREFIX)
+
+
+def encode_files(files):
+    """
+    encode a files dict, as stored in commits, to a compact text.
+    Paths are sorted, so the zlib compression of the manifest shares their common prefixes. Hexadecimal checksums
+    are stored as raw digests. Each attribute is stored as a column, so the manifest is encoded and decoded with
+    bulk operations. The manifest is tagged with its format version.
+    raise a ValueError if an entry holds other keys than ENTRY_KEYS
+
+    :param files: dict in the form {path: {"checksum": checksum, "algorithm": algorithm, "size": bytes,
+     "mtime": nanoseconds}}, algorithm, size and mtime are optional
+    :return: string
+    """
+    paths = sorted(files)
+    entries = [files[x] for x in paths]
+    if not ENTRY_KEYS.issuperset(set().union(*entries)):
+        path = next(x for x, entry in zip(paths, entries) if not ENTRY_KEYS.issuperset(entry))
+        raise ValueError("can't encode the files entry of " + path)
+
+    # entries without algorithm are kept as is, "" stands for them in the algorithms table
+    algorithm_names = [x.get("algorithm", "") for x in entries]
+    algorithms_table = list(dict.fromkeys(algorithm_names))
+    algorithm_indexes = {x: index for index, x in enumerate(algorithms_table)}
+
+    checksums = [x["checksum"] for x in entries]
+    joined_checksums = "".join(checksums)
+    try:
+        # checksums are almost always lowercase hexadecimal digests, they are converted at once
+        digests = bytes.fromhex(joined_checksums)
+        all_hex = digests.hex() == joined_checksums and not any(len(x) % 2 for x in checksums)
+    except ValueError:
+        all_hex = False
+    if all_hex:
+        hex_flags = [_FLAG_HEX_CHECKSUM] * len(checksums)
+        checksum_blob = digests
+        checksum_lengths = [len(x) // 2 for x in checksums]
+    else:
+        hex_flags, raw_checksums = zip(*[_checksum_bytes(x) for x in checksums]) if checksums else ((), ())
+        checksum_blob = b"".join(raw_checksums)
+        checksum_lengths = [len(x) for x in raw_checksums]
+
+    columns = {
+        "algorithms": map(algorithm_indexes.__getitem__, algorithm_names),
+        "flags": [
+            flag | (_FLAG_SIZE if "size" in entry else 0) | (_FLAG_MTIME if "mtime" in entry else 0)
+            for flag, entry in zip(hex_flags, entries)
+        ],
+        "checksum_lengths": checksum_lengths,
+        "sizes": [x.get("size", 0) for x in entries],
+        "mtimes": [x.get("mtime", 0) for x in entries]
+    }
+    blobs = [
+        "\n".join(algorithms_table).encode("utf-8"),
+        _PATH_SEPARATOR.join(paths).encode("utf-8"),
+        checksum_blob
+    ]
+    for name, type_code in _COLUMNS:
+        column = array.array(type_code, columns[name])
+        if sys.byteorder == "big":
+            column.byteswap()
+        blobs.append(column.tobytes())
+    data = array.array("Q", [len(files)] + [len(x) for x in blobs])
+    if sys.byteorder == "big":
+        data.byteswap()
+    compressed_data = zlib.compress(data.tobytes() + b"".join(blobs), _COMPRESSION_LEVEL)
+    return FORMAT_TAG + base64.b64encode(compressed_data).decode("ascii")
+
+
+def _checksum_bytes(checksum):
+    """return the flag and the bytes storing a checksum, its digest if it's a lowercase hexadecimal one"""
+    try:
+        digest = bytes.fromhex(checksum)
+        if digest.hex() == checksum:
+            return _FLAG_HEX_CHECKSUM, digest
+    except ValueError:
+        pass
+    return 0, checksum.encode("utf-8")
+
+
+def decode_files(value):
+    """
+    decode a files manifest encoded by encode_files.
+    raise a ValueError if its format version is unknown
+
+    :return: a FilesManifest, read only mapping in the form {path: entry}
+    """
+    return FilesManifest(value)
+
+
+class FilesManifest(Mapping):
+    """
+    the files of an encoded manifest, by path. The manifest columns are kept as arrays : the entries dicts are built
+    on access, each access returns a new dict
+    """
+    def __init__(self, value):
+        version, _, encoded_data = value[len(FORMAT_PREFIX):].partition(":")
+        if version != str(FORMAT_VERSION):
+            raise ValueError("unknown files manifest format : " + version)
+        data = zlib.decompress(base64.b64decode(encoded_data))
+
+        header = array.array("Q")
+        header_length = 8 * (len(_BLOBS) + len(_COLUMNS) + 1)
+        header.frombytes(data[:header_length])
+        if sys.byteorder == "big":
+            header.byteswap()
+        blobs = []
+        position = header_length
+        for length in header[1:]:
+            blobs.append(data[position:position + length])
+            position += length
+
+        self._algorithms_table = blobs[0].decode("utf-8").split("\n")
+        self._paths_blob = blobs[1] if header[0] else None
+        self._paths_list = None
+        self._checksums = blobs[2]
+        self._columns = {}
+        for (name, type_code), blob in zip(_COLUMNS, blobs[len(_BLOBS):]):
+            self._columns[name] = array.array(type_code)
+            self._columns[name].frombytes(blob)
+            if sys.byteorder == "big":
+                self._columns[name].byteswap()
+        # checksums positions, computed on the first entry access
+        self._checksum_offsets = None
+
+    @property
+    def _paths(self):
+        """the sorted paths, split on the first access"""
+        if self._paths_list is None:
+            self._paths_list = []
+            if self._paths_blob is not None:
+                self._paths_list = self._paths_blob.decode("utf-8").split(_PATH_SEPARATOR)
+            self._paths_blob = None
+        return self._paths_list
+
+    def __len__(self):
+        return len(self._columns["flags"])
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __contains__(self, path):
+        index = bisect.bisect_left(self._paths, path)
+        return index < len(self._paths) and self._paths[index] == path
+
+    def __getitem__(self, path):
+        index = bisect.bisect_left(self._paths, path)
+        if index == len(self._paths) or self._paths[index] != path:
+            raise KeyError(path)
+        return self._entry(index)
+
+    def items(self):
+        return _FilesManifestItems(self)
+
+    def values(self):
+        return _FilesManifestValues(self)
+
+    def _entry(self, index):
+        if self._checksum_offsets is None:
+            self._checksum_offsets = array.array("Q", accumulate(self._columns["checksum_lengths"], initial=0))
+        flags = self._columns["flags"][index]
+        checksum = self._checksums[self._checksum_offsets[index]:self._checksum_offsets[index + 1]]
+        entry = {"checksum": checksum.hex() if flags & _FLAG_HEX_CHECKSUM else checksum.decode("utf-8")}
+        algorithm = self._algorithms_table[self._columns["algorithms"][index]]
+        if algorithm:
+            entry["algorithm"] = algorithm
+        if flags & _FLAG_SIZE:
+            entry["size"] = self._columns["sizes"][index]
+        if flags & _FLAG_MTIME:
+            entry["mtime"] = self._columns["mtimes"][index]
+        return entry
+
+
+class _FilesManifestItems(ItemsView):
+    # the entries are built in the paths order, without looking their paths up
+    def __iter__(self):
+        for index, path in enumerate(self._mapping._paths):
+            yield path, self._mapping._entry(index)
+
+
+class _FilesManifestValues(ValuesView):
+    def __iter__(self):
+        for index in range(len(self._mapping)):
+            yield self._mapping._entry(index)
@@ -0,0 +1,94 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 10
+"""seconds an object read from the database is reused before being read again"""
+IMMUTABLE_ENTITY_TYPES = ("PublishedVersion",)
+"""entity types never changed once created, they are kept without expiration"""
+DEFAULT_MAX_ENTRIES = 10000
+"""entries kept by a cache, the least recently used are removed beyond"""
+
+
+class ObjectCache:
+    """
+    read through cache of the objects a project reads from its database, keyed by entity type and uri.
+    Entries expire after ttl seconds, except the immutable entity types ones. Beyond max_entries, the least recently
+    used entries are removed. The entries are copied in and out, so an object changing its attributes doesn't change
+    the cache. The cache is shared by the threads using the project.
+
+    :param ttl: entries lifetime in seconds, 0 to only cache the immutable entity types
+    :param max_entries: the entries count limit
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, entity_type, uri, fields=None):
+        """
+        return the cached data of an object, None if it's missing or expired.
+        If fields is set, the entry can be partial but has to hold these fields, otherwise it has to be complete
+
+        :param fields: the fields needed
+        """
+        with self._lock:
+            entry = self._entries.get((entity_type, uri))
+            if entry is not None and entity_type not in IMMUTABLE_ENTITY_TYPES and \
+                    time.time() - entry[1] >= self.ttl:
+                del self._entries[(entity_type, uri)]
+                entry = None
+            if entry is not None and not entry[2] and (fields is None or any(x not in entry[0] for x in fields)):
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end((entity_type, uri))
+            self._hits += 1
+        return copy.deepcopy(entry[0])
+
+    def set(self, entity_type, uri, data, fields=None):
+        """
+        cache the data of an object, as just read from the database.
+        If fields is set, data only holds these fields, they are added to the object entry
+
+        :param fields: the fields read, None if the object has been completely read
+        """
+        if entity_type not in IMMUTABLE_ENTITY_TYPES and not self.ttl:
+            return
+        data = copy.deepcopy(data)
+        with self._lock:
+            entry = self._entries.get((entity_type, uri))
+            if fields is None or entry is None:
+                self._entries[(entity_type, uri)] = (data, time.time(), fields is None)
+            else:
+                # the entry keeps its age, the fields it already had are as old
+                merged_data = dict(entry[0])
+                merged_data.update(data)
+                self._entries[(entity_type, uri)] = (merged_data, entry[1], entry[2])
+            self._entries.move_to_end((entity_type, uri))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, entity_type=None, uri=None):
+        """
+        remove the entries of an object, as after it has been changed. If uri is not set, all the entity type
+        entries are removed, and if entity_type is not set, the whole cache is cleared
+        """
+        with self._lock:
+            if entity_type is None:
+                self._entries.clear()
+            elif uri is not None:
+                self._entries.pop((entity_type, uri), None)
+            else:
+                for key in [x for x in self._entries if x[0] == entity_type]:
+                    del self._entries[key]
+
+    def get_statistics(self):
+        """return the cache counters as a dict : hits, misses, size (entries count) and ttl"""
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "size": len(self._entries), "ttl": self.ttl}
@@ -1,7 +1,27 @@
 # your repository adapter plugin should have a "Repository" class inherited from PulseRepository
+import inspect
 from pulse.exception import *
 
 
+def supported_arguments(method, **arguments):
+    """
+    return the optional arguments a repository method accepts, to pass as keyword arguments.
+    The arguments added to the interface after an adapter was written are left out for it : it still downloads the
+    right content without them, all the commit files instead of the listed ones, or copies instead of links
+
+    :param method: the bound method of the repository
+    :param arguments: the optional arguments, by name
+    :return: dict
+    """
+    try:
+        parameters = inspect.signature(method).parameters
+    except (TypeError, ValueError):
+        return arguments
+    if any(x.kind == inspect.Parameter.VAR_KEYWORD for x in parameters.values()):
+        return arguments
+    return {name: value for name, value in arguments.items() if name in parameters}
+
+
 class PulseRepository:
     def __init__(self, login="", password="", settings=None):
         self.settings = settings
@@ -16,18 +36,60 @@ class PulseRepository:
         pass
 
     def upload_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
-        """upload a commit content to repository
+        """upload a commit content to repository.
+        The commit should only be visible once complete. The files left by an interrupted upload must not end in the
+        next one : they are discarded, or only reused if they can be checked against the commit files checksums
+        """
+        pass
+
+    def stage_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
+        """upload a commit content to a staging location, where it's not visible yet.
+            The staged commit is made visible by promote_resource_commit, or removed by discard_resource_commit.
+            The caller holds the resource commit lock, a staged commit already there for this uri has been left by
+            an interrupted publish : it's discarded, or only the files checked against the commit checksums are kept.
+            This default implementation uploads the commit directly, for the adapters without staging location
+        """
+        return self.upload_resource_commit(project_name, uri, work_root, work_files, product_root, product_files)
+
+    def promote_resource_commit(self, project_name, uri):
+        """make a staged commit visible, in a single operation. Does nothing if the commit is already visible
         """
         pass
 
-    def download_work(self, project_name, uri, work_folder):
+    def discard_resource_commit(self, project_name, uri):
+        """remove a staged commit. Does nothing if there's no staged commit for this uri
+        """
+        pass
+
+    def list_staged_commits(self, project_name):
+        """return the commits staged and neither promoted nor discarded, as a dict {uri: staging time}
+            the staging time is a timestamp, as time.time()
+        """
+        return {}
+
+    def download_work(self, project_name, uri, work_folder, files=None):
         """download a resource work content to a local folder. Creates the folder if needed
+            files is the list of the work files to download, as recorded in the commit (slash prefixed paths
+            relative to the work root). If None, all the work files are downloaded
         """
         pass
 
-    def download_product(self, project_name, uri, destination_folder, subpath=""):
+    def download_product(self, project_name, uri, destination_folder, subpath="", writable=False, files=None):
         """download a product content to a local folder. Creates the folder if needed
             raise a PulseRepositoryError if the subpath is unreachable
+            writable is True when the files will be modified, as when products are restored in a work,
+            the downloaded files can't be links to the repository ones then.
+            A file should only get its final name once complete, the files already there are kept
+            files is the list of the product files to download, as slash prefixed paths relative to the product
+            root, they have to be under subpath. If None, all the files are downloaded
+        """
+        pass
+
+    def get_manifest(self, project_name, uri):
+        """return the content of a commit, as
+            {"work": {"files": {path: key}, "directories": [path]}, "products": {same}}
+            paths are slash prefixed and relative to the work or the product root, keys are the files
+            file_utils.checksum_key. Return None if the repository doesn't know the files checksums
         """
         pass
 
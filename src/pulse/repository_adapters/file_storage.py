@@ -1,32 +1,61 @@
 import os
 import shutil
+import threading
+import time
 from pulse.repository_adapter_interface import *
 import pulse.file_utils as fu
+import pulse.config as cfg
+import pulse.compression as compression
 
+BLOBS_DIRECTORY = ".blobs"
+MANIFEST_FILENAME = "manifest.json"
+# blobs written or reused since are kept by purge_unreferenced_blobs, a publish stores them before its manifest
+BLOB_GRACE_HOURS = 24
+# interrupted uploads, they are not part of the resource history
+TRANSFER_LEFTOVERS = shutil.ignore_patterns("*" + fu.STAGING_SUFFIX, "*" + fu.PARTIAL_SUFFIX)
 
-def copy_folder_content(source_folder, destination_folder):
+
+def copy_folder_content(source_folder, destination_folder, strategy="copy", ignore=None, copy_function=None):
     """copy a folder tree, and creates subsequents destination folders if needed
     """
     destination_folder = os.path.normpath(destination_folder)
     source_folder = os.path.normpath(source_folder)
     if not os.path.exists(source_folder):
         return
-    if not os.path.exists(destination_folder):
-        os.makedirs(destination_folder)
-    for node in os.listdir(source_folder):
-        source_filepath = os.path.join(source_folder, node)
-        destination_filepath = os.path.join(destination_folder, node)
-        if os.path.isdir(source_filepath):
-            fu.copytree(source_filepath, destination_filepath)
-        else:
-            if not os.path.exists(destination_filepath):
-                shutil.copyfile(source_filepath, destination_filepath)
+    fu.copytree(source_folder, destination_folder, ignore=ignore, strategy=strategy, copy_function=copy_function)
+
+
+def select_files(manifest_entry, files=None):
+    """return a manifest entry restricted to some of its files, or the entry itself if files is None"""
+    if files is None:
+        return manifest_entry
+    return {
+        "directories": manifest_entry["directories"],
+        "files": {x: manifest_entry["files"][x] for x in files}
+    }
 
 
 class Repository(PulseRepository):
+    """
+    store resources in a file system directory.
+
+    settings :
+        - path : the repository root directory, slash separated
+        - content_addressed : if True, files are stored once in a blob store keyed by their checksum, and each
+          commit only records a manifest. Unchanged files cost nothing between versions
+        - materialization : how downloaded files are created from the repository ones : "copy" (default),
+          "reflink", "hardlink" or "symlink". It falls back to a plain copy when the filesystem can't do it.
+          Links are only used for read only local products, work files are at best reflinked
+        - compression : "auto", "zstd", "zlib" or "lzma" to store files compressed. "auto" uses zstd if the
+          zstandard module is installed, zlib otherwise. Files already compressed are stored as is, see
+          pulse.compression. Compressed files are always copied when downloaded
+    """
     def __init__(self, login="", password="", settings=None):
         PulseRepository.__init__(self, login, password, settings)
         self.root = self.settings["path"]
+        self.content_addressed = bool(self.settings.get("content_addressed", False))
+        self.materialization = self.settings.get("materialization", "copy")
+        self.compression = self.settings.get("compression")
 
         self.version_prefix = "V"
         self.version_padding = 3
@@ -34,6 +63,9 @@ class Repository(PulseRepository):
     def test_settings(self):
         if "\\" in self.root:
             raise PulseRepositoryError("the root path should use slash separator only")
+        if self.materialization not in fu.MATERIALIZATION_FALLBACKS:
+            raise PulseRepositoryError("unknown materialization strategy : " + self.materialization)
+        self._get_codec()
         if not os.path.exists(self.root):
             os.makedirs(self.root)
         return True
@@ -55,40 +87,330 @@ class Repository(PulseRepository):
             uri.replace("/", "~")
         )
 
+    def _build_version_path(self, project_name, uri):
+        return os.path.dirname(self._build_commit_path(project_name, "work", uri))
+
+    def _build_manifest_path(self, project_name, uri):
+        return os.path.join(self._build_version_path(project_name, uri), MANIFEST_FILENAME)
+
+    def _build_blob_path(self, project_name, key):
+        # keys are the checksum, prefixed with the algorithm name if it's not md5
+        fan_out = key.split("-")[-1][:2]
+        return os.path.join(os.path.expandvars(self.root), project_name, BLOBS_DIRECTORY, fan_out, key)
+
+    def _get_codec(self):
+        """return the compression codec for uploaded files, None if they are stored as is"""
+        try:
+            return compression.get_codec(self.compression)
+        except ValueError as ex:
+            raise PulseRepositoryError(str(ex))
+
+    def _get_store_function(self):
+        """return the function copying a file to the repository, or None if files are plainly copied"""
+        codec = self._get_codec()
+        if not codec:
+            return None
+        return lambda source, destination: compression.store_file(source, destination, codec)
+
     @staticmethod
-    def _copy_files(relative_filepath_list, source_root, destination_root):
-        os.makedirs(destination_root)
+    def _get_restore_function(strategy):
+        """return the function copying a file from the repository"""
+        return lambda source, destination: compression.restore_file(source, destination, strategy)
+
+    def _copy_files(self, relative_filepath_list, source_root, destination_root):
+        os.makedirs(destination_root, exist_ok=True)
+        store_function = self._get_store_function()
+        if store_function:
+            fu.map_parallel(lambda x: store_function(source_root + x, destination_root + x), relative_filepath_list)
+        else:
+            fu.copy_files([(source_root + x, destination_root + x) for x in relative_filepath_list])
+        # the repository files are read only, so they can be linked to the local products
+        fu.lock_directory_content(destination_root)
+
+    def _store_blobs(self, project_name, source_root, files, excluded_directories=[]):
+        """
+        copy the files missing from the blob store, and return the manifest entry describing them.
+        files can be a list of relative path, or a dict with the checksum already computed for each path
+        """
+        if not isinstance(files, dict):
+            files = {x: {} for x in files}
+        missing_checksums = [x for x in files if "checksum" not in files[x]]
+        checksums = fu.map_parallel(lambda x: fu.md5(source_root + x), missing_checksums)
+        manifest_files = {x: fu.checksum_key(files[x]) for x in files if "checksum" in files[x]}
+        manifest_files.update(zip(missing_checksums, checksums))
+
+        # identical files are stored once, even inside a single commit
+        new_blobs = {}
+        reused_blobs = set()
+        for filepath_rel, key in manifest_files.items():
+            blob_path = self._build_blob_path(project_name, key)
+            if blob_path in new_blobs or blob_path in reused_blobs:
+                continue
+            for stored_path in [blob_path, blob_path + compression.COMPRESSED_SUFFIX]:
+                try:
+                    # a reused blob is touched, so a purge running before the manifest is written keeps it
+                    os.utime(stored_path)
+                except FileNotFoundError:
+                    continue
+                except OSError:
+                    # the blob belongs to another user, it can't be touched
+                    pass
+                reused_blobs.add(blob_path)
+                break
+            else:
+                new_blobs[blob_path] = source_root + filepath_rel
+        codec = self._get_codec()
+        fu.map_parallel(lambda blob_path: self._store_blob(new_blobs[blob_path], blob_path, codec), new_blobs)
+        directories = []
+        if os.path.isdir(source_root):
+            directories = fu.get_directory_list(source_root, excluded_directories)
+        return {"files": manifest_files, "directories": directories}
 
-        for filepath_rel in relative_filepath_list:
-            destination = destination_root + filepath_rel
-            destination_dir = os.path.split(destination)[0]
-            if not os.path.isdir(destination_dir):
-                os.makedirs(destination_dir)
-            shutil.copyfile(source_root + filepath_rel, destination)
+    @staticmethod
+    def _store_blob(source, blob_path, codec=None):
+        # copy to a temporary name first, a blob is never visible until it is complete
+        temp_path = blob_path + ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+        stored_path = compression.store_file(source, temp_path, codec)
+        # blobs are read only before anything can link to them, a product file is shared by all the versions
+        fu.set_read_only(stored_path)
+        os.replace(stored_path, blob_path + stored_path[len(temp_path):])
+
+    @staticmethod
+    def _restore_blob(blob_path, destination, strategy="copy"):
+        if os.path.exists(blob_path):
+            fu.copy_file(blob_path, destination, strategy)
+        else:
+            compression.restore_file(blob_path + compression.COMPRESSED_SUFFIX, destination)
+
+    def _restore_blobs(self, project_name, manifest_entry, destination_folder, subpath="", strategy="copy"):
+        """
+        rebuild a directory tree from a manifest entry. Only the part under subpath is restored
+        """
+        prefix = "/" + subpath if subpath else ""
+        if not os.path.exists(destination_folder):
+            os.makedirs(destination_folder)
+        for rel_dir in manifest_entry["directories"]:
+            if not rel_dir.startswith(prefix + "/"):
+                continue
+            directory = destination_folder + rel_dir[len(prefix):]
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        file_pairs = []
+        for filepath_rel, key in manifest_entry["files"].items():
+            if not filepath_rel.startswith(prefix + "/"):
+                continue
+            destination = destination_folder + filepath_rel[len(prefix):]
+            if not os.path.exists(destination):
+                file_pairs.append((self._build_blob_path(project_name, key), destination))
+        fu.map_parallel(lambda pair: self._restore_blob(pair[0], pair[1], strategy), file_pairs)
+
+    def _get_materialization(self, writable):
+        """return the materialization strategy to use, links would let the user modify the repository files"""
+        if writable and self.materialization in ["hardlink", "symlink"]:
+            return "reflink"
+        return self.materialization
+
+    def _read_manifest(self, project_name, uri):
+        manifest_path = self._build_manifest_path(project_name, uri)
+        if not os.path.exists(manifest_path):
+            raise PulseRepositoryError("missing commit manifest : " + manifest_path)
+        return fu.read_data(manifest_path)
 
     def upload_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
-        self._copy_files(work_files, work_root, self._build_commit_path(project_name, "work", uri))
-        self._copy_files(product_files, product_root, self._build_commit_path(project_name, "products", uri))
+        self.stage_resource_commit(project_name, uri, work_root, work_files, product_root, product_files)
+        self.promote_resource_commit(project_name, uri)
         return True
 
-    def download_work(self, project_name, uri, work_folder):
+    def stage_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
+        # the version is filled in a staging directory. The publish holds the commit lock, a staging directory
+        # already there has been left by an interrupted publish : its content can't be trusted
+        self.discard_resource_commit(project_name, uri)
+        staging_path = self._build_version_path(project_name, uri) + fu.STAGING_SUFFIX
+        if not self.content_addressed:
+            self._copy_files(work_files, work_root, os.path.join(staging_path, "work"))
+            self._copy_files(product_files, product_root, os.path.join(staging_path, "products"))
+            return True
+
+        manifest = {
+            "work": self._store_blobs(
+                project_name, work_root, work_files, [cfg.work_output_dir, cfg.work_input_dir]),
+            "products": self._store_blobs(project_name, product_root, product_files)
+        }
+        # the manifest is written last, a staged commit without manifest is incomplete
+        fu.write_data(os.path.join(staging_path, MANIFEST_FILENAME), manifest)
+        return True
+
+    def promote_resource_commit(self, project_name, uri):
+        version_path = self._build_version_path(project_name, uri)
+        staging_path = version_path + fu.STAGING_SUFFIX
+        if not os.path.exists(staging_path):
+            return
+        if os.path.exists(version_path):
+            # already promoted by someone else, as a publish recovery
+            fu.remove_tree(staging_path)
+            return
+        try:
+            os.rename(staging_path, version_path)
+        except OSError:
+            if not os.path.exists(version_path):
+                raise
+
+    def discard_resource_commit(self, project_name, uri):
+        staging_path = self._build_version_path(project_name, uri) + fu.STAGING_SUFFIX
+        if os.path.exists(staging_path):
+            fu.remove_tree(staging_path)
+
+    def list_staged_commits(self, project_name):
+        project_path = os.path.join(os.path.expandvars(self.root), project_name)
+        staged_commits = {}
+        if not os.path.exists(project_path):
+            return staged_commits
+        for resource in os.listdir(project_path):
+            if resource == BLOBS_DIRECTORY:
+                continue
+            resource_path = os.path.join(project_path, resource)
+            for version in os.listdir(resource_path):
+                if not version.endswith(fu.STAGING_SUFFIX):
+                    continue
+                uri = resource.replace("~", "/") + "@" + version[:-len(fu.STAGING_SUFFIX)]
+                staged_commits[uri] = os.path.getmtime(os.path.join(resource_path, version))
+        return staged_commits
+
+    def download_work(self, project_name, uri, work_folder, files=None):
+        strategy = self._get_materialization(writable=True)
+        if self.content_addressed:
+            work_entry = self._read_manifest(project_name, uri)["work"]
+            self._restore_blobs(project_name, select_files(work_entry, files), work_folder, strategy=strategy)
+            return
         repo_work_path = self._build_commit_path(project_name, "work", uri)
-        # copy repo work to sandbox
-        copy_folder_content(repo_work_path, work_folder)
+        if files is None:
+            # copy repo work to sandbox
+            copy_folder_content(repo_work_path, work_folder, copy_function=self._get_restore_function(strategy))
+        else:
+            self._restore_files(repo_work_path, work_folder, files, strategy=strategy)
 
-    def download_product(self, project_name, uri, destination_folder, subpath=""):
+    def download_product(self, project_name, uri, destination_folder, subpath="", writable=False, files=None):
+        strategy = self._get_materialization(writable)
+        if self.content_addressed:
+            products = self._read_manifest(project_name, uri)["products"]
+            if subpath:
+                subpath = subpath.strip("/")
+                prefix = "/" + subpath
+                if prefix not in products["directories"] and \
+                        not any(x.startswith(prefix + "/") for x in products["files"]):
+                    raise PulseRepositoryError("path does not exists : " + uri + prefix)
+            self._restore_blobs(project_name, select_files(products, files), destination_folder, subpath, strategy)
+            return
+
+        products_path = self._build_commit_path(project_name, "products", uri)
         # build_products_repository_path
-        product_repo_path = os.path.join(self._build_commit_path(project_name, "products", uri), subpath)
+        product_repo_path = os.path.join(products_path, subpath)
         if not os.path.exists(product_repo_path):
             raise PulseRepositoryError("path does not exists : " + product_repo_path)
+        if files is not None:
+            prefix = "/" + subpath.strip("/") if subpath else ""
+            self._restore_files(products_path, destination_folder, files, prefix, strategy)
+            return
         # copy repo products type to products_user_filepath
-        copy_folder_content(product_repo_path, destination_folder)
+        copy_folder_content(
+            product_repo_path, destination_folder, copy_function=self._get_restore_function(strategy))
+
+    def _restore_files(self, repository_folder, destination_folder, files, prefix="", strategy="copy"):
+        """copy some files of a plain repository folder, the prefix is removed from their destination path"""
+        restore_function = self._get_restore_function(strategy)
+        file_pairs = []
+        for filepath_rel in files:
+            source = repository_folder + filepath_rel
+            if not os.path.exists(source):
+                source += compression.COMPRESSED_SUFFIX
+            file_pairs.append((source, destination_folder + filepath_rel[len(prefix):]))
+        fu.map_parallel(lambda pair: restore_function(pair[0], pair[1]), file_pairs)
+
+    def get_manifest(self, project_name, uri):
+        if not self.content_addressed:
+            return None
+        return self._read_manifest(project_name, uri)
 
     def download_resource(self, project_name, uri, destination):
-        copy_folder_content(self._build_resource_path(project_name, uri), destination)
+        if not self.content_addressed:
+            copy_folder_content(
+                self._build_resource_path(project_name, uri),
+                destination,
+                ignore=TRANSFER_LEFTOVERS,
+                copy_function=self._get_restore_function("copy")
+            )
+            return
+        # rebuild the plain layout, so the resource can be uploaded to any other repository
+        resource_path = self._build_resource_path(project_name, uri)
+        if not os.path.exists(resource_path):
+            return
+        for version in os.listdir(resource_path):
+            if version.endswith(fu.STAGING_SUFFIX):
+                continue
+            manifest = self._read_manifest(project_name, uri + "@" + version)
+            for path_type in ["work", "products"]:
+                self._restore_blobs(project_name, manifest[path_type], os.path.join(destination, version, path_type))
 
     def upload_resource(self, project_name, uri, source):
-        copy_folder_content(source, self._build_resource_path(project_name, uri))
+        if not self.content_addressed:
+            resource_path = self._build_resource_path(project_name, uri)
+            copy_folder_content(source, resource_path, copy_function=self._get_store_function())
+            fu.lock_directory_content(resource_path)
+            return
+        if not os.path.exists(source):
+            return
+        for version in os.listdir(source):
+            manifest = {}
+            for path_type in ["work", "products"]:
+                path_root = os.path.join(source, version, path_type)
+                files = fu.get_file_list(path_root) if os.path.isdir(path_root) else {}
+                manifest[path_type] = self._store_blobs(project_name, path_root, files)
+            fu.write_data(self._build_manifest_path(project_name, uri + "@" + version), manifest)
 
     def remove_resource(self, project_name, uri):
-        shutil.rmtree(self._build_resource_path(project_name, uri))
+        fu.remove_tree(self._build_resource_path(project_name, uri))
+
+    def purge_unreferenced_blobs(self, project_name, grace_hours=BLOB_GRACE_HOURS):
+        """
+        remove blobs no commit manifest refers to anymore, as after a resource removal.
+        only meaningful in content addressed mode
+
+        :param grace_hours: the blobs written or reused by a publish since are kept, its manifest may not be written
+         yet
+        :return: the removed blob keys
+        """
+        project_path = os.path.join(os.path.expandvars(self.root), project_name)
+        blobs_path = os.path.join(project_path, BLOBS_DIRECTORY)
+        if not os.path.exists(blobs_path):
+            return []
+        referenced = set()
+        for resource in os.listdir(project_path):
+            if resource == BLOBS_DIRECTORY:
+                continue
+            resource_path = os.path.join(project_path, resource)
+            for version in os.listdir(resource_path):
+                manifest_path = os.path.join(resource_path, version, MANIFEST_FILENAME)
+                if not os.path.exists(manifest_path):
+                    continue
+                manifest = fu.read_data(manifest_path)
+                for path_type in manifest:
+                    referenced.update(manifest[path_type]["files"].values())
+        removed = []
+        now = time.time()
+        for root, directories, files in os.walk(blobs_path):
+            for filename in files:
+                key = filename
+                if key.endswith(compression.COMPRESSED_SUFFIX):
+                    key = key[:-len(compression.COMPRESSED_SUFFIX)]
+                if key in referenced:
+                    continue
+                blob_path = os.path.join(root, filename)
+                try:
+                    if now - os.path.getmtime(blob_path) < grace_hours * 3600:
+                        continue
+                    fu.remove_file(blob_path)
+                except FileNotFoundError:
+                    # a temporary file renamed meanwhile
+                    continue
+                removed.append(key)
+        return removed
@@ -1,221 +1,594 @@
+import io
+import json
 import os
-from pulse.repository_adapters.interface_class import PulseRepository
+import queue
+import socket
+import threading
+import time
+import calendar
 import ftplib
+from pulse.repository_adapter_interface import *
+import pulse.file_utils as fu
+import pulse.compression as compression
 
+DEFAULT_SESSIONS = 4
+SESSION_TIMEOUT = 60
+POOL_TIMEOUT = 300
+JOURNAL_FILENAME = "upload_journal"
+# the "done" records of the journal are appended by batches, an interruption loses at most one batch
+JOURNAL_BATCH_SIZE = 32
+# the start of the uploads from this size is journaled, so they can be resumed. Smaller files are uploaded again
+RESUMABLE_SIZE = 8 * fu.BUFFER_SIZE
+# errors meaning the session is unusable, as when the server has closed an idle connection
+SESSION_ERRORS = (EOFError, ConnectionError, socket.timeout, ftplib.error_reply)
+# reply code of a server closing the session. The other 4xx replies, like "450 file busy", keep the session open
+SERVICE_NOT_AVAILABLE = "421"
 
-def ftp_copytree(source, ftp_connection):
-    files = os.listdir(source)
-    for f in files:
-        fp = os.path.join(source, f)
-        if os.path.isfile(fp):
-            fh = open(fp, 'rb')
-            ftp_connection.storbinary('STOR %s' % f, fh)
-            fh.close()
-        elif os.path.isdir(fp):
-            ftp_connection.mkd(f)
-            ftp_connection.cwd(f)
-            ftp_copytree(fp, ftp_connection)
-    ftp_connection.cwd('..')
+
+def ftp_makedirs(directory, ftp_connection, known_directories=None):
+    """
+    creates a remote directory and its parents if needed.
+    known_directories is an optional set of the directories already created, it saves a MKD per directory
+    """
+    path = "/" if directory.startswith("/") else ""
+    for item in directory.strip("/").split("/"):
+        path += item
+        if known_directories is None or path not in known_directories:
+            try:
+                ftp_connection.mkd(path)
+            except ftplib.error_perm:
+                # the directory already exists
+                pass
+            if known_directories is not None:
+                known_directories.add(path)
+        path += "/"
 
 
-def ftp_cwd_makedirs(directory, ftp_connection):
+def ftp_walk(directory, ftp_connection):
     """
-    change current ftp path to directory
-    creates subsequent directories if needed
-    :param directory:
-    :param ftp_connection:
-    :return:
+    list a remote directory tree with MLSD. Paths are relative to the directory, and start with a slash
+
+    :return: the files dict with their size, and the directories list
     """
-    ftp_connection.cwd('/')
-    try:
-        ftp_connection.cwd(directory)
-    except:
-        splitted_path = os.path.normpath(directory).split(os.sep)
-        try:
-            for item in splitted_path:
-                try:
-                    ftp_connection.cwd(item)
-                except:
-                    ftp_connection.mkd(item)
-                    ftp_connection.cwd(item)
-        except Exception as e:
-            print(e)
-
-def ftp_list_all_files(ftp, path=""):
-    lines = []
-    filenames = []
-    ftp.retrlines("LIST -a " + path, lines.append)
-    for filename in [line.split(' ')[-1] for line in lines]:
-        if filename not in ['.', '..']:
-            filenames.append(filename)
-    return filenames
-
-def ftp_rmtree(path, ftp):
-    """path should be the absolute path to the root FOLDER of the file tree to remove"""
-    try:
-        names = ftp_list_all_files(ftp, path)
-    except ftplib.all_errors as e:
-        print ('FtpRmTree: Could not list {0}: {1}'.format(path, e))
-        return
-
-    for name in names:
+    files = {}
+    directories = []
+    pending = [""]
+    while pending:
+        relative_path = pending.pop()
+        for name, facts in ftp_connection.mlsd(directory + relative_path, facts=["type", "size"]):
+            entry_type = facts.get("type", "").lower()
+            if entry_type == "file":
+                files[relative_path + "/" + name] = int(facts.get("size", -1))
+            elif entry_type == "dir":
+                directories.append(relative_path + "/" + name)
+                pending.append(relative_path + "/" + name)
+    return files, directories
+
+
+def ftp_rmtree(directory, ftp_connection):
+    """remove a remote directory tree"""
+    files, directories = ftp_walk(directory, ftp_connection)
+    for filepath in files:
+        ftp_connection.delete(directory + filepath)
+    # deepest directories first
+    for relative_path in sorted(directories, reverse=True):
+        ftp_connection.rmd(directory + relative_path)
+    ftp_connection.rmd(directory)
+
+
+def ftp_timestamp(modify_fact):
+    """convert a MLSD modify fact, as YYYYMMDDHHMMSS[.sss] in UTC, to a timestamp. Return 0 if it's unknown"""
+    if not modify_fact:
+        return 0
+    return calendar.timegm(time.strptime(modify_fact[:14], "%Y%m%d%H%M%S"))
+
+
+def is_transfer_leftover(path):
+    """return True if the path belongs to an interrupted transfer"""
+    return any(x.endswith((fu.STAGING_SUFFIX, fu.PARTIAL_SUFFIX)) for x in path.split("/"))
+
+
+def list_local_tree(directory):
+    """return the files and directories of a local tree, with the same relative paths as ftp_walk"""
+    files = []
+    directories = []
+    for root, dirs, filenames in os.walk(directory):
+        relative_root = root[len(directory):].replace(os.sep, "/")
+        directories.extend([relative_root + "/" + d for d in dirs])
+        files.extend([relative_root + "/" + f for f in filenames])
+    return files, directories
+
+
+def ftp_delete_files(filepaths, ftp_connection):
+    """remove remote files, the files already missing are ignored"""
+    for filepath in filepaths:
         try:
-            ftp.delete(path + "/" + name)
-        except ftplib.all_errors:
-            ftp_rmtree(path + "/" + name, ftp)
+            ftp_connection.delete(filepath)
+        except ftplib.error_perm:
+            pass
 
-    try:
-        ftp.rmd(path)
-    except ftplib.all_errors as e:
-        raise e
 
+class UploadJournal:
+    """
+    journal of a commit upload, stored in its staging directory as json lines [state, path, checksum key].
+    A file is recorded as "started" before a resumable upload, and as "done" once it's completely uploaded, the last
+    record of a file gives its state. The next upload only trusts the journaled files of the staging directory :
+    the bytes of a "started" file on the server are the beginning of the content with this checksum.
 
-def ftp_download(source, destination, ftp_connection):
-    """path & destination are str of the form "/dir/folder/something/"
-    #path should be the abs path to the root FOLDER of the file tree to download
+    :param repository: the ftp repository
+    :param staging_path: the remote staging directory
+    :param keys: dict of the checksum keys of the uploaded files, by path relative to the staging directory
     """
-    source = source.replace("\\", "/")
-    destination = destination.replace("\\", "/")
-    for filename in ftp_list_all_files(ftp_connection):
-        if filename == "." or filename == "..":
-            continue
-        ftp_path = source + "/" + filename
-        disk_path = (os.path.join(destination, filename))
+    def __init__(self, repository, staging_path, keys):
+        self.repository = repository
+        self.staging_path = staging_path
+        self.path = staging_path + "/" + JOURNAL_FILENAME
+        self.keys = keys
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def read(self):
+        """return the files states, as a dict {path: [state, checksum key]}. Empty if there's no journal"""
+        def operation(ftp_connection):
+            buffer = io.BytesIO()
+            ftp_connection.retrbinary("RETR " + self.path, buffer.write)
+            return buffer.getvalue()
         try:
-            ftp_connection.cwd(ftp_path)
-            if not os.path.exists(disk_path):
-                os.makedirs(disk_path)
-            ftp_download(ftp_path, disk_path, ftp_connection)
-            ftp_connection.cwd(source)
+            data = self.repository._run(operation)
         except ftplib.error_perm:
-            with open(disk_path, "wb") as dest_file:
-                ftp_connection.retrbinary("RETR " + filename, dest_file.write)
+            return {}
+        records = {}
+        # the last line has no end if its append has been interrupted
+        for line in data.decode("utf-8").split("\n")[:-1]:
+            try:
+                state, path, key = json.loads(line)
+            except (ValueError, TypeError):
+                continue
+            records[path] = [state, key]
+        return records
+
+    def write(self, records):
+        """replace the journal content with the given files states, see read"""
+        self._send("STOR", [[state, path, key] for path, (state, key) in records.items()])
+
+    def start(self, remote_path):
+        """record that the upload of a file starts, before it has sent anything"""
+        path = remote_path[len(self.staging_path):]
+        with self._lock:
+            self._send("APPE", [["started", path, self.keys[path]]])
+
+    def done(self, remote_path):
+        """record that a file is completely uploaded"""
+        path = remote_path[len(self.staging_path):]
+        with self._lock:
+            self._pending.append(["done", path, self.keys[path]])
+            if len(self._pending) >= JOURNAL_BATCH_SIZE:
+                self._send("APPE", self._pending)
+                self._pending = []
+
+    def flush(self):
+        """append the records not sent yet"""
+        with self._lock:
+            if self._pending:
+                self._send("APPE", self._pending)
+                self._pending = []
+
+    def _send(self, command, records):
+        data = "".join(json.dumps(x) + "\n" for x in records).encode("utf-8")
+        self.repository._run(
+            lambda ftp_connection: ftp_connection.storbinary(command + " " + self.path, io.BytesIO(data)))
 
 
 class Repository(PulseRepository):
-    def __init__(self, login, password, settings):
+    """
+    store resources on a ftp server, with the same layout as the file_storage repository.
+
+    settings :
+        - host, port : the ftp server address
+        - root : the repository directory on the server, slash separated
+        - sessions : how many ftp sessions are opened to transfer files in parallel, 4 by default
+        - compression : "auto", "zstd", "zlib" or "lzma" to upload files compressed, they are decompressed while
+          they are downloaded. Files already compressed are uploaded as is, see pulse.compression.
+          An interrupted transfer of a compressed file restarts from its beginning
+
+    The server has to support MLSD listing (RFC 3659).
+    Sessions are opened on demand and kept open between transfers. A session closed by the server is replaced
+    by a new one and the transfer is retried once.
+    """
+    def __init__(self, login="", password="", settings=None):
         PulseRepository.__init__(self, login, password, settings)
-        self.root = self.settings["root"]
-        if not self.root.endswith('/'):
-            self.root += '/'
-        self.version_prefix = "V"
-        self.version_padding = 3
-        self.connection = None
-        self._refresh_connection()
+        self.root = self.settings["root"].replace("\\", "/").rstrip("/")
+        self.sessions = int(self.settings.get("sessions", DEFAULT_SESSIONS))
+        self.compression = self.settings.get("compression")
+        self._idle_sessions = queue.LifoQueue()
+        self._sessions_count = 0
+        self._lock = threading.Lock()
 
     def test_settings(self):
-        self._refresh_connection()
+        if self.sessions < 1:
+            raise PulseRepositoryError("at least one ftp session is needed")
+        self._get_codec()
+        self._run(lambda ftp: ftp_makedirs(self.root, ftp))
         return True
 
-    def _refresh_connection(self):
+    def _connect(self):
+        try:
+            ftp_connection = ftplib.FTP(timeout=SESSION_TIMEOUT)
+            ftp_connection.connect(self.settings["host"], int(self.settings["port"]))
+            ftp_connection.login(self.login, self.password)
+        except ftplib.all_errors as ex:
+            raise PulseRepositoryError("can't connect to ftp server : " + str(ex))
+        return ftp_connection
+
+    def _acquire(self):
+        try:
+            return self._idle_sessions.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._sessions_count < self.sessions
+            if can_open:
+                self._sessions_count += 1
+        if can_open:
+            try:
+                return self._connect()
+            except PulseRepositoryError:
+                with self._lock:
+                    self._sessions_count -= 1
+                raise
+        try:
+            return self._idle_sessions.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise PulseRepositoryError("no ftp session available after " + str(POOL_TIMEOUT) + "s")
+
+    def _release(self, ftp_connection):
+        self._idle_sessions.put(ftp_connection)
+
+    def _discard(self, ftp_connection):
         try:
-            self.connection.voidcmd("NOOP")
-        except:
-            self.connection = ftplib.FTP()
-            self.connection.connect(self.settings["host"], self.settings["port"])
-            self.connection.login(self.login, self.password)
-        self.connection.cwd(self.root)
+            ftp_connection.close()
+        except ftplib.all_errors:
+            pass
+        with self._lock:
+            self._sessions_count -= 1
+
+    def close(self, quit_sessions=True):
+        """close the idle sessions, new ones will be opened if the repository is used again"""
+        while True:
+            try:
+                ftp_connection = self._idle_sessions.get_nowait()
+            except queue.Empty:
+                break
+            if quit_sessions:
+                try:
+                    ftp_connection.quit()
+                except ftplib.all_errors:
+                    pass
+            self._discard(ftp_connection)
+
+    def _run(self, operation):
+        """
+        call the operation with a pooled session and return its result.
+        If the session is lost, the other idle sessions are probably lost too : they are all closed, and the
+        operation is called again once on a new session
+        """
+        for attempt in range(2):
+            ftp_connection = self._acquire()
+            try:
+                result = operation(ftp_connection)
+            except (SESSION_ERRORS + (ftplib.error_temp,)) as ex:
+                if isinstance(ex, ftplib.error_temp) and not str(ex).startswith(SERVICE_NOT_AVAILABLE):
+                    # the command has failed temporarily, the session is still usable
+                    self._release(ftp_connection)
+                    raise
+                self._discard(ftp_connection)
+                self.close(quit_sessions=False)
+                if attempt:
+                    raise
+                continue
+            except ftplib.error_perm:
+                # the command has been refused, the session is still usable
+                self._release(ftp_connection)
+                raise
+            except BaseException:
+                self._discard(ftp_connection)
+                raise
+            self._release(ftp_connection)
+            return result
+
+    def _get_codec(self):
+        """return the compression codec for uploaded files, None if they are uploaded as is"""
+        try:
+            return compression.get_codec(self.compression)
+        except ValueError as ex:
+            raise PulseRepositoryError(str(ex))
+
+    def _upload_compressed_file(self, source, destination, codec):
+        """upload a file compressed on the fly, with the compressed suffix added to the destination name"""
+        def operation(ftp_connection):
+            with open(source, "rb") as f:
+                ftp_connection.storbinary(
+                    "STOR " + destination + compression.COMPRESSED_SUFFIX,
+                    compression.CompressedReader(f, codec),
+                    blocksize=fu.BUFFER_SIZE
+                )
+        self._run(operation)
+
+    def _download_compressed_file(self, source, destination):
+        """download a compressed file, decompressed as it comes, to a temporary name renamed once complete"""
+        partial_path = destination + fu.PARTIAL_SUFFIX
+
+        def operation(ftp_connection):
+            with open(partial_path, "wb") as f:
+                writer = compression.DecompressingWriter(f)
+                ftp_connection.retrbinary("RETR " + source, writer.write, blocksize=fu.BUFFER_SIZE)
+                writer.close()
+        self._run(operation)
+        os.replace(partial_path, destination)
+
+    def _upload_file(self, source, destination, offset=0, codec=None):
+        """
+        upload a file, the bytes before offset are already on the server and are not sent again
+
+        :param codec: the codec compressing the file, None to upload it as is
+        """
+        if codec:
+            self._upload_compressed_file(source, destination, codec)
+            return
+        attempts = []
+
+        def operation(ftp_connection):
+            start = offset
+            if attempts:
+                # the session was lost during the upload, resume after the bytes the server has received
+                ftp_connection.voidcmd("TYPE I")
+                try:
+                    start = ftp_connection.size(destination) or 0
+                except ftplib.error_perm:
+                    start = 0
+            attempts.append(start)
+            with open(source, "rb") as f:
+                f.seek(start)
+                ftp_connection.storbinary(
+                    "STOR " + destination, f, blocksize=fu.BUFFER_SIZE, rest=start or None)
+        self._run(operation)
+
+    def _download_file(self, source, destination, size=-1):
+        """
+        download a file to a temporary name, renamed once complete.
+        The bytes received by an interrupted download are kept, the download restarts after them
+        """
+        if source.endswith(compression.COMPRESSED_SUFFIX):
+            self._download_compressed_file(source, destination)
+            return
+        partial_path = destination + fu.PARTIAL_SUFFIX
+
+        def operation(ftp_connection):
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            if offset > size >= 0:
+                offset = 0
+            with open(partial_path, "ab" if offset else "wb") as f:
+                ftp_connection.retrbinary(
+                    "RETR " + source, f.write, blocksize=fu.BUFFER_SIZE, rest=offset or None)
+        self._run(operation)
+        os.replace(partial_path, destination)
+
+    def _upload_files(self, relative_filepath_list, source_root, destination_root, directories=(), offsets=None,
+                      journal=None):
+        """
+        create the destination directories, then upload the files in parallel, each one with a pooled session.
+
+        :param offsets: dict of the bytes already on the server for some files, their upload is resumed after them
+        :param journal: the UploadJournal recording the uploads, if any
+        """
+        offsets = offsets or {}
+        directories = set(directories)
+        directories.update([os.path.dirname(x) for x in relative_filepath_list])
+
+        def make_directories(ftp_connection):
+            known_directories = set()
+            ftp_makedirs(destination_root, ftp_connection, known_directories)
+            for directory in sorted(directories):
+                if directory not in ["", "/"]:
+                    ftp_makedirs(destination_root + directory, ftp_connection, known_directories)
+        self._run(make_directories)
+        codec = self._get_codec()
+
+        def upload(filepath):
+            source = source_root + filepath
+            destination = destination_root + filepath
+            file_codec = codec if codec and compression.is_worth_compressing(source) else None
+            if file_codec and offsets.get(filepath):
+                # the compression settings changed since the interrupted upload, its bytes can't be resumed
+                self._run(lambda ftp_connection: ftp_delete_files([destination], ftp_connection))
+            # an upload resumed from its journaled start keeps its record
+            if journal and not file_codec and not offsets.get(filepath) and os.path.getsize(source) >= RESUMABLE_SIZE:
+                journal.start(destination)
+            self._upload_file(source, destination, offsets.get(filepath, 0), file_codec)
+            if journal:
+                journal.done(destination)
+        fu.map_parallel(upload, relative_filepath_list)
+        if journal:
+            journal.flush()
 
     def _upload_folder(self, source, destination):
         if not os.path.exists(source):
             return
-        source = source.replace("\\", "/")
-        destination = destination.replace("\\", "/")
-        self._refresh_connection()
-        ftp_cwd_makedirs(self.root + destination, self.connection)
-        self.connection.cwd(self.root + destination)
-        ftp_copytree(source, self.connection)
-
-    def _download_folder(self, source, destination):
-        source = source.replace("\\", "/")
-        destination = destination.replace("\\", "/")
-        if not os.path.exists(destination):
-            os.makedirs(destination)
-        self._refresh_connection()
-        self.connection.cwd(self.root + source)
-        ftp_download(self.root + source, destination, self.connection)
-
-    def _build_commit_path(self, path_type, commit):
-        """custom function to build a repository path
+        files, directories = list_local_tree(source)
+        self._upload_files(files, source, destination, directories)
+
+    def _download_folder(self, source, destination, missing_ok=False, selection=None):
+        """
+        download a remote tree, the files already in the destination are kept.
+        If selection is given, only the files whose local relative path is in it are downloaded
         """
-        return os.path.join(
-            self._build_resource_path(path_type, commit.resource),
-            self.version_prefix + str(commit.version).zfill(self.version_padding)
-        ).replace("\\", "/")
-
-    @staticmethod
-    def _build_resource_path(path_type, resource):
-        return os.path.join(
-            resource.project.name,
-            path_type,
-            resource.resource_type,
-            resource.entity.replace(":", "/")
-        ).replace("\\", "/")
-
-    def upload_resource_commit(self, commit, work_folder, work_files, products_folder=None):
-        """create a new resource default folders and file from a resource template
+        try:
+            files, directories = self._run(lambda ftp_connection: ftp_walk(source, ftp_connection))
+        except ftplib.error_perm:
+            if missing_ok:
+                return
+            raise PulseRepositoryError("path does not exists : " + source)
+        for directory in [""] + directories:
+            if not is_transfer_leftover(directory):
+                os.makedirs(destination + directory, exist_ok=True)
+        # compressed files are restored without their suffix
+        local_paths = {}
+        for filepath in files:
+            local_path = filepath
+            if local_path.endswith(compression.COMPRESSED_SUFFIX):
+                local_path = local_path[:-len(compression.COMPRESSED_SUFFIX)]
+            if selection is not None and local_path not in selection:
+                continue
+            if not is_transfer_leftover(filepath) and not os.path.exists(destination + local_path):
+                local_paths[filepath] = local_path
+        fu.map_parallel(
+            lambda x: self._download_file(source + x, destination + local_paths[x], files[x]),
+            local_paths
+        )
+
+    def _build_commit_path(self, project_name, path_type, uri):
+        """custom function to build a repository path
         """
+        return self._build_version_path(project_name, uri) + "/" + path_type
 
-        # create the version folder
-        work_destination = self._build_commit_path("work", commit)
-        self._refresh_connection()
-        version_folder = self.root + work_destination
-        ftp_cwd_makedirs(version_folder, self.connection)
-        self.connection.cwd(version_folder)
-
-        # Copy work files to repo
-        current_directory = version_folder
-        for rel_filepath in work_files:
-            file_dir = os.path.dirname(version_folder + rel_filepath)
-            if file_dir != current_directory:
-                ftp_cwd_makedirs(file_dir, self.connection)
-                current_directory = file_dir
-            filename = os.path.basename(rel_filepath)
-            fp = work_folder + rel_filepath
-            fh = open(fp, 'rb')
-            self.connection.storbinary('STOR %s' % filename, fh)
-            fh.close()
-
-        # Copy products folder to repo
-        if not products_folder or not os.path.exists(products_folder):
-            return True
-        products_destination = self._build_commit_path("products", commit)
-
-        self._upload_folder(products_folder, products_destination)
+    def _build_version_path(self, project_name, uri):
+        resource, version = uri.split("@")
+        return self._build_resource_path(project_name, resource) + "/" + version
+
+    def _build_resource_path(self, project_name, uri):
+        return self.root + "/" + project_name + "/" + uri.replace("/", "~")
+
+    def _list_remote_files(self, directory):
+        """return the files under a remote directory with their size, or None if the directory doesn't exist"""
+        try:
+            return self._run(lambda ftp_connection: ftp_walk(directory, ftp_connection))[0]
+        except ftplib.error_perm:
+            return None
+
+    def upload_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
+        self.stage_resource_commit(project_name, uri, work_root, work_files, product_root, product_files)
+        self.promote_resource_commit(project_name, uri)
         return True
 
-    def download_work(self, commit, work_folder):
-        """build_work_user_filepath
-        """
-        repo_work_path = self._build_commit_path("work", commit)
-        self._download_folder(repo_work_path, work_folder)
-
-    def download_product(self, product, product_folder=None):
-        # build_products_repository_path
-        product_repo_path = self._build_commit_path("products", product.parent) + os.sep + product.product_type
-        if not product_folder:
-            product_folder = product.directory
-        self._download_folder(product_repo_path, product_folder)
-
-    def download_resource(self, resource, destination):
-        resource_product_repo_path = self._build_resource_path("products", resource)
-        resource_work_repo_path = self._build_resource_path("work", resource)
-        self._download_folder(resource_product_repo_path, os.path.join(destination, "products"))
-        self._download_folder(resource_work_repo_path, os.path.join(destination, "work"))
-
-    def upload_resource(self, resource, source):
-        resource_product_repo_path = self._build_resource_path("products", resource)
-        resource_work_repo_path = self._build_resource_path("work", resource)
-        self._upload_folder(os.path.join(source, "products"), resource_product_repo_path)
-        self._upload_folder(os.path.join(source, "work"), resource_work_repo_path)
-
-    def remove_resource(self, resource):
-        self._refresh_connection()
-        ftp_rmtree(self.root + self._build_resource_path("products", resource), self.connection)
-        ftp_rmtree(self.root + self._build_resource_path("work", resource), self.connection)
-
-    def reset_project(self, project):
-        self._refresh_connection()
-        self.connection.cwd(project.name)
-        for directory in self.connection.nlst():
-            ftp_rmtree(self.root + "/" + project.name + "/" + directory, self.connection)
+    def stage_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
+        # the version is uploaded to a staging directory, with a journal of the uploaded files. The publish holds the
+        # commit lock, a staging directory already there has been left by an interrupted publish : only its files
+        # journaled with the same checksum are kept, the others are removed
+        staging_path = self._build_version_path(project_name, uri) + fu.STAGING_SUFFIX
+        path_types = [("work", work_root, work_files), ("products", product_root, product_files)]
+        sources = {}
+        keys = {}
+        for path_type, root, files in path_types:
+            for filepath, entry in files.items():
+                sources["/" + path_type + filepath] = root + filepath
+                keys["/" + path_type + filepath] = fu.checksum_key(entry)
+        journal = UploadJournal(self, staging_path, keys)
+        remote_files = self._list_remote_files(staging_path)
+        records = journal.read() if remote_files else {}
+        remote_files = remote_files or {}
+
+        # the compressed files are stored with a suffix, they are journaled with their path
+        stored_names = {}
+        for stored_name in remote_files:
+            path = stored_name
+            if path.endswith(compression.COMPRESSED_SUFFIX):
+                path = path[:-len(compression.COMPRESSED_SUFFIX)]
+            stored_names.setdefault(path, []).append(stored_name)
+
+        kept_records = {}
+        kept_names = {"/" + JOURNAL_FILENAME}
+        offsets = {}
+        for path, source in sources.items():
+            state, key = records.get(path, [None, None])
+            # a file stored both compressed and as is comes from several attempts, none can be trusted
+            stored_name = stored_names[path][0] if len(stored_names.get(path, [])) == 1 else None
+            if key == keys[path] and state == "done" and stored_name:
+                kept_records[path] = records[path]
+                kept_names.add(stored_name)
+                continue
+            offsets[path] = 0
+            # only the uploads as is can be resumed
+            if key == keys[path] and state == "started" and stored_name == path and \
+                    0 < remote_files[path] < os.path.getsize(source):
+                kept_records[path] = records[path]
+                kept_names.add(stored_name)
+                offsets[path] = remote_files[path]
+        stale_files = [staging_path + x for x in remote_files if x not in kept_names]
+
+        def prepare_staging(ftp_connection):
+            ftp_delete_files(stale_files, ftp_connection)
+            ftp_makedirs(staging_path, ftp_connection)
+        self._run(prepare_staging)
+        journal.write(kept_records)
+        for path_type, root, files in path_types:
+            prefix = "/" + path_type
+            type_offsets = {x[len(prefix):]: offsets[x] for x in offsets if x.startswith(prefix + "/")}
+            self._upload_files(list(type_offsets), root, staging_path + prefix, offsets=type_offsets, journal=journal)
+        return True
+
+    def promote_resource_commit(self, project_name, uri):
+        version_path = self._build_version_path(project_name, uri)
+        staging_path = version_path + fu.STAGING_SUFFIX
+        if self._list_remote_files(staging_path) is None:
+            return
+        if self._list_remote_files(version_path) is not None:
+            # already promoted by someone else, as a publish recovery
+            self.discard_resource_commit(project_name, uri)
+            return
+        # the journal is only needed while the commit is staged
+        self._run(lambda ftp_connection: ftp_delete_files([staging_path + "/" + JOURNAL_FILENAME], ftp_connection))
+        try:
+            self._run(lambda ftp_connection: ftp_connection.rename(staging_path, version_path))
+        except ftplib.error_perm:
+            if self._list_remote_files(version_path) is None:
+                raise
+
+    def discard_resource_commit(self, project_name, uri):
+        staging_path = self._build_version_path(project_name, uri) + fu.STAGING_SUFFIX
+        if self._list_remote_files(staging_path) is not None:
+            self._run(lambda ftp_connection: ftp_rmtree(staging_path, ftp_connection))
+
+    def list_staged_commits(self, project_name):
+        project_path = self.root + "/" + project_name
+
+        def operation(ftp_connection):
+            staged_commits = {}
+            try:
+                resources = [name for name, facts in ftp_connection.mlsd(project_path, facts=["type"])
+                             if facts.get("type", "").lower() == "dir"]
+            except ftplib.error_perm:
+                return staged_commits
+            for resource in resources:
+                for name, facts in ftp_connection.mlsd(project_path + "/" + resource, facts=["type", "modify"]):
+                    if facts.get("type", "").lower() != "dir" or not name.endswith(fu.STAGING_SUFFIX):
+                        continue
+                    uri = resource.replace("~", "/") + "@" + name[:-len(fu.STAGING_SUFFIX)]
+                    staged_commits[uri] = ftp_timestamp(facts.get("modify"))
+            return staged_commits
+        return self._run(operation)
+
+    def download_work(self, project_name, uri, work_folder, files=None):
+        self._download_folder(
+            self._build_commit_path(project_name, "work", uri),
+            work_folder,
+            selection=None if files is None else set(files)
+        )
+
+    def download_product(self, project_name, uri, destination_folder, subpath="", writable=False, files=None):
+        # files are always downloaded as plain copies, writable makes no difference
+        product_repo_path = self._build_commit_path(project_name, "products", uri)
+        prefix = ""
+        if subpath:
+            prefix = "/" + subpath.strip("/")
+            product_repo_path += prefix
+        selection = None if files is None else set(x[len(prefix):] for x in files)
+        self._download_folder(product_repo_path, destination_folder, selection=selection)
+
+    def download_resource(self, project_name, uri, destination):
+        self._download_folder(self._build_resource_path(project_name, uri), destination, missing_ok=True)
+
+    def upload_resource(self, project_name, uri, source):
+        self._upload_folder(source, self._build_resource_path(project_name, uri))
+
+    def remove_resource(self, project_name, uri):
+        self._run(lambda ftp_connection: ftp_rmtree(self._build_resource_path(project_name, uri), ftp_connection))
@@ -0,0 +1,362 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import pulse.file_utils as fu
+import pulse.config as cfg
+from pulse.repository_adapter_interface import *
+
+DEFAULT_QUOTA = 20 * 1024 ** 3
+"""cache size limit in bytes, the least recently used files are evicted beyond"""
+INDEX_FILENAME = "index.sqlite"
+BLOBS_DIRECTORY = "blobs"
+SQL_VARIABLES_CHUNK = 500
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path, quota=DEFAULT_QUOTA):
+    """
+    return the cache stored in a directory. The same instance is shared by all the connections of the process,
+    so its statistics cover all of them
+
+    :param path: the cache directory, environment variables are expanded
+    :param quota: the cache size limit in bytes
+    """
+    path = os.path.abspath(os.path.expandvars(path))
+    with _caches_lock:
+        cache = _caches.get(path)
+        # the cache directory could have been deleted meanwhile, a new index is needed then
+        if cache is None or not os.path.exists(os.path.join(path, INDEX_FILENAME)):
+            if cache:
+                cache.close()
+            cache = _caches[path] = RepositoryCache(path, quota)
+        else:
+            cache.quota = quota
+    return cache
+
+
+class RepositoryCache:
+    """
+    content addressed store of the files downloaded from repositories, shared by all the projects of a workstation.
+    Files are stored once by checksum key (see file_utils.checksum_key), and indexed in a sqlite database with their
+    size and last access time. When the cache exceeds its quota, the least recently used files are evicted.
+    The index also keeps the commits content, for the repositories which can't list it themselves.
+
+    :param path: the cache directory
+    :param quota: the cache size limit in bytes
+    """
+    def __init__(self, path, quota=DEFAULT_QUOTA):
+        self.path = path
+        self.quota = quota
+        self._statistics = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0, "evictions": 0}
+        os.makedirs(os.path.join(self.path, BLOBS_DIRECTORY), exist_ok=True)
+        self._lock = threading.RLock()
+        # the index is shared with the other processes of the workstation, transactions are explicitly opened
+        self.connection = sqlite3.connect(
+            os.path.join(self.path, INDEX_FILENAME), timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS Blob (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS Blob_last_access ON Blob (last_access)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS Manifest (id TEXT PRIMARY KEY, data TEXT)")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def _build_blob_path(self, key):
+        fan_out = key.split("-")[-1][:2]
+        return os.path.join(self.path, BLOBS_DIRECTORY, fan_out, key)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._statistics[name] += value
+
+    def get_statistics(self):
+        """
+        return the cache usage since the process started
+
+        :return: dict with the hits and misses count, the hit_bytes and miss_bytes transferred, the evictions
+         count, the current cache size and its quota
+        """
+        with self._lock:
+            statistics = dict(self._statistics)
+            statistics["size"] = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM Blob").fetchone()[0]
+        statistics["quota"] = self.quota
+        return statistics
+
+    def get_manifest(self, manifest_id):
+        """return a manifest entry recorded by set_manifest, or None if it's unknown"""
+        with self._lock:
+            row = self.connection.execute("SELECT data FROM Manifest WHERE id = ?", (manifest_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_manifest(self, manifest_id, manifest_entry):
+        with self._transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO Manifest (id, data) VALUES (?, ?)", (manifest_id, json.dumps(manifest_entry)))
+
+    def remove_manifests(self, prefix):
+        """forget the manifest entries whose id starts with prefix"""
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM Manifest WHERE substr(id, 1, ?) = ?", (len(prefix), prefix))
+
+    def restore_files(self, files, strategy="reflink"):
+        """
+        copy cached files to their destination
+
+        :param files: list of (key, destination) tuples
+        :param strategy: see file_utils.copy_file. Links would let the cached files be modified
+        :return: the tuples of the files missing from the cache
+        """
+        def restore(item):
+            blob_path = self._build_blob_path(item[0])
+            try:
+                fu.copy_file(blob_path, item[1], strategy)
+            except FileNotFoundError:
+                # not cached, or evicted meanwhile by another process
+                return None
+            return os.path.getsize(item[1])
+
+        sizes = fu.map_parallel(restore, files)
+        hits = [item[0] for item, size in zip(files, sizes) if size is not None]
+        self._count("hits", len(hits))
+        self._count("hit_bytes", sum(size for size in sizes if size is not None))
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.executemany("UPDATE Blob SET last_access = ? WHERE key = ?", [(now, key) for key in hits])
+        return [item for item, size in zip(files, sizes) if size is None]
+
+    def store_files(self, files):
+        """
+        add downloaded files to the cache, they are counted as misses.
+        Then the least recently used files are evicted if the quota is exceeded
+
+        :param files: list of (source, key) tuples
+        """
+        def store(item):
+            blob_path = self._build_blob_path(item[1])
+            size = os.path.getsize(item[0])
+            try:
+                stored_size = os.path.getsize(blob_path)
+            except FileNotFoundError:
+                stored_size = None
+            # a blob of another size is damaged, it's replaced. Concurrent stores each write their own temporary
+            # file, the blob is always complete
+            if stored_size != size:
+                fu.copy_file(item[0], blob_path, "reflink")
+            return size
+
+        # identical files are stored once
+        blobs = list({key: (source, key) for source, key in files}.values())
+        sizes = fu.map_parallel(store, blobs)
+        self._count("misses", len(files))
+        self._count("miss_bytes", sum(os.path.getsize(source) for source, key in files))
+        now = time.time()
+        with self._transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO Blob (key, size, last_access) VALUES (?, ?, ?)",
+                [(item[1], size, now) for item, size in zip(blobs, sizes)]
+            )
+        self.evict()
+
+    def evict(self, quota=None):
+        """
+        remove the least recently used files until the cache size is under the quota
+
+        :param quota: the size to reach, the cache quota if not set
+        :return: the number of evicted files
+        """
+        if quota is None:
+            quota = self.quota
+        with self._transaction() as cursor:
+            excess = cursor.execute("SELECT COALESCE(SUM(size), 0) FROM Blob").fetchone()[0] - quota
+            evicted = []
+            if excess > 0:
+                for key, size in cursor.execute("SELECT key, size FROM Blob ORDER BY last_access"):
+                    if excess <= 0:
+                        break
+                    evicted.append(key)
+                    excess -= size
+            for index in range(0, len(evicted), SQL_VARIABLES_CHUNK):
+                chunk = evicted[index:index + SQL_VARIABLES_CHUNK]
+                cursor.execute("DELETE FROM Blob WHERE key IN (" + ", ".join(["?"] * len(chunk)) + ")", chunk)
+        for key in evicted:
+            try:
+                os.remove(self._build_blob_path(key))
+            except FileNotFoundError:
+                pass
+        self._count("evictions", len(evicted))
+        return len(evicted)
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedRepository(PulseRepository):
+    """
+    read through cache wrapping any repository : downloaded files are kept in a RepositoryCache, and the next
+    downloads of identical files, from any version, resource or project, are served from it.
+
+    The work downloads are given the commit files checksums, as recorded in the database. For the products, if the
+    repository can list a commit files checksums (see PulseRepository.get_manifest), the cache is used from the first
+    download of a version. Otherwise the files are hashed once downloaded, and the version is served from the cache
+    the next times. The recorded manifests are forgotten when their resource is removed or uploaded again.
+    Uploads go straight to the repository.
+
+    :param repository: the wrapped repository
+    :param cache: RepositoryCache
+    """
+    def __init__(self, repository, cache):
+        PulseRepository.__init__(self, repository.login, repository.password, repository.settings)
+        self.repository = repository
+        self.cache = cache
+        # manifests are recorded in the machine wide cache, they are identified by the repository location
+        identity = json.dumps([type(repository).__module__, repository.settings], sort_keys=True)
+        self._identity = hashlib.md5(identity.encode("utf-8")).hexdigest()
+
+    def __getattr__(self, name):
+        # adapter specific methods and attributes are the wrapped repository ones
+        if name == "repository":
+            raise AttributeError(name)
+        return getattr(self.repository, name)
+
+    def test_settings(self):
+        return self.repository.test_settings()
+
+    def upload_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
+        return self.repository.upload_resource_commit(
+            project_name, uri, work_root, work_files, product_root, product_files)
+
+    def stage_resource_commit(self, project_name, uri, work_root, work_files, product_root, product_files):
+        return self.repository.stage_resource_commit(
+            project_name, uri, work_root, work_files, product_root, product_files)
+
+    def promote_resource_commit(self, project_name, uri):
+        self.repository.promote_resource_commit(project_name, uri)
+
+    def discard_resource_commit(self, project_name, uri):
+        self.repository.discard_resource_commit(project_name, uri)
+
+    def list_staged_commits(self, project_name):
+        return self.repository.list_staged_commits(project_name)
+
+    def download_work(self, project_name, uri, work_folder, files=None, checksums=None):
+        """
+        :param checksums: the commit files entries, as PublishedVersion.files. If set, the files keys are taken from
+         them, the commit manifest is neither read nor recorded
+        """
+        self._download(project_name, uri, "work", work_folder, files=files, checksums=checksums)
+
+    def download_product(self, project_name, uri, destination_folder, subpath="", writable=False, files=None):
+        self._download(project_name, uri, "products", destination_folder, subpath, writable, files)
+
+    def download_resource(self, project_name, uri, destination):
+        self.repository.download_resource(project_name, uri, destination)
+
+    def upload_resource(self, project_name, uri, source):
+        self.forget_manifests(project_name, uri)
+        self.repository.upload_resource(project_name, uri, source)
+
+    def remove_resource(self, project_name, uri):
+        # a resource created again with the same uri will have other commits
+        self.forget_manifests(project_name, uri)
+        self.repository.remove_resource(project_name, uri)
+
+    def get_manifest(self, project_name, uri):
+        return self.repository.get_manifest(project_name, uri)
+
+    def _get_manifest_id(self, project_name, uri, path_type):
+        return "/".join([self._identity, project_name, uri, path_type])
+
+    def forget_manifests(self, project_name, uri=None):
+        """
+        forget the recorded manifests of a resource commits, or of a whole project if uri is None
+        """
+        prefix = self._identity + "/" + project_name + "/"
+        if uri is not None:
+            prefix += uri + "@"
+        self.cache.remove_manifests(prefix)
+
+    def _get_manifest_entry(self, project_name, uri, path_type):
+        """return the files keys of a commit work or products, None if they are still unknown"""
+        manifest_id = self._get_manifest_id(project_name, uri, path_type)
+        entry = self.cache.get_manifest(manifest_id)
+        if entry is None:
+            manifest = self.repository.get_manifest(project_name, uri)
+            if manifest is not None:
+                # a commit never changes, its manifest can be kept
+                for key in ["work", "products"]:
+                    self.cache.set_manifest(self._get_manifest_id(project_name, uri, key), manifest[key])
+                entry = manifest[path_type]
+        return entry
+
+    def _download_from_repository(self, project_name, uri, path_type, destination, subpath, writable, files):
+        if path_type == "work":
+            self.repository.download_work(
+                project_name, uri, destination, **supported_arguments(self.repository.download_work, files=files))
+        else:
+            self.repository.download_product(
+                project_name, uri, destination, subpath,
+                **supported_arguments(self.repository.download_product, writable=writable, files=files)
+            )
+
+    def _download(self, project_name, uri, path_type, destination, subpath="", writable=False, files=None,
+                  checksums=None):
+        if checksums is not None:
+            entry = {"files": {x: fu.checksum_key(y) for x, y in checksums.items()}, "directories": []}
+        else:
+            entry = self._get_manifest_entry(project_name, uri, path_type)
+        if entry is None:
+            self._download_from_repository(project_name, uri, path_type, destination, subpath, writable, files)
+            # only a complete download describes the whole commit
+            if files is None and not subpath:
+                self._index_download(project_name, uri, path_type, destination)
+            return
+
+        prefix = "/" + subpath.strip("/") if subpath else ""
+        if prefix and prefix not in entry["directories"] and \
+                not any(x.startswith(prefix + "/") for x in entry["files"]):
+            raise PulseRepositoryError("path does not exists : " + uri + prefix)
+        os.makedirs(destination, exist_ok=True)
+        for rel_dir in entry["directories"]:
+            if rel_dir.startswith(prefix + "/"):
+                os.makedirs(destination + rel_dir[len(prefix):], exist_ok=True)
+
+        # the files already in the destination are kept
+        wanted = {}
+        for filepath_rel, key in entry["files"].items():
+            if not filepath_rel.startswith(prefix + "/") or (files is not None and filepath_rel not in files):
+                continue
+            if not os.path.exists(destination + filepath_rel[len(prefix):]):
+                wanted[destination + filepath_rel[len(prefix):]] = (filepath_rel, key)
+        missing = self.cache.restore_files([(key, path) for path, (filepath_rel, key) in wanted.items()])
+        if not missing:
+            return
+        self._download_from_repository(
+            project_name, uri, path_type, destination, subpath, writable, [wanted[path][0] for key, path in missing])
+        self.cache.store_files([(path, key) for key, path in missing])
+
+    def _index_download(self, project_name, uri, path_type, destination):
+        """hash a commit downloaded without its files keys, store its files and record its manifest"""
+        excluded_directories = [cfg.work_output_dir, cfg.work_input_dir] if path_type == "work" else []
+        files = fu.get_file_list(destination, excluded_directories)
+        entry = {
+            "files": {x: fu.checksum_key(files[x]) for x in files},
+            "directories": fu.get_directory_list(destination, excluded_directories)
+        }
+        self.cache.store_files([(destination + x, key) for x, key in entry["files"].items()])
+        self.cache.set_manifest(self._get_manifest_id(project_name, uri, path_type), entry)
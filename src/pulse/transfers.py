@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_TRANSFERS = 8
+"""maximum number of transfers running at the same time, all repositories together"""
+DEFAULT_REPOSITORY_TRANSFERS = 4
+"""maximum number of transfers running at the same time on one repository, if its settings don't set
+ max_transfers"""
+
+
+class TransferScheduler:
+    """
+    run transfers concurrently, with a limit of simultaneous transfers for each repository.
+
+    Transfers run in the scheduler own threads : they copy their files with the file_utils shared pool, a
+    transfer waiting for this pool from one of its threads could starve it.
+
+    :param max_transfers: maximum number of transfers running at the same time
+    :param repository_limits: dict of the maximum number of simultaneous transfers, by repository name.
+     Repositories not listed use DEFAULT_REPOSITORY_TRANSFERS
+    :param progress_callback: called after each transfer, with the number of transfers done, the transfers
+     count, and the description of the transfer which has just ended
+    """
+    def __init__(self, max_transfers=DEFAULT_MAX_TRANSFERS, repository_limits=None, progress_callback=None):
+        self.max_transfers = max(1, max_transfers)
+        self.repository_limits = repository_limits or {}
+        self.progress_callback = progress_callback
+        self._pending = OrderedDict()
+        self._count = 0
+
+    def add(self, repository_name, function, description=""):
+        """
+        register a transfer, it will be run by run()
+
+        :param repository_name: the repository the transfer is made with
+        :param function: a callable without argument doing the transfer
+        :param description: text passed to the progress callback
+        """
+        self._pending.setdefault(repository_name, deque()).append((self._count, function, description))
+        self._count += 1
+
+    def _get_limit(self, repository_name):
+        return max(1, self.repository_limits.get(repository_name, DEFAULT_REPOSITORY_TRANSFERS))
+
+    def run(self):
+        """
+        run all the registered transfers, and wait for them.
+        If transfers fail, the others still run, then the error of the first one added is raised
+
+        :return: the transfers results, in the order they were added
+        """
+        total = self._count
+        results = [None] * total
+        errors = []
+        done_count = 0
+        running = {}
+        active = {name: 0 for name in self._pending}
+        with ThreadPoolExecutor(max_workers=min(self.max_transfers, total) or 1) as executor:
+            while self._pending or running:
+                # start the transfers allowed by the global and the repository limits
+                for repository_name in list(self._pending):
+                    transfers = self._pending[repository_name]
+                    while transfers and active[repository_name] < self._get_limit(repository_name) \
+                            and len(running) < self.max_transfers:
+                        index, function, description = transfers.popleft()
+                        running[executor.submit(function)] = (index, repository_name, description)
+                        active[repository_name] += 1
+                    if not transfers:
+                        self._pending.pop(repository_name)
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, repository_name, description = running.pop(future)
+                    active[repository_name] -= 1
+                    try:
+                        results[index] = future.result()
+                    except Exception as ex:
+                        errors.append((index, ex))
+                    done_count += 1
+                    if self.progress_callback:
+                        self.progress_callback(done_count, total, description)
+        self._count = 0
+        if errors:
+            raise min(errors, key=lambda x: x[0])[1]
+        return results
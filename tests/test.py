@@ -1,9 +1,32 @@
 from pulse.api import *
 import pulse.uri_standards as uri
 import unittest
+from unittest import mock
 import os
 import utils
 import sys
+import time
+import shutil
+import pulse.compression as compression
+import threading
+import multiprocessing
+import ftplib
+from pulse.transfers import TransferScheduler
+from pulse.repository_adapter_interface import supported_arguments
+import pulse.repository_cache as repository_cache
+import pulse.object_cache as object_cache
+import pulse.manifest as manifest
+import pulse.database_adapters.json_db as json_db
+import pulse.repository_adapters.ftp as ftp
+import json
+try:
+    import pyftpdlib
+except ImportError:
+    pyftpdlib = None
+try:
+    import pulse.database_adapters.mysql as mysql_adapter
+except ImportError:
+    mysql_adapter = None
 test_project_name = "test"
 
 
@@ -118,6 +141,519 @@ class TestProjectSettings(unittest.TestCase):
         surf_work.publish()
 
 
+class TestFileUtils(unittest.TestCase):
+    def setUp(self):
+        utils.reset_test_data()
+        self.source = os.path.join(utils.test_data_output_path, "source")
+        for index in range(20):
+            filepath = utils.add_file_to_directory(os.path.join(self.source, "sub" + str(index % 3)), str(index))
+            with open(filepath, "w") as f:
+                f.write(str(index) * index)
+
+    def test_parallel_file_list(self):
+        with mock.patch.object(fu, "_max_workers", 1):
+            sequential = fu.get_file_list(self.source)
+        self.assertEqual(fu.get_file_list(self.source), sequential)
+        self.assertEqual(len(sequential), 20)
+
+    def test_thread_pool_size_is_fixed_once_started(self):
+        self.assertEqual(fu.map_parallel(len, ["a", "bb"]), [1, 2])
+        # the connections of the process share the pool, a running transfer could still be using it
+        fu.set_max_workers(fu.get_max_workers())
+        with self.assertRaises(ValueError):
+            fu.set_max_workers(fu.get_max_workers() + 1)
+        with self.assertRaises(PulseError):
+            Connection(adapter="json_db", path=utils.json_db_path, max_workers=fu.get_max_workers() + 1)
+        self.assertEqual(Connection(adapter="json_db", path=utils.json_db_path).max_workers, fu.get_max_workers())
+
+    def test_parallel_copytree(self):
+        destination = os.path.join(utils.test_data_output_path, "destination")
+        utils.add_file_to_directory(os.path.join(destination, "sub1"), "1")
+        fu.copytree(self.source, destination)
+        # existing files are kept
+        with open(os.path.join(destination, "sub1", "1"), "r") as f:
+            self.assertEqual(f.read(), "")
+        self.assertEqual(len(fu.get_file_list(destination)), 20)
+        self.assertEqual(fu.get_file_list(destination)["/sub2/5"], fu.get_file_list(self.source)["/sub2/5"])
+
+    def test_staging_directory(self):
+        destination = os.path.join(utils.test_data_output_path, "destination")
+        with self.assertRaises(ConnectionError):
+            with fu.staging_directory(destination) as staging:
+                fu.copy_file(os.path.join(self.source, "sub1", "1"), os.path.join(staging, "1"))
+                raise ConnectionError("transfer interrupted")
+        self.assertFalse(os.path.exists(destination))
+        # the next transfer resumes from the complete files
+        with fu.staging_directory(destination) as staging:
+            self.assertTrue(os.path.exists(os.path.join(staging, "1")))
+            fu.copy_file(os.path.join(self.source, "sub2", "2"), os.path.join(staging, "2"))
+        self.assertEqual(sorted(os.listdir(destination)), ["1", "2"])
+        self.assertFalse(os.path.exists(destination + fu.STAGING_SUFFIX))
+
+    def test_concurrent_data_updates(self):
+        counter_path = os.path.join(utils.test_data_output_path, "counter.json")
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=utils.increment_counter, args=(counter_path, 50)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(120)
+            self.assertEqual(process.exitcode, 0)
+        # no update has been lost, and no temporary file is left
+        self.assertEqual(fu.read_data(counter_path), 200)
+        self.assertEqual(
+            sorted(os.listdir(utils.test_data_output_path)), ["counter.json", "counter.json.lock", "source"])
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        utils.reset_test_data()
+        self.source = os.path.join(utils.test_data_output_path, "scene.abc")
+        with open(self.source, "wb") as f:
+            f.write(b"vertex 0.0 1.0 2.0\n" * 10000)
+
+    def test_codecs_round_trip(self):
+        for codec in compression.CODECS:
+            compressed = os.path.join(utils.test_data_output_path, codec + compression.COMPRESSED_SUFFIX)
+            restored = os.path.join(utils.test_data_output_path, codec, "scene.abc")
+            compression.compress_file(self.source, compressed, codec)
+            self.assertLess(os.path.getsize(compressed), os.path.getsize(self.source) / 10)
+            compression.decompress_file(compressed, restored)
+            self.assertEqual(fu.md5(restored), fu.md5(self.source))
+
+    def test_streamed_decompression(self):
+        with open(self.source, "rb") as f:
+            data = compression.CompressedReader(f, "zlib").read()
+        restored = os.path.join(utils.test_data_output_path, "restored.abc")
+        with open(restored, "wb") as f:
+            writer = compression.DecompressingWriter(f)
+            # the header is split between several writes
+            for index in range(0, len(data), 3):
+                writer.write(data[index:index + 3])
+            writer.close()
+        self.assertEqual(fu.md5(restored), fu.md5(self.source))
+
+    def test_already_compressed_files_are_skipped(self):
+        self.assertTrue(compression.is_worth_compressing(self.source))
+        random_file = os.path.join(utils.test_data_output_path, "noise.exr")
+        with open(random_file, "wb") as f:
+            f.write(os.urandom(100000))
+        self.assertFalse(compression.is_worth_compressing(random_file))
+        picture = os.path.join(utils.test_data_output_path, "picture.jpg")
+        shutil.copyfile(self.source, picture)
+        self.assertFalse(compression.is_worth_compressing(picture))
+        stored = compression.store_file(picture, os.path.join(utils.test_data_output_path, "repo", "picture.jpg"),
+                                        "zlib")
+        self.assertFalse(stored.endswith(compression.COMPRESSED_SUFFIX))
+
+
+class TestTransferScheduler(unittest.TestCase):
+    def test_repository_limits(self):
+        lock = threading.Lock()
+        running = {"a": 0, "b": 0}
+        peaks = {"a": 0, "b": 0}
+
+        def transfer(repository_name, index):
+            with lock:
+                running[repository_name] += 1
+                peaks[repository_name] = max(peaks[repository_name], running[repository_name])
+            time.sleep(0.02)
+            with lock:
+                running[repository_name] -= 1
+            return repository_name + str(index)
+
+        progress = []
+        scheduler = TransferScheduler(
+            max_transfers=4, repository_limits={"a": 1}, progress_callback=lambda *args: progress.append(args))
+        for index in range(6):
+            repository_name = "a" if index % 2 else "b"
+            scheduler.add(repository_name, lambda r=repository_name, i=index: transfer(r, i), str(index))
+        self.assertEqual(scheduler.run(), ["b0", "a1", "b2", "a3", "b4", "a5"])
+        self.assertEqual(peaks["a"], 1)
+        self.assertGreater(peaks["b"], 1)
+        self.assertEqual([x[:2] for x in progress], [(x, 6) for x in range(1, 7)])
+
+    def test_errors_are_raised_after_all_transfers(self):
+        done = []
+
+        def failing_transfer():
+            raise PulseRepositoryError("transfer failed")
+        scheduler = TransferScheduler()
+        scheduler.add("a", failing_transfer)
+        scheduler.add("a", lambda: done.append(True))
+        with self.assertRaises(PulseRepositoryError):
+            scheduler.run()
+        self.assertEqual(done, [True])
+
+
+class TestObjectCache(unittest.TestCase):
+    def test_expiration(self):
+        cache = object_cache.ObjectCache(ttl=0.2)
+        cache.set("Resource", "anna-mdl", {"metas": {}})
+        cache.set("PublishedVersion", "anna-mdl@1", {"version": 1})
+        # the mutable objects data can't be changed through the cache
+        cache.get("Resource", "anna-mdl")["metas"]["site"] = "Paris"
+        self.assertEqual(cache.get("Resource", "anna-mdl"), {"metas": {}})
+        time.sleep(0.3)
+        # published versions never expire
+        self.assertIsNone(cache.get("Resource", "anna-mdl"))
+        self.assertEqual(cache.get("PublishedVersion", "anna-mdl@1"), {"version": 1})
+        cache.invalidate("PublishedVersion")
+        self.assertIsNone(cache.get("PublishedVersion", "anna-mdl@1"))
+        self.assertEqual(cache.get_statistics(), {"hits": 3, "misses": 2, "size": 0, "ttl": 0.2})
+
+    def test_least_recently_used_entries_are_removed(self):
+        cache = object_cache.ObjectCache(max_entries=2)
+        for version in [1, 2]:
+            cache.set("PublishedVersion", "anna-mdl@" + str(version), {"version": version, "work_inputs": {}})
+        # the immutable objects data can't be changed through the cache either
+        cache.get("PublishedVersion", "anna-mdl@1")["work_inputs"]["rig"] = "anna-rig@1"
+        cache.set("PublishedVersion", "anna-mdl@3", {"version": 3, "work_inputs": {}})
+        self.assertEqual(cache.get("PublishedVersion", "anna-mdl@1"), {"version": 1, "work_inputs": {}})
+        self.assertIsNone(cache.get("PublishedVersion", "anna-mdl@2"))
+        self.assertEqual(cache.get_statistics()["size"], 2)
+
+
+class TestManifest(unittest.TestCase):
+    def test_round_trip(self):
+        files = {
+            "/seq/shot.0001.exr": {"checksum": "0cc175b9c0f1b6a831c399e269772661", "algorithm": "md5",
+                                   "size": 1024, "mtime": 1700000000123456789},
+            "/seq/shot.0002.exr": {"checksum": "92eb5ffee6ae2fec3ad71c777531578f", "algorithm": "md5",
+                                   "size": 0, "mtime": 1700000000123456790},
+            "/seq/café.txt": {"checksum": "4a8a08f09d37b73795649038408b5f33", "algorithm": "blake2b",
+                                  "size": 12, "mtime": 0},
+            # entries written before algorithms, sizes and modification times were recorded
+            "/legacy.ma": {"checksum": "8277e0910d750195b448797616e091ad"},
+            "/custom.ma": {"checksum": "not-an-hex-checksum", "algorithm": "custom"},
+            "/upper.ma": {"checksum": "8277E0910D750195B448797616E091AD"}
+        }
+        encoded = manifest.encode_files(files)
+        self.assertTrue(manifest.is_encoded(encoded))
+        self.assertTrue(encoded.startswith(manifest.FORMAT_TAG))
+        self.assertEqual(manifest.decode_files(encoded), files)
+        self.assertEqual(manifest.decode_files(manifest.encode_files({})), {})
+        self.assertFalse(manifest.is_encoded(files))
+        with self.assertRaises(ValueError):
+            manifest.encode_files({"/a.ma": {"checksum": "abc", "comment": "custom key"}})
+        with self.assertRaises(ValueError):
+            manifest.decode_files(manifest.FORMAT_PREFIX + "99:" + encoded[len(manifest.FORMAT_TAG):])
+
+    def test_fixture_manifests(self):
+        # manifests are stored in the shared database, they must decode the same on every platform
+        files = {
+            "/work.blend": {"checksum": "0cc175b9c0f1b6a831c399e269772661", "algorithm": "md5", "size": 1,
+                            "mtime": 1700000000000000000},
+            "/textures/wood.png": {"checksum": "1234", "size": 2048},
+            "/textures/wood.tx": {"checksum": "not hex"}
+        }
+        payload = (
+            "eAFjZoAAFihtAKUloTQblGaG0jxQWgKN5spNMdUvSa0oKS1KLdYvz89P0SvIS2dAEyqpYADKFWXrJeWk5qUImeTllyhkpFbwH"
+            "CzdeeDjthWGh2c+yixXSwSZzcjAzMDOBGSwA7EASIQDRCAAI4KJxtIy+zdnujgAJM0iPw=="
+        )
+        self.assertEqual(manifest.encode_files(files), "pulse-files-1:" + payload)
+        self.assertEqual(manifest.decode_files("pulse-files-1:" + payload), files)
+
+    def test_entries_are_built_on_access(self):
+        files = {"/seq/shot.%04d.exr" % x: {"checksum": "%032x" % x, "algorithm": "md5", "size": x} for x in range(100)}
+        decoded = manifest.decode_files(manifest.encode_files(files))
+        self.assertEqual(len(decoded), 100)
+        self.assertIn("/seq/shot.0042.exr", decoded)
+        self.assertNotIn("/seq/shot.0100.exr", decoded)
+        self.assertEqual(list(decoded), sorted(files))
+        self.assertEqual(dict(decoded.items()), files)
+        self.assertEqual(list(decoded.values()), [files[x] for x in sorted(files)])
+        # each access returns a new entry, changing it doesn't change the manifest
+        decoded["/seq/shot.0042.exr"]["size"] = 0
+        self.assertEqual(decoded["/seq/shot.0042.exr"]["size"], 42)
+        with self.assertRaises(KeyError):
+            decoded["/missing.exr"]
+
+
+class TestJsonDatabaseLayout(unittest.TestCase):
+    def setUp(self):
+        utils.reset_test_data()
+        self.db = json_db.Database(path=utils.json_db_path)
+
+    def test_migrate_flat_project(self):
+        # projects created before the sharded layout have no layout file
+        os.makedirs(os.path.join(utils.json_db_path, "Project", test_project_name))
+        self.assertEqual(self.db.get_project_layout(test_project_name), json_db.FLAT_LAYOUT)
+        self.db.create(test_project_name, "Resource", "anna-mdl", {"last_version": 2})
+        self.db.create(test_project_name, "Resource", "_template:mdl", {"last_version": 0})
+        for uri in ["anna-mdl@1", "anna-mdl@2", "bob-rig@1"]:
+            self.db.create(test_project_name, "PublishedVersion", uri, {"version": int(uri[-1])})
+        flat_filepath = os.path.join(
+            utils.json_db_path, "Project", test_project_name, "PublishedVersion", "anna-mdl@1.json")
+        self.assertTrue(os.path.exists(flat_filepath))
+        patterns = {
+            "Resource": ["*", "anna*", "_template:mdl", "missing"],
+            "PublishedVersion": ["*", "anna-mdl@*", "*@1", "anna-mdl@2", "b*"]
+        }
+        flat_uris = {(x, y): sorted(self.db.find_uris(test_project_name, x, y)) for x in patterns for y in patterns[x]}
+
+        self.assertEqual(self.db.migrate_project(test_project_name), 5)
+        self.assertFalse(os.path.exists(flat_filepath))
+        # the migration is seen by another client, and can be run again
+        self.db = json_db.Database(path=utils.json_db_path)
+        self.assertEqual(self.db.get_project_layout(test_project_name), json_db.SHARDED_LAYOUT)
+        self.assertEqual(self.db.migrate_project(test_project_name), 0)
+        for entity_type, pattern in flat_uris:
+            self.assertEqual(
+                sorted(self.db.find_uris(test_project_name, entity_type, pattern)), flat_uris[(entity_type, pattern)])
+        self.assertEqual(self.db.read(test_project_name, "Resource", "_template:mdl"), {"last_version": 0})
+        self.assertEqual(
+            self.db.list_objects(test_project_name, "PublishedVersion", "anna-mdl@*", fields=["version"]),
+            {"anna-mdl@1": {"version": 1}, "anna-mdl@2": {"version": 2}}
+        )
+
+        # the new objects are indexed, and the versions of a resource are grouped in its directory
+        self.db.create(test_project_name, "PublishedVersion", "anna-mdl@3", {"version": 3})
+        self.assertEqual(self.db.get_last_version(test_project_name, "anna-mdl"), 3)
+        self.assertIn("anna-mdl@3", self.db.find_uris(test_project_name, "PublishedVersion", "an*"))
+        version_filepath = self.db._get_json_filepath(test_project_name, "PublishedVersion", "anna-mdl@3")
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(version_filepath))), ["1.json", "2.json", "3.json", "objects.lock"])
+
+    def test_objects_share_their_directory_lock(self):
+        self.db.create_project(test_project_name)
+        for version in range(1, 4):
+            self.db.create(test_project_name, "PublishedVersion", "anna-mdl@" + str(version), {"version": version})
+        self.db.update(test_project_name, "PublishedVersion", "anna-mdl@1", {"version": 0})
+        self.assertTrue(self.db.compare_and_set(
+            test_project_name, "PublishedVersion", "anna-mdl@2", {"version": 2}, {"version": 4}))
+        version_filepath = self.db._get_json_filepath(test_project_name, "PublishedVersion", "anna-mdl@1")
+        # a single lock file is added to the directory, whatever its objects count
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(version_filepath))), ["1.json", "2.json", "3.json", "objects.lock"])
+
+
+class TestRepositoryCache(unittest.TestCase):
+    def setUp(self):
+        utils.reset_test_data()
+        self.cache = repository_cache.RepositoryCache(os.path.join(utils.test_data_output_path, "cache"), quota=250)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def _create_file(self, name, size=100):
+        filepath = os.path.join(utils.test_data_output_path, name)
+        with open(filepath, "wb") as f:
+            f.write(os.urandom(size))
+        return filepath, fu.md5(filepath)
+
+    def test_least_recently_used_files_are_evicted(self):
+        files = [self._create_file(name) for name in ["a", "b", "c"]]
+        restored_path = os.path.join(utils.test_data_output_path, "restored")
+        self.cache.store_files(files[:2])
+        time.sleep(0.01)
+        # "a" is read again, "b" becomes the least recently used file
+        self.assertEqual(self.cache.restore_files([(files[0][1], restored_path)]), [])
+        with open(restored_path, "rb") as restored_file, open(files[0][0], "rb") as source_file:
+            self.assertEqual(restored_file.read(), source_file.read())
+        time.sleep(0.01)
+        self.cache.store_files(files[2:])
+        missing = self.cache.restore_files([(key, restored_path + key) for filepath, key in files])
+        self.assertEqual(missing, [(files[1][1], restored_path + files[1][1])])
+        statistics = self.cache.get_statistics()
+        self.assertEqual(statistics["hits"], 3)
+        self.assertEqual(statistics["misses"], 3)
+        self.assertEqual(statistics["evictions"], 1)
+        self.assertEqual(statistics["size"], 200)
+
+    def test_stored_blobs_are_complete(self):
+        filepath, key = self._create_file("a")
+        blob_path = self.cache._build_blob_path(key)
+        self.cache.store_files([(filepath, key)])
+        # a damaged blob is replaced when the file is stored again
+        with open(blob_path, "r+b") as blob_file:
+            blob_file.truncate(10)
+        # the temporary file of another writer storing the same blob is left alone
+        other_partial_path = blob_path + fu.PARTIAL_SUFFIX
+        with open(other_partial_path, "wb") as other_partial_file:
+            other_partial_file.write(b"partial")
+        self.cache.store_files([(filepath, key)])
+        with open(blob_path, "rb") as blob_file, open(filepath, "rb") as source_file:
+            self.assertEqual(blob_file.read(), source_file.read())
+        self.assertTrue(os.path.exists(other_partial_path))
+        self.assertEqual(self.cache.get_statistics()["size"], 100)
+
+
+@unittest.skipIf(mysql_adapter is None, "mysql connector is not installed")
+class TestMysqlSessions(unittest.TestCase):
+    def setUp(self):
+        self.server = utils.FakeMysqlServer(self._answer)
+        self.rows = {}
+        patcher = mock.patch.object(mysql_adapter.mariadb, "connect", side_effect=self.server.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = mysql_adapter.Database("localhost", "tester", "secret", {"pool_size": 2})
+        self.server.statements.clear()
+
+    def _answer(self, cmd, parameters):
+        # the rows are (lock_state, lock_user) tuples by uri
+        if cmd.startswith("SELECT") and parameters:
+            uri = parameters[0]
+            return ["lock_state", "lock_user", "uri"], [self.rows[uri] + (uri,)] if uri in self.rows else [], 1
+        if cmd.startswith("INSERT"):
+            if parameters[-1] in self.rows:
+                raise mysql_adapter.mariadb.IntegrityError(msg="duplicate entry")
+            self.rows[parameters[-1]] = tuple(parameters[:2])
+            return [], [], 1
+        if cmd.startswith("UPDATE"):
+            data, uri, expected = tuple(parameters[:2]), parameters[2], tuple(parameters[3:])
+            if self.rows.get(uri) != expected:
+                return [], [], 0
+            self.rows[uri] = data
+            return [], [], 1
+        return [], [], 0
+
+    def _lose_connection(self, applied, errno=mysql_adapter and mysql_adapter.errorcode.CR_SERVER_LOST):
+        self.server.failures.append((mysql_adapter.mariadb.InterfaceError(errno=errno), applied))
+
+    def _count(self, statement_start):
+        return len([x for x in self.server.statements if x.startswith(statement_start)])
+
+    def test_sessions_are_pooled(self):
+        self.db.get_projects()
+        self.db.get_projects()
+        self.assertEqual(len(self.server.connections), 1)
+        sessions = [self.db._acquire(), self.db._acquire()]
+        self.assertEqual(len(self.server.connections), 2)
+        for session in sessions:
+            self.db._release(session)
+
+        # an idle session is checked before being used again
+        sessions[-1].last_use -= mysql_adapter.IDLE_PING_DELAY + 1
+        self.db.get_projects()
+        self.assertEqual(self.server.connections[-1].pings, 1)
+
+    def test_prepared_cursors_are_bounded(self):
+        session = self.db._acquire()
+        self.addCleanup(self.db._release, session)
+        opened_cursors = len(session._cursors)
+        first_cursor = session.cursor("SELECT 0")
+        for index in range(1, mysql_adapter.MAX_PREPARED_CURSORS + 10):
+            session.cursor("SELECT " + str(index))
+            # a statement used again stays prepared
+            self.assertIs(session.cursor("SELECT 0"), first_cursor)
+        self.assertEqual(len(session._cursors), mysql_adapter.MAX_PREPARED_CURSORS)
+        self.assertEqual(self.server.closed_cursors, opened_cursors + 10)
+
+    def test_idempotent_statements_are_replayed(self):
+        self._lose_connection(applied=True)
+        self.db.get_projects()
+        self.assertEqual(self._count("SELECT"), 2)
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertTrue(self.server.connections[0].closed)
+
+    def test_lost_insert_is_not_replayed(self):
+        data = {"lock_state": False, "lock_user": ""}
+        self._lose_connection(applied=True)
+        self.db.create("test", "Lock", "anna-mdl", data)
+        self.assertEqual(self._count("INSERT"), 1)
+
+        # an unsent statement is replayed
+        self._lose_connection(applied=False, errno=mysql_adapter.errorcode.CR_SERVER_GONE_ERROR)
+        self.db.create("test", "Lock", "anna-rig", data)
+        self.assertEqual(self._count("INSERT"), 2)
+        self.assertIn("anna-rig", self.rows)
+
+        # a row inserted by another client is still a conflict
+        self.rows["anna-surf"] = (True, "joe")
+        self._lose_connection(applied=False)
+        with self.assertRaises(PulseDatabaseError):
+            self.db.create("test", "Lock", "anna-surf", data)
+        self.assertEqual(self.rows["anna-surf"], (True, "joe"))
+
+    def test_lost_compare_and_set_is_not_replayed(self):
+        self.rows["anna-mdl"] = (False, "")
+        expected = {"lock_state": False, "lock_user": ""}
+        commit_lock = {"lock_state": True, "lock_user": "tester_commit"}
+        self._lose_connection(applied=True)
+        self.assertTrue(self.db.compare_and_set("test", "Lock", "anna-mdl", expected, commit_lock))
+        self.assertEqual(self._count("UPDATE"), 1)
+
+        self._lose_connection(applied=False)
+        self.assertTrue(self.db.compare_and_set("test", "Lock", "anna-mdl", commit_lock, expected))
+        self.assertEqual(self._count("UPDATE"), 2)
+        self.assertEqual(self.rows["anna-mdl"], (False, ""))
+
+    def test_lost_schema_change_is_not_replayed(self):
+        self._lose_connection(applied=True)
+        with self.assertRaises(PulseDatabaseError):
+            self.db.create_project("test")
+        self.assertEqual(self._count("CREATE DATABASE"), 1)
+        # the session is usable again
+        self.db.get_projects()
+        self.assertEqual(len(self.server.connections), 2)
+
+
+@unittest.skipIf(mysql_adapter is None, "mysql connector is not installed")
+class TestMysqlUriPatterns(unittest.TestCase):
+    def setUp(self):
+        # the patterns translation doesn't need a server, only the projects schema versions
+        self.db = mysql_adapter.Database.__new__(mysql_adapter.Database)
+        self.db.config_name = "_Pulse_config"
+        self.db._project_versions = {
+            "test": mysql_adapter.ADAPTER_VERSION,
+            "legacy": mysql_adapter.UNSTRUCTURED_ADAPTER_VERSION
+        }
+
+    def test_glob_to_like(self):
+        self.assertEqual(mysql_adapter._glob_to_like("anna-*@?"), "anna-%@_")
+        self.assertEqual(mysql_adapter._glob_to_like("100%_\\"), "100\\%\\_\\\\")
+        # a characters set matches one character, an unclosed one is literal
+        self.assertEqual(mysql_adapter._glob_to_like("anna-mdl@[12]"), "anna-mdl@_")
+        self.assertEqual(mysql_adapter._glob_to_like("[!]a]x"), "_x")
+        self.assertEqual(mysql_adapter._glob_to_like("anna-[mdl"), "anna-[mdl")
+
+    def test_set_end(self):
+        self.assertEqual(mysql_adapter._set_end("[ab]", 1), 3)
+        self.assertEqual(mysql_adapter._set_end("[]a]", 1), 3)
+        self.assertEqual(mysql_adapter._set_end("[!]a]", 1), 4)
+        self.assertEqual(mysql_adapter._set_end("[ab", 1), -1)
+
+    def test_match_uris(self):
+        uris = ["anna-mdl@1", "Anna-mdl@1", "anna-mdl@2", "anna-mdl@10"]
+        self.assertEqual(mysql_adapter.match_uris(uris, "anna-mdl@1"), ["anna-mdl@1"])
+        self.assertEqual(mysql_adapter.match_uris(uris, "anna-mdl@[12]"), ["anna-mdl@1", "anna-mdl@2"])
+        self.assertEqual(mysql_adapter.match_uris(uris, "anna-mdl@1*"), ["anna-mdl@1", "anna-mdl@10"])
+
+    def test_uri_parts(self):
+        # the resource type is everything after the first "-", as in the projects upgrade
+        self.assertEqual(
+            mysql_adapter._uri_parts("a-b-c@12", {}), {"entity": "a", "resource_type": "b-c", "version": 12})
+        self.assertEqual(
+            mysql_adapter._uri_parts("anna-mdl", {"entity": "anna", "resource_type": "mdl"}),
+            {"entity": "anna", "resource_type": "mdl"}
+        )
+
+    def test_uri_condition(self):
+        def condition(uri_pattern, entity_type="PublishedVersion", project_name="test"):
+            return self.db._uri_condition(project_name, entity_type, uri_pattern)
+
+        self.assertEqual(
+            condition("anna-mdl@3"), ("entity = %s AND resource_type = %s AND version = %s", ["anna", "mdl", 3]))
+        self.assertEqual(condition("a-b-c@3"), ("entity = %s AND resource_type = %s AND version = %s", ["a", "b-c", 3]))
+        self.assertEqual(condition("anna-*@*"), ("entity = %s", ["anna"]))
+        self.assertEqual(condition("anna-m?l@*"), ("entity = %s AND resource_type LIKE %s", ["anna", "m_l"]))
+        # the versions which are not plain numbers are matched on the uri
+        self.assertEqual(
+            condition("anna-mdl@01"),
+            ("entity = %s AND resource_type = %s AND uri LIKE %s", ["anna", "mdl", "anna-mdl@01"])
+        )
+        # an entity wildcard can match a "-" of the uri
+        self.assertEqual(condition("*-mdl@2"), ("uri LIKE %s AND version = %s", ["%-mdl@%", 2]))
+        self.assertEqual(condition("*-mdl", "Resource"), ("uri LIKE %s", ["%-mdl"]))
+        self.assertEqual(condition("anna-*", "Resource"), ("entity = %s", ["anna"]))
+        self.assertEqual(condition("anna-mdl@1", "Resource"), ("FALSE", []))
+        # the characters sets, the other entity types and the projects without uri columns use the uri
+        self.assertEqual(condition("anna-mdl@[12]"), ("uri LIKE %s", ["anna-mdl@_"]))
+        self.assertEqual(condition("anna-mdl@1", "Work"), ("uri = %s", ["anna-mdl@1"]))
+        self.assertEqual(condition("anna-*", project_name="legacy"), ("uri LIKE %s", ["anna-%"]))
+
+
 class TestResources(unittest.TestCase):
     def setUp(self):
         utils.reset_test_data()
@@ -213,6 +749,106 @@ class TestResources(unittest.TestCase):
         self.assertEqual(['anna-mdl@1'], self.prj.purge_unused_local_products(dry_mode=False))
         self.assertFalse(os.path.exists(self.anna_abc_work_product))
 
+    def test_local_products_eviction(self):
+        def publish_product(size):
+            utils.add_file_to_directory(self.anna_abc_work_product, "anna.abc")
+            with open(os.path.join(self.anna_abc_work_product, "anna.abc"), "wb") as product_file:
+                product_file.write(os.urandom(size))
+            return self.anna_mdl_work.publish()
+
+        anna_mdl_v2 = publish_product(100)
+        # a work using the version 2 keeps it from being evicted
+        anna_surf_work = self.prj.create_resource("anna-surfacing").checkout()
+        anna_surf_work.add_input(anna_mdl_v2.uri)
+        self.cnx.local_products_quota = 150
+        anna_mdl_v3 = publish_product(100)
+        self.assertFalse(os.path.exists(self.anna_mdl_v1.product_directory))
+        self.assertTrue(os.path.exists(anna_mdl_v2.product_directory))
+        self.assertTrue(os.path.exists(anna_mdl_v3.product_directory))
+        self.assertEqual(self.prj.local_products.get_total_size(), 200)
+
+        # releasing the version 2 uses it, the version 3 becomes the least recently used product.
+        # Eviction doesn't need the database
+        anna_surf_work.trash()
+        db = self.cnx.db
+        self.cnx.db = None
+        try:
+            self.assertEqual(self.prj.evict_local_products(), [anna_mdl_v3.uri])
+        finally:
+            self.cnx.db = db
+        self.assertFalse(os.path.exists(anna_mdl_v3.product_directory))
+        self.assertEqual(self.prj.purge_unused_local_products(dry_mode=True), [anna_mdl_v2.uri])
+
+    def test_inputs_update_under_quota(self):
+        def publish_product(work):
+            product_directory = os.path.join(work.output_directory, "abc")
+            utils.add_file_to_directory(product_directory, "prop.abc")
+            with open(os.path.join(product_directory, "prop.abc"), "wb") as product_file:
+                product_file.write(os.urandom(100))
+            return work.publish()
+
+        prop_works = [self.prj.create_resource(x + "-mdl").checkout() for x in ["propa", "propb"]]
+        surf_work = self.prj.create_resource("props-surfacing").checkout()
+        for prop_work in prop_works:
+            surf_work.add_input(publish_product(prop_work).uri, input_name=prop_work.resource.uri)
+        # the new versions are only in the repository
+        new_versions = [publish_product(x) for x in prop_works]
+        for version in new_versions:
+            version.remove_from_local_products()
+        self.cnx.local_products_quota = 150
+
+        # a download doesn't evict the products downloaded with it, they are all linked first
+        updated_inputs = surf_work.update_inputs({"propa-mdl": "propa-mdl@2", "propb-mdl": "propb-mdl@2"})
+        self.assertEqual(sorted(x.uri for x in updated_inputs.values()), ["propa-mdl@2", "propb-mdl@2"])
+        for version in new_versions:
+            self.assertTrue(os.path.exists(version.product_directory))
+            self.assertEqual(version.get_product_users(), [surf_work.directory])
+
+    def test_local_products_index(self):
+        anna_surf_work = self.prj.create_resource("anna-surfacing").checkout()
+        anna_surf_work.add_input(self.anna_mdl_v1.uri)
+        index = self.prj.local_products
+        self.assertEqual(index.get_users(self.anna_mdl_v1.uri), [anna_surf_work.directory])
+        self.assertEqual(index.get_used_products(anna_surf_work.directory), [(self.anna_mdl_v1.uri, False)])
+        self.assertEqual(self.prj.list_published_versions("anna-*", local_only=True), [self.anna_mdl_v1.uri])
+
+        # the users lists written before the index existed are imported in a new index
+        index.close()
+        data_directory = os.path.join(utils.sandbox_products_path, test_project_name, ".pulse_data")
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(os.path.join(data_directory, "local_products.sqlite" + suffix)):
+                os.remove(os.path.join(data_directory, "local_products.sqlite" + suffix))
+        users_file = os.path.join(self.prj.commit_product_data_directory, self.anna_mdl_v1.uri + ".json")
+        fu.write_data(users_file, [anna_surf_work.directory])
+        prj = self.cnx.get_project(test_project_name)
+        self.assertEqual(prj.local_products.get_users(self.anna_mdl_v1.uri), [anna_surf_work.directory])
+        self.assertEqual(prj.list_published_versions(local_only=True), [self.anna_mdl_v1.uri])
+        self.assertFalse(os.path.exists(users_file))
+
+    def test_local_products_index_rebuild(self):
+        anna_surf_work = self.prj.create_resource("anna-surfacing").checkout()
+        anna_surf_work.add_input(self.anna_mdl_v1.uri)
+        index_filepath = self.prj.local_products.filepath
+
+        # the index keeps its rows when it's opened again
+        self.prj.local_products.add_user(self.anna_mdl_v1.uri, "/other/work")
+        self.prj.local_products.close()
+        prj = self.cnx.get_project(test_project_name)
+        self.assertEqual(prj.local_products.get_users(self.anna_mdl_v1.uri), ["/other/work", anna_surf_work.directory])
+
+        # a new index registers the products json users lists written before it existed, and the works inputs
+        prj.local_products.close()
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(index_filepath + suffix):
+                os.remove(index_filepath + suffix)
+        users_file = os.path.join(self.prj.commit_product_data_directory, self.anna_mdl_v1.uri + ".json")
+        fu.write_data(users_file, ["/other/work"])
+        prj = self.cnx.get_project(test_project_name)
+        product = prj.local_products.get_product(self.anna_mdl_v1.uri)
+        self.assertEqual(product["directory"], self.anna_mdl_v1.product_directory)
+        self.assertEqual(prj.local_products.get_users(self.anna_mdl_v1.uri), ["/other/work", anna_surf_work.directory])
+        self.assertFalse(os.path.exists(users_file))
+
     def test_manipulating_trashed_work(self):
         # ensure a file inside output won't be an issue when trashing the work
         utils.add_file_to_directory(self.anna_mdl_work.output_directory, "wip.abc")
@@ -237,6 +873,135 @@ class TestResources(unittest.TestCase):
         # res.read_data()
         # self.assertTrue(res.metas["site"] == "Paris")
 
+    def test_find_uris_patterns(self):
+        for version in range(2, 12):
+            self.cnx.db.create(test_project_name, "PublishedVersion", "anna-mdl@" + str(version), {"version": version})
+        self.prj.create_resource("anna-rig")
+        self.cnx.db.create(test_project_name, "PublishedVersion", "anna-rig@1", {"version": 1})
+        all_versions = ["anna-mdl@" + str(x) for x in range(1, 12)]
+        # an uri without wildcard only matches itself, and the versions are sorted by number
+        self.assertEqual(self.prj.list_published_versions("anna-mdl@1"), ["anna-mdl@1"])
+        self.assertEqual(self.prj.list_published_versions("anna-mdl@*"), all_versions)
+        self.assertEqual(self.prj.list_published_versions("anna-mdl@1?"), ["anna-mdl@10", "anna-mdl@11"])
+        self.assertEqual(self.prj.list_published_versions("anna-mdl@[12]"), ["anna-mdl@1", "anna-mdl@2"])
+        self.assertEqual(self.prj.list_published_versions("*-rig@1"), ["anna-rig@1"])
+        self.assertEqual(self.prj.list_published_versions("anna-*@1"), ["anna-mdl@1", "anna-rig@1"])
+        self.assertEqual(self.prj.list_published_versions("an?a*"), all_versions + ["anna-rig@1"])
+        self.assertEqual(self.prj.list_published_versions("anna-mdl@"), [])
+        self.assertEqual([x.uri for x in self.prj.get_published_versions("anna-mdl@*")], all_versions)
+        self.assertEqual([x.uri for x in self.prj.get_resources("anna-*")], ["anna-mdl", "anna-rig"])
+        self.assertEqual([x.uri for x in self.prj.get_resources("anna-mdl")], ["anna-mdl"])
+        self.assertEqual(self.cnx.db.get_last_version(test_project_name, "anna-mdl"), 11)
+
+    def test_published_version_lazy_fields(self):
+        self.prj.object_cache.invalidate()
+        self.assertEqual(
+            self.cnx.db.read(test_project_name, "PublishedVersion", "anna-mdl@1", fields=["version", "comment"]),
+            {"version": 1, "comment": ""}
+        )
+        self.assertEqual(
+            self.cnx.db.read_many(test_project_name, "PublishedVersion", ["anna-mdl@1"], fields=["version"]),
+            {"anna-mdl@1": {"version": 1}}
+        )
+        heavy_fields = {"files", "work_directories", "product_directories"}
+        version = self.prj.get_published_version("anna-mdl@1")
+        listed_version = self.prj.get_published_versions("anna-mdl@*")[0]
+        self.assertEqual(version._unloaded_fields, heavy_fields)
+        self.assertEqual(listed_version._unloaded_fields, heavy_fields)
+        # the files and directories are read on their first access
+        self.assertEqual(version.files, self.anna_mdl_v1.files)
+        # the files are stored as an encoded manifest, with their size and modification time
+        stored_files = self.cnx.db.read(test_project_name, "PublishedVersion", "anna-mdl@1", fields=["files"])["files"]
+        self.assertTrue(manifest.is_encoded(stored_files))
+        self.assertEqual(manifest.decode_files(stored_files), version.files)
+        self.assertEqual(set(version.files["/work.blend"]), manifest.ENTRY_KEYS)
+        self.assertEqual(version._unloaded_fields, set())
+        self.assertEqual(version.product_directories, self.anna_mdl_v1.product_directories)
+        self.assertEqual(listed_version.work_directories, self.anna_mdl_v1.work_directories)
+        # the product can still be downloaded
+        self.anna_mdl_v1.remove_from_local_products()
+        self.prj.get_published_version("anna-mdl@1").download()
+        self.assertTrue(os.path.exists(os.path.join(self.anna_mdl_v1.product_directory, "abc", "anna.abc")))
+
+    def test_object_cache(self):
+        cache = self.prj.object_cache
+        cache.invalidate()
+        # once read by a checkout, the resource and its version are not read again
+        self.anna_mdl_work.trash()
+        self.prj.get_resource("anna-mdl").checkout()
+        statistics = cache.get_statistics()
+        self.prj.get_resource("anna-mdl")
+        self.prj.get_published_version("anna-mdl@1")
+        new_statistics = cache.get_statistics()
+        self.assertEqual(new_statistics["misses"], statistics["misses"])
+        self.assertEqual(new_statistics["hits"] - statistics["hits"], 3)
+
+        # a local change is seen at once
+        self.anna_mdl.set_lock(True, "another_user")
+        self.assertEqual(self.prj.get_resource("anna-mdl").lock_user, "another_user")
+        # a change from another user is seen once the entry has expired
+        self.cnx.db.update(test_project_name, "Resource", "anna-mdl", {"lock_user": "third_user"})
+        self.assertEqual(self.prj.get_resource("anna-mdl").lock_user, "another_user")
+        cache.ttl = 0
+        self.assertEqual(self.prj.get_resource("anna-mdl").lock_user, "third_user")
+
+    def test_interrupted_publishes_recovery(self):
+        repository = self.cnx.repositories["main_storage"]
+        no_recovery = {"promoted": [], "discarded": []}
+        utils.add_file_to_directory(self.anna_mdl_work.directory, "v2.blend")
+
+        def fail(*args):
+            raise PulseRepositoryError("repository unreachable")
+
+        # the upload fails : no version is recorded, and the resource lock is restored
+        repository.stage_resource_commit = fail
+        with self.assertRaises(PulseRepositoryError):
+            self.anna_mdl_work.publish()
+        del repository.stage_resource_commit
+        self.assertEqual(self.anna_mdl.get_last_version(), 1)
+        self.anna_mdl.db_read()
+        self.assertFalse(self.anna_mdl.lock_state)
+
+        # the promotion fails, as after a crash : the version is recorded, and its staged files are promoted later
+        repository.promote_resource_commit = fail
+        with self.assertRaises(PulseRepositoryError):
+            self.anna_mdl_work.publish()
+        del repository.promote_resource_commit
+        self.assertEqual(self.anna_mdl.get_last_version(), 2)
+        self.assertEqual(self.anna_mdl_work.version, 3)
+        self.assertEqual(list(repository.list_staged_commits(test_project_name)), ["anna-mdl@2"])
+        recovered = {"promoted": ["anna-mdl@2"], "discarded": []}
+        self.assertEqual(self.prj.recover_interrupted_publishes(dry_mode=True), recovered)
+        self.assertEqual(self.prj.recover_interrupted_publishes(), recovered)
+        self.assertEqual(self.prj.recover_interrupted_publishes(), no_recovery)
+        download_path = os.path.join(utils.test_data_output_path, "download")
+        repository.download_work(test_project_name, "anna-mdl@2", download_path)
+        self.assertTrue(os.path.exists(os.path.join(download_path, "v2.blend")))
+
+        # a staged commit unknown to the database can belong to a running publish, it's discarded once stale
+        repository.stage_resource_commit(
+            test_project_name, "anna-mdl@3", self.anna_mdl_work.directory, {}, self.anna_mdl_work.product_directory, {})
+        self.assertEqual(self.prj.recover_interrupted_publishes(), no_recovery)
+        self.assertEqual(
+            self.prj.recover_interrupted_publishes(stale_hours=0), {"promoted": [], "discarded": ["anna-mdl@3"]})
+        self.assertEqual(repository.list_staged_commits(test_project_name), {})
+        utils.add_file_to_directory(self.anna_mdl_work.directory, "v3.blend")
+        self.assertEqual(self.anna_mdl_work.publish().version, 3)
+
+    def test_publish_discards_interrupted_staging(self):
+        repository = self.cnx.repositories[self.anna_mdl.repository]
+        # a publish of the same version crashed after staging a file the next publish doesn't have
+        crashed_work = os.path.join(utils.test_data_output_path, "crashed_work")
+        utils.add_file_to_directory(crashed_work, "crashed_only.blend")
+        repository.stage_resource_commit(
+            test_project_name, "anna-mdl@2", crashed_work, fu.get_file_list(crashed_work), crashed_work, {})
+        utils.add_file_to_directory(self.anna_mdl_work.directory, "v2.blend")
+        anna_mdl_v2 = self.anna_mdl_work.publish()
+        self.assertEqual(sorted(anna_mdl_v2.files), ["/v2.blend", "/work.blend"])
+        download_path = os.path.join(utils.test_data_output_path, "download")
+        repository.download_work(test_project_name, "anna-mdl@2", download_path)
+        self.assertEqual(sorted(fu.get_file_list(download_path)), ["/v2.blend", "/work.blend"])
+
     def test_lock_resource(self):
         self.anna_mdl.set_lock(True, "another_user")
         res_work = self.anna_mdl.checkout()
@@ -506,6 +1271,124 @@ class TestResources(unittest.TestCase):
         with self.assertRaises(PulseError):
             work.update()
 
+    def test_work_update_only_downloads_changed_files(self):
+        # version 2 adds a texture, version 3 edits the blend and moves the texture
+        with open(os.path.join(self.anna_mdl_work.directory, "texture.png"), "w") as texture_file:
+            texture_file.write("texture content")
+        self.anna_mdl_work.publish()
+        with open(os.path.join(self.anna_mdl_work.directory, "work.blend"), "w") as work_file:
+            work_file.write("v3 content")
+        os.makedirs(os.path.join(self.anna_mdl_work.directory, "textures"))
+        os.rename(
+            os.path.join(self.anna_mdl_work.directory, "texture.png"),
+            os.path.join(self.anna_mdl_work.directory, "textures", "texture.png")
+        )
+        self.anna_mdl_work.publish()
+        self.anna_mdl_work.trash()
+        work = self.anna_mdl.checkout(index=2)
+
+        repository = self.cnx.repositories["main_storage"]
+        downloaded_files = []
+        download_work = repository.download_work
+
+        def recording_download_work(project_name, uri, work_folder, files=None):
+            downloaded_files.append(files)
+            download_work(project_name, uri, work_folder, files)
+
+        repository.download_work = recording_download_work
+        work.update()
+        # the moved texture has been reused, only the blend has been downloaded
+        self.assertEqual(downloaded_files, [["/work.blend"]])
+        with open(os.path.join(work.directory, "work.blend"), "r") as work_file:
+            self.assertEqual(work_file.read(), "v3 content")
+        with open(os.path.join(work.directory, "textures", "texture.png"), "r") as texture_file:
+            self.assertEqual(texture_file.read(), "texture content")
+        self.assertFalse(os.path.exists(os.path.join(work.directory, "texture.png")))
+        self.assertEqual(self.anna_mdl.checkout().status(), {})
+
+    def test_checkout_reuses_the_trashed_work(self):
+        with open(os.path.join(self.anna_mdl_work.directory, "texture.png"), "w") as texture_file:
+            texture_file.write("texture content")
+        self.anna_mdl_work.publish()
+        with open(os.path.join(self.anna_mdl_work.directory, "work.blend"), "w") as work_file:
+            work_file.write("v3 content")
+        self.anna_mdl_work.publish()
+        self.anna_mdl_work.trash()
+
+        repository = self.cnx.repositories["main_storage"]
+        downloaded_files = []
+        download_work = repository.download_work
+
+        def recording_download_work(project_name, uri, work_folder, files=None):
+            downloaded_files.append(files)
+            download_work(project_name, uri, work_folder, files)
+
+        repository.download_work = recording_download_work
+        # the version 2 differs from the trashed work by its blend, the texture is copied from the trash
+        work = self.anna_mdl.checkout(index=2)
+        self.assertEqual(downloaded_files, [["/work.blend"]])
+        with open(os.path.join(work.directory, "texture.png"), "r") as texture_file:
+            self.assertEqual(texture_file.read(), "texture content")
+        self.assertEqual(work.status(), {})
+        trashed_work = self.anna_mdl._get_trashed_work()
+        self.assertEqual(sorted(trashed_work[1]), ["/texture.png", "/work.blend"])
+
+        # the last version is the trashed work, nothing is downloaded
+        work.trash(no_backup=True)
+        downloaded_files.clear()
+        work = self.anna_mdl.checkout()
+        self.assertEqual(downloaded_files, [])
+        self.assertEqual(work.status(), {})
+
+        # a revert only downloads the edited files
+        with open(os.path.join(work.directory, "texture.png"), "w") as texture_file:
+            texture_file.write("edited content")
+        work.revert()
+        self.assertEqual(downloaded_files, [["/texture.png"]])
+        work = self.anna_mdl.checkout()
+        self.assertEqual(work.status(), {})
+        with open(os.path.join(work.directory, "texture.png"), "r") as texture_file:
+            self.assertEqual(texture_file.read(), "texture content")
+
+    def test_repository_cache(self):
+        settings = self.cnx.get_settings()
+        cnx = Connection(
+            settings["adapter"],
+            settings["path"],
+            cache_path=os.path.join(utils.test_data_output_path, "cache"),
+            **settings["settings"]
+        )
+        self.assertIsInstance(cnx.repositories["main_storage"], repository_cache.CachedRepository)
+        published_version = cnx.get_project(test_project_name).get_published_version(self.anna_mdl_v1.uri)
+        # the first download goes to the repository, the next ones are served by the cache
+        for folder_name, hits, misses in [("first_download", 0, 1), ("second_download", 1, 1)]:
+            destination_folder = os.path.join(utils.test_data_output_path, folder_name)
+            published_version.download(destination_folder=destination_folder)
+            self.assertTrue(os.path.exists(os.path.join(destination_folder, "abc", "anna.abc")))
+            statistics = cnx.cache.get_statistics()
+            self.assertEqual((statistics["hits"], statistics["misses"]), (hits, misses))
+
+        # the work files keys are the commit files checksums, the work is never hashed to be cached
+        repository = cnx.repositories["main_storage"]
+        self.anna_mdl_work.trash(no_backup=True)
+        resource = cnx.get_project(test_project_name).get_resource(self.anna_mdl.uri)
+        with mock.patch.object(repository, "_index_download") as index_download:
+            resource.checkout().trash(no_backup=True)
+            resource.checkout().trash(no_backup=True)
+        index_download.assert_not_called()
+        # the empty work file has the same content as the product downloaded before
+        statistics = cnx.cache.get_statistics()
+        self.assertEqual((statistics["hits"], statistics["misses"]), (3, 1))
+
+        # the recorded manifests are forgotten with their resource, or with their project
+        products_id = repository._get_manifest_id(test_project_name, self.anna_mdl_v1.uri, "products")
+        self.assertIsNotNone(cnx.cache.get_manifest(products_id))
+        repository.remove_resource(test_project_name, self.anna_mdl.uri)
+        self.assertIsNone(cnx.cache.get_manifest(products_id))
+        cnx.cache.set_manifest(products_id, {"files": {}, "directories": []})
+        cnx.delete_project(test_project_name)
+        self.assertIsNone(cnx.cache.get_manifest(products_id))
+
     def test_work_status(self):
         # test new work file is reported, even in subdirectory
         utils.add_file_to_directory(self.anna_mdl_work.directory, "new_file.txt")
@@ -529,13 +1412,157 @@ class TestResources(unittest.TestCase):
             '/work.blend': 'removed'
         })
 
+    def test_work_checksum_cache(self):
+        work_filepath = os.path.join(self.anna_mdl_work.directory, "work.blend")
+        with open(work_filepath, "w") as work_file:
+            work_file.write("aaaa")
+        # pretend the file has not been modified recently, so its checksum can be cached
+        os.utime(work_filepath, (time.time() - 60, time.time() - 60))
+        self.assertEqual(self.anna_mdl_work.status(), {'/work.blend': 'edited'})
+        self.assertTrue(os.path.exists(self.anna_mdl_work.checksum_cache_file))
+
+        # same size and modification time : the cached checksum is trusted, the file is not hashed again
+        cached_checksum = fu.md5(work_filepath)
+        stat = os.stat(work_filepath)
+        with open(work_filepath, "w") as work_file:
+            work_file.write("bbbb")
+        os.utime(work_filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        anna_mdl_v2 = self.anna_mdl_work.publish()
+        self.assertEqual(anna_mdl_v2.files['/work.blend']['checksum'], cached_checksum)
+
+        # any stat change triggers a new hash
+        os.utime(work_filepath, (time.time() - 30, time.time() - 30))
+        self.assertEqual(self.anna_mdl_work.status(), {'/work.blend': 'edited'})
+
+        self.anna_mdl_work.trash()
+        self.assertFalse(os.path.exists(self.anna_mdl_work.checksum_cache_file))
+
+    def test_hash_algorithm(self):
+        with self.assertRaises(PulseError):
+            self.cnx.create_project("bad_hash", utils.sandbox_work_path, default_repository="main_storage",
+                                    product_user_root=utils.sandbox_products_path, hash_algorithm="unknown")
+        prj = self.cnx.create_project(
+            "blake_project",
+            utils.sandbox_work_path,
+            default_repository="main_storage",
+            product_user_root=utils.sandbox_products_path,
+            hash_algorithm="blake2b"
+        )
+        self.assertEqual(self.cnx.get_project("blake_project").hash_algorithm, "blake2b")
+        resource = prj.create_resource("anna-mdl")
+        work = resource.checkout()
+        work_filepath = utils.add_file_to_directory(work.directory, "work.blend")
+        commit = work.publish()
+        self.assertEqual(commit.files["/work.blend"]["algorithm"], "blake2b")
+        self.assertEqual(commit.files["/work.blend"]["checksum"], fu.file_checksum(work_filepath, "blake2b"))
+
+        # untagged md5 checksums written by older versions are still comparable
+        work_data = fu.read_data(work.data_file)
+        work_data["work_files"] = {"/work.blend": {"checksum": fu.md5(work_filepath)}}
+        fu.write_data(work.data_file, work_data)
+        self.assertEqual(work.status(), {})
+        with open(work_filepath, "w") as f:
+            f.write("edit")
+        self.assertEqual(work.status(), {"/work.blend": "edited"})
+
+    def test_legacy_adapter_signatures(self):
+        class LegacyRepository:
+            """repository adapter written before the writable and files download arguments"""
+            def __init__(self, repository):
+                self.repository = repository
+
+            def __getattr__(self, name):
+                return getattr(self.repository, name)
+
+            def download_product(self, project_name, uri, destination_folder, subpath=""):
+                self.repository.download_product(project_name, uri, destination_folder, subpath)
+
+            def download_work(self, project_name, uri, work_folder):
+                self.repository.download_work(project_name, uri, work_folder)
+
+        legacy_repository = LegacyRepository(self.cnx.repositories["main_storage"])
+        self.assertEqual(supported_arguments(legacy_repository.download_work, files=["/work.blend"]), {})
+        cache = repository_cache.RepositoryCache(os.path.join(utils.test_data_output_path, "cache"))
+        self.addCleanup(cache.close)
+        for repository in [legacy_repository, repository_cache.CachedRepository(legacy_repository, cache)]:
+            self.cnx.repositories["main_storage"] = repository
+            self.anna_mdl_v1.remove_from_local_products()
+            self.anna_mdl_v1.download()
+            self.assertTrue(os.path.exists(os.path.join(self.anna_mdl_v1.product_directory, "abc", "anna.abc")))
+            destination = os.path.join(utils.test_data_output_path, "custom", str(id(repository)))
+            self.anna_mdl_v1.download(destination_folder=destination)
+            self.assertTrue(os.path.exists(os.path.join(destination, "abc", "anna.abc")))
+
+    def test_product_materialization(self):
+        with self.assertRaises(PulseRepositoryError):
+            self.cnx.add_repository(name="bad_storage", adapter="file_storage",
+                                    path=utils.file_storage_path + "/bad_storage", materialization="teleport")
+        self.cnx.add_repository(
+            name="linked_storage",
+            adapter="file_storage",
+            path=utils.file_storage_path + "/linked_storage",
+            materialization="hardlink"
+        )
+        resource = self.prj.create_resource("joe-mdl", repository="linked_storage")
+        work = resource.checkout()
+        utils.add_file_to_directory(work.directory, "work.blend")
+        utils.add_file_to_directory(os.path.join(work.output_directory, "abc"), "joe.abc")
+        commit = work.publish()
+        work.trash()
+        self.prj.purge_unused_local_products()
+
+        # local products are read only, they are linked to the repository files
+        repository_filepath = os.path.join(
+            utils.file_storage_path, "linked_storage", test_project_name, "joe-mdl", "1", "products", "abc", "joe.abc")
+        self.assertTrue(fu.is_read_only(repository_filepath))
+        commit.download()
+        product_filepath = os.path.join(commit.directory, "abc", "joe.abc")
+        self.assertTrue(os.path.samefile(product_filepath, repository_filepath))
+        self.assertFalse(os.stat(product_filepath).st_mode & 0o222)
+
+        # removing the local product doesn't make the repository file writable
+        commit.remove_from_local_products()
+        self.assertTrue(os.path.exists(repository_filepath))
+        self.assertFalse(os.stat(repository_filepath).st_mode & 0o222)
+
+        # work files are never linked
+        work = resource.checkout()
+        self.assertEqual(os.stat(os.path.join(work.directory, "work.blend")).st_nlink, 1)
+
+    def test_copy_file_fallback(self):
+        source = utils.add_file_to_directory(utils.test_data_output_path, "source.txt")
+        with open(source, "w") as f:
+            f.write("content")
+        destination = os.path.join(utils.test_data_output_path, "sub", "reflinked.txt")
+        # reflink is not supported everywhere, copy is the last resort
+        self.assertIn(fu.copy_file(source, destination, "reflink"), ["reflink", "copy"])
+        with open(destination, "r") as f:
+            self.assertEqual(f.read(), "content")
+        # a writable file is never linked, writing the link would change it
+        self.assertIn(fu.copy_file(source, destination + "2", "hardlink"), ["reflink", "copy"])
+        self.assertEqual(os.stat(source).st_nlink, 1)
+        fu.set_read_only(source)
+        self.assertEqual(fu.copy_file(source, destination + "3", "hardlink"), "hardlink")
+
+    def test_last_version_lookup(self):
+        for index in range(2, 11):
+            utils.add_file_to_directory(self.anna_mdl_work.directory, "v" + str(index))
+            self.anna_mdl_work.publish()
+        self.assertEqual(self.anna_mdl.get_last_version(), 10)
+        # "last" is resolved numerically, @10 is after @9
+        self.assertEqual(self.prj.get_published_version("anna-mdl").version, 10)
+        self.assertEqual(self.prj.get_published_version("anna-mdl@last").version, 10)
+        self.assertEqual(self.prj.get_resource("anna-mdl").db_read()._storage_vars["last_version"], 10)
+        with self.assertRaises(PulseMissingNode):
+            self.prj.get_published_version(self.prj.create_resource("anna-rig").uri)
+
     def test_work_trash(self):
         utils.add_file_to_directory(self.anna_mdl_work.product_directory, "product_file.txt")
         # test trash work and its wip product
         self.anna_mdl_work.trash()
         self.assertFalse(os.path.exists(self.anna_mdl_work.product_directory))
         self.assertFalse(os.path.exists(self.anna_mdl_work.directory))
-        self.assertFalse(os.path.exists(self.anna_mdl_work.pulse_product_data_file))
+        self.assertIsNone(self.prj.local_products.get_product(self.anna_mdl_work.uri, work=True))
 
     def test_work_commit_data(self):
         anna_rig_resource = self.prj.create_resource("anna-rigging")
@@ -546,20 +1573,85 @@ class TestResources(unittest.TestCase):
         self.assertEqual(list(commit.files.keys())[0], '/work_file.txt')
 
 
+    def _test_compressed_storage(self, repository_name):
+        """publish compressible and incompressible files to a repository, and check they come back intact"""
+        resource = self.prj.create_resource("joe-mdl", repository=repository_name)
+        work = resource.checkout()
+        with open(os.path.join(work.directory, "work.blend"), "wb") as f:
+            f.write(b"mesh data " * 10000)
+        with open(utils.add_file_to_directory(os.path.join(work.output_directory, "abc"), "joe.abc"), "wb") as f:
+            f.write(b"vertex 0.0 1.0 2.0\n" * 10000)
+        noise = os.urandom(50000)
+        with open(os.path.join(work.directory, "noise.bin"), "wb") as f:
+            f.write(noise)
+        published_version = work.publish()
+        work.trash()
+        self.prj.purge_unused_local_products()
+
+        work = resource.checkout()
+        with open(os.path.join(work.directory, "work.blend"), "rb") as f:
+            self.assertEqual(f.read(), b"mesh data " * 10000)
+        with open(os.path.join(work.directory, "noise.bin"), "rb") as f:
+            self.assertEqual(f.read(), noise)
+        destination = os.path.join(utils.test_data_output_path, "download")
+        published_version.download(destination_folder=destination)
+        self.assertEqual(os.listdir(os.path.join(destination, "abc")), ["joe.abc"])
+        with open(os.path.join(destination, "abc", "joe.abc"), "rb") as f:
+            self.assertEqual(f.read(), b"vertex 0.0 1.0 2.0\n" * 10000)
+
+    def test_compressed_repository(self):
+        self.cnx.add_repository(
+            name="compressed_storage",
+            adapter="file_storage",
+            path=utils.file_storage_path + "/compressed_storage",
+            compression="zlib"
+        )
+        with self.assertRaises(PulseRepositoryError):
+            self.cnx.add_repository(name="bad_storage", adapter="file_storage",
+                                    path=utils.file_storage_path + "/bad_storage", compression="rar")
+        self._test_compressed_storage("compressed_storage")
+        stored_files = []
+        for root, directories, files in os.walk(os.path.join(utils.file_storage_path, "compressed_storage")):
+            stored_files.extend(files)
+        self.assertIn("noise.bin", stored_files)
+        self.assertNotIn("work.blend", stored_files)
+        self.assertTrue([x for x in stored_files if x.endswith(compression.COMPRESSED_SUFFIX)])
+
+    def test_interrupted_product_download(self):
+        self.anna_mdl_work.trash()
+        self.prj.purge_unused_local_products()
+        anna_mdl_v1 = self.prj.get_published_version("anna-mdl@1")
+        repository = self.cnx.repositories["main_storage"]
+
+        def interrupted_download(*args, **kwargs):
+            Repository.download_product(repository, *args, **kwargs)
+            raise ConnectionError("transfer interrupted")
+        Repository = type(repository)
+        repository.download_product = interrupted_download
+        with self.assertRaises(ConnectionError):
+            anna_mdl_v1.download()
+        self.assertFalse(anna_mdl_v1.is_local())
+        self.assertFalse(os.path.exists(anna_mdl_v1.directory))
+
+        del repository.download_product
+        anna_mdl_v1.download()
+        self.assertTrue(anna_mdl_v1.is_local())
+        self.assertTrue(os.path.exists(os.path.join(anna_mdl_v1.directory, "abc", "anna.abc")))
+
     def test_product_download(self):
         self.anna_mdl_work.trash()
         self.prj.purge_unused_local_products()
         anna_mdl_V1 = self.prj.get_published_version("anna-mdl@1")
         self.assertFalse(os.path.exists(anna_mdl_V1.directory))
         self.assertFalse(anna_mdl_V1.is_local())
-        self.assertFalse(os.path.exists(anna_mdl_V1.pulse_product_data_file))
+        self.assertIsNone(self.prj.local_products.get_product(anna_mdl_V1.uri))
         anna_mdl_V1.download()
         self.assertTrue(os.path.exists(anna_mdl_V1.directory))
-        self.assertTrue(os.path.exists(anna_mdl_V1.pulse_product_data_file))
+        self.assertIsNotNone(self.prj.local_products.get_product(anna_mdl_V1.uri))
         self.assertTrue(anna_mdl_V1.is_local())
         anna_mdl_V1.remove_from_local_products()
         self.assertFalse(os.path.exists(anna_mdl_V1.directory))
-        self.assertFalse(os.path.exists(anna_mdl_V1.pulse_product_data_file))
+        self.assertIsNone(self.prj.local_products.get_product(anna_mdl_V1.uri))
 
         # test to download a product with a subpath which does not exists
         with self.assertRaises(PulseRepositoryError):
@@ -628,6 +1720,28 @@ class TestResources(unittest.TestCase):
         self.assertTrue(len(self.prj.list_published_versions("anna*")) == 2)
         self.assertTrue(len(self.prj.list_published_versions("an?a*")) == 2)
 
+    def test_project_bulk_getters(self):
+        anna_rig = self.prj.create_resource("anna-rigging")
+        anna_rig.set_lock(True, "another_user")
+        utils.add_file_to_directory(self.anna_mdl_work.directory, "v2.blend")
+        self.anna_mdl_work.publish(comment="second")
+
+        resources = self.prj.get_resources("anna-*")
+        self.assertEqual([x.uri for x in resources], ["anna-mdl", "anna-rigging"])
+        self.assertEqual(resources[1].lock_user, "another_user")
+
+        versions = self.prj.get_published_versions("anna-mdl@*")
+        self.assertEqual([x.uri for x in versions], ["anna-mdl@1", "anna-mdl@2"])
+        self.assertEqual(versions[1].comment, "second")
+        self.assertEqual(versions[1].resource.repository, "main_storage")
+
+        data = self.cnx.db.list_objects(test_project_name, "PublishedVersion", "anna-mdl@*", fields=["comment"])
+        self.assertEqual(data["anna-mdl@2"], {"comment": "second"})
+        self.assertEqual(
+            list(self.cnx.db.read_many(test_project_name, "Resource", ["anna-mdl", "missing-uri"]).keys()),
+            ["anna-mdl"]
+        )
+
     def test_project_list_works(self):
         anna_rig_resource = self.prj.create_resource("anna-rigging")
         anna_rig_resource.checkout()
@@ -688,6 +1802,28 @@ class TestResources(unittest.TestCase):
         anna_rig_work.add_input("anna-mdl/high_geo", consider_work_product=True)
         self.assertTrue(os.path.exists(os.path.join(anna_rig_work.directory, "input", "anna-mdl~high_geo", "hi.abc")))
 
+    def test_checkout_downloads_inputs_concurrently(self):
+        shot_work = self.prj.create_resource("shot010-anim").checkout()
+        for name in ["joe", "bob", "tom"]:
+            work = self.prj.create_resource(name + "-mdl").checkout()
+            utils.add_file_to_directory(os.path.join(work.output_directory, "abc"), name + ".abc")
+            work.publish()
+            work.trash()
+            shot_work.add_input(name + "-mdl/abc")
+        shot_work.add_input("anna-mdl/abc")
+        shot_work.publish()
+        shot_work.trash()
+        self.anna_mdl_work.trash()
+        self.prj.purge_unused_local_products()
+
+        progress = []
+        shot_work = self.prj.get_resource("shot010-anim").checkout(
+            progress_callback=lambda done, total, uri: progress.append((done, total, uri)))
+        self.assertEqual([x[:2] for x in progress], [(x, 4) for x in range(1, 5)])
+        self.assertEqual(sorted(x[2] for x in progress), ["anna-mdl@1", "bob-mdl@1", "joe-mdl@1", "tom-mdl@1"])
+        self.assertTrue(os.path.exists(os.path.join(shot_work.input_directory, "bob-mdl~abc", "bob.abc")))
+        self.assertTrue(self.prj.get_published_version("tom-mdl@1").is_local())
+
     def test_work_add_input_with_custom_name(self):
         anna_rig_resource = self.prj.create_resource("anna-rigging")
         anna_rig_work = anna_rig_resource.checkout()
@@ -818,5 +1954,463 @@ class TestResources(unittest.TestCase):
         resource_model_b.db_read()
         self.assertEqual(resource_model_b.get_last_version(), 1)
 
+
+class TestConcurrentProcesses(unittest.TestCase):
+    adapter = "json_db"
+    db_path = utils.json_db_path
+
+    def setUp(self):
+        utils.reset_test_data()
+        self.cnx = Connection(adapter=self.adapter, path=self.db_path)
+        self.cnx.add_repository(name="main_storage", adapter="file_storage", path=utils.file_storage_path + "/main")
+        self.prj = self.cnx.create_project(
+            test_project_name,
+            utils.sandbox_work_path,
+            default_repository="main_storage",
+            product_user_root=utils.sandbox_products_path
+        )
+        work = self.prj.create_resource("anna-mdl").checkout()
+        utils.add_file_to_directory(os.path.join(work.output_directory, "abc"), "anna.abc")
+        self.anna_mdl_v1 = work.publish()
+
+    def test_checkouts_and_publishes_in_one_sandbox(self):
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=utils.publish_concurrently,
+                args=(
+                    self.adapter, self.db_path, test_project_name, "proc" + str(index) + "-mdl", 3,
+                    self.anna_mdl_v1.uri
+                )
+            )
+            for index in range(6)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(300)
+            self.assertEqual(process.exitcode, 0)
+
+        for index in range(6):
+            resource = self.prj.get_resource("proc" + str(index) + "-mdl")
+            self.assertEqual(resource.get_last_version(), 3)
+            work = Work(self.prj, resource.uri).read()
+            self.assertEqual(work.version, 4)
+            self.assertEqual(list(work.get_inputs()), [self.anna_mdl_v1.uri])
+        self.assertEqual(len(self.prj.local_products.get_users(self.anna_mdl_v1.uri)), 6)
+        leftovers = [f for root, dirs, files in os.walk(utils.test_data_output_path) for f in files if ".tmp" in f]
+        self.assertEqual(leftovers, [])
+
+    def _run_concurrently(self, target, args_list):
+        """start a process per arguments tuple, they wait for each other to start. Return the results queue content"""
+        context = multiprocessing.get_context("spawn")
+        start_barrier = context.Barrier(len(args_list))
+        results = context.Queue()
+        processes = [context.Process(target=target, args=args + (start_barrier, results)) for args in args_list]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(300)
+            self.assertEqual(process.exitcode, 0)
+        return [results.get(timeout=10) for _ in range(results.qsize())]
+
+    def test_concurrent_publishes_of_one_resource(self):
+        os.environ["USER_VAR"] = "userA"
+        prj = self.cnx.create_project(
+            "project_contention",
+            utils.sandbox_work_path + "_${USER_VAR}",
+            default_repository="main_storage",
+            product_user_root=utils.sandbox_products_path + "_${USER_VAR}"
+        )
+        resource = prj.create_resource("joe-model")
+        winners = self._run_concurrently(
+            utils.publish_in_user_sandbox,
+            [(self.adapter, self.db_path, "project_contention", "joe-model", "user" + str(i)) for i in range(6)]
+        )
+        # all the works are based on the same version, only one of them can be published
+        self.assertEqual(len(winners), 1)
+        resource.db_read()
+        self.assertEqual(resource.get_last_version(), 1)
+        self.assertEqual(list(prj.get_published_version("joe-model@1").files), ["/" + winners[0] + ".txt"])
+        # the commit lock has been released
+        self.assertFalse(resource.lock_state)
+
+    def test_try_lock_contention(self):
+        winners = [user for user, locked in self._run_concurrently(
+            utils.try_lock_concurrently,
+            [(self.adapter, self.db_path, test_project_name, "anna-mdl", "user" + str(i)) for i in range(8)]
+        ) if locked]
+        self.assertEqual(len(winners), 1)
+        resource = self.prj.get_resource("anna-mdl")
+        self.assertTrue(resource.lock_state)
+        self.assertEqual(resource.lock_user, winners[0])
+        # the lock owner can take it again, the other users can't
+        self.assertTrue(self.cnx.db.try_lock(test_project_name, "anna-mdl", winners[0]))
+        self.assertFalse(self.cnx.db.try_lock(test_project_name, "anna-mdl", "another_user"))
+        self.assertFalse(self.cnx.db.compare_and_set(
+            test_project_name, "Resource", "anna-mdl", {"lock_state": False}, {"lock_user": "another_user"}))
+        with self.assertRaises(PulseDatabaseMissingObject):
+            self.cnx.db.try_lock(test_project_name, "unknown-mdl", "another_user")
+
+
+class TestConcurrentProcessesSQLite(TestConcurrentProcesses):
+    adapter = "sqlite"
+    db_path = utils.sqlite_db_path
+
+    def tearDown(self):
+        self.cnx.db.close()
+
+
+class TestResourcesContentAddressed(TestResources):
+    def setUp(self):
+        utils.reset_test_data()
+        self.cnx = Connection(adapter="json_db", path=utils.json_db_path)
+        storage_name = "main_storage"
+        self.cnx.add_repository(
+            name=storage_name,
+            adapter="file_storage",
+            path=utils.file_storage_path + "/" + storage_name,
+            content_addressed=True
+        )
+        self.prj = self.cnx.create_project(
+            test_project_name,
+            utils.sandbox_work_path,
+            default_repository=storage_name,
+            product_user_root=utils.sandbox_products_path
+        )
+        self._initResource()
+
+    def test_compressed_blobs(self):
+        self.cnx.add_repository(
+            name="compressed_storage",
+            adapter="file_storage",
+            path=utils.file_storage_path + "/compressed_storage",
+            content_addressed=True,
+            compression="lzma"
+        )
+        self._test_compressed_storage("compressed_storage")
+        repository = self.cnx.repositories["compressed_storage"]
+        self.assertEqual(repository.purge_unreferenced_blobs(test_project_name), [])
+
+    def test_repository_cache_shares_identical_files(self):
+        # the version 2 products are the same as the version 1 ones
+        utils.add_file_to_directory(self.anna_abc_work_product, "anna.abc")
+        anna_mdl_v2 = self.anna_mdl_work.publish()
+        cnx = Connection(
+            adapter="json_db", path=utils.json_db_path, cache_path=os.path.join(utils.test_data_output_path, "cache"))
+        prj = cnx.get_project(test_project_name)
+        for uri in [self.anna_mdl_v1.uri, anna_mdl_v2.uri]:
+            prj.get_published_version(uri).download(
+                destination_folder=os.path.join(utils.test_data_output_path, uri.replace("@", "_")))
+        # the manifest lists the files checksums, the second version is served by the cache from its first download
+        statistics = cnx.cache.get_statistics()
+        self.assertEqual((statistics["hits"], statistics["misses"]), (1, 1))
+        # uploads are not cached, and adapter specific methods are still reachable
+        self.assertEqual(cnx.repositories["main_storage"].purge_unreferenced_blobs(test_project_name), [])
+
+    def test_unchanged_files_are_stored_once(self):
+        blobs_path = os.path.join(utils.file_storage_path, "main_storage", test_project_name, ".blobs")
+
+        def count_blobs():
+            return sum(len(files) for root, dirs, files in os.walk(blobs_path))
+
+        with open(os.path.join(self.anna_mdl_work.directory, "work.blend"), "w") as work_file:
+            work_file.write("v2 content")
+        utils.add_file_to_directory(self.anna_abc_work_product, "anna.abc")
+        self.anna_mdl_work.publish()
+        # the empty work and product files of v1 are shared, only the new blend content is stored
+        self.assertEqual(count_blobs(), 2)
+        # the blobs are read only, the local products can be linked to them
+        for root, dirs, files in os.walk(blobs_path):
+            self.assertTrue(all(fu.is_read_only(os.path.join(root, x)) for x in files))
+
+        self.anna_mdl_work.trash()
+        work = self.anna_mdl.checkout(index=1)
+        with open(os.path.join(work.directory, "work.blend"), "r") as work_file:
+            self.assertEqual(work_file.read(), "")
+        work.update(force=True)
+        with open(os.path.join(work.directory, "work.blend"), "r") as work_file:
+            self.assertEqual(work_file.read(), "v2 content")
+
+        # removed resources let their blobs be purged
+        repository = self.cnx.repositories["main_storage"]
+        repository.remove_resource(test_project_name, self.anna_mdl.uri)
+        self.assertEqual(len(repository.purge_unreferenced_blobs(test_project_name, grace_hours=0)), 2)
+        self.assertEqual(count_blobs(), 0)
+
+    def test_purge_keeps_the_blobs_of_running_publishes(self):
+        repository = self.cnx.repositories["main_storage"]
+        blobs_path = os.path.join(utils.file_storage_path, "main_storage", test_project_name, ".blobs")
+        source_root = os.path.join(utils.test_data_output_path, "publish")
+        with open(utils.add_file_to_directory(source_root, "new.blend"), "w") as source_file:
+            source_file.write("new content")
+        # an old blob is reused by the publish, after the resource referring to it has been removed
+        old_blobs = [os.path.join(root, x) for root, dirs, files in os.walk(blobs_path) for x in files]
+        for blob_path in old_blobs:
+            os.utime(blob_path, (0, 0))
+        repository.remove_resource(test_project_name, self.anna_mdl.uri)
+        utils.add_file_to_directory(source_root, "empty.blend")
+
+        # the publish blobs are stored before its manifest is written
+        entry = repository._store_blobs(test_project_name, source_root, ["/new.blend", "/empty.blend"])
+        self.assertEqual(repository.purge_unreferenced_blobs(test_project_name), [])
+        self.assertEqual(
+            sorted(repository.purge_unreferenced_blobs(test_project_name, grace_hours=0)),
+            sorted(set(entry["files"].values()))
+        )
+
+
+class TestResourcesSQLite(TestResources):
+    def setUp(self):
+        utils.reset_test_data()
+        self.cnx = Connection(adapter="sqlite", path=utils.sqlite_db_path)
+        storage_name = "main_storage"
+        self.cnx.add_repository(
+            name=storage_name,
+            adapter="file_storage",
+            path=utils.file_storage_path + "/" + storage_name
+        )
+        self.prj = self.cnx.create_project(
+            test_project_name,
+            utils.sandbox_work_path,
+            default_repository=storage_name,
+            product_user_root=utils.sandbox_products_path
+        )
+        self._initResource()
+
+    def tearDown(self):
+        self.cnx.db.close()
+
+    def test_find_uris_pattern(self):
+        for index in range(2, 12):
+            utils.add_file_to_directory(self.anna_mdl_work.directory, "v" + str(index))
+            self.anna_mdl_work.publish()
+        # versions come back in numeric order, and exact uris don't match longer ones
+        self.assertEqual(
+            self.cnx.db.find_uris(test_project_name, "PublishedVersion", "anna-mdl@*"),
+            ["anna-mdl@" + str(x) for x in range(1, 12)]
+        )
+        self.assertEqual(self.cnx.db.find_uris(test_project_name, "PublishedVersion", "anna-mdl@1"), ["anna-mdl@1"])
+        self.assertEqual(len(self.cnx.db.find_uris(test_project_name, "PublishedVersion", "an?a-mdl@1*")), 3)
+
+    def test_edit_repository(self):
+        self.cnx.edit_repository("main_storage", "file_storage", path=utils.file_storage_path + "/moved")
+        repository = Connection(adapter="sqlite", path=utils.sqlite_db_path).get_repositories()["main_storage"]
+        self.assertEqual(repository.root, utils.file_storage_path + "/moved")
+
+
+
+@unittest.skipIf(pyftpdlib is None, "pyftpdlib is not installed")
+class TestResourcesFTP(TestResources):
+    @classmethod
+    def setUpClass(cls):
+        utils.reset_test_data()
+        # the server home is the test data root, the repository has the same layout as the file_storage one
+        cls.ftp_server, cls.ftp_port = utils.start_ftp_server(utils.test_data_output_path, "tester", "secret")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ftp_server.close_all()
+
+    def setUp(self):
+        utils.reset_test_data()
+        self.cnx = Connection(adapter="json_db", path=utils.json_db_path)
+        storage_name = "main_storage"
+        self.cnx.add_repository(
+            name=storage_name,
+            adapter="ftp",
+            login="tester",
+            password="secret",
+            host="127.0.0.1",
+            port=self.ftp_port,
+            root="/repos/" + storage_name
+        )
+        self.prj = self.cnx.create_project(
+            test_project_name,
+            utils.sandbox_work_path,
+            default_repository=storage_name,
+            product_user_root=utils.sandbox_products_path
+        )
+        self._initResource()
+
+    def tearDown(self):
+        for repository in self.cnx.repositories.values():
+            if repository.__module__.endswith("ftp"):
+                repository.close()
+
+    def test_parallel_transfers(self):
+        resource = self.prj.create_resource("crowd-anim")
+        work = resource.checkout()
+        for index in range(200):
+            filepath = utils.add_file_to_directory(
+                os.path.join(work.output_directory, "cache", "part" + str(index % 10)), str(index) + ".abc")
+            with open(filepath, "w") as f:
+                f.write(str(index) * 1000)
+        repository = self.cnx.repositories["main_storage"]
+        upload_file = repository._upload_file
+        running = []
+        concurrency = []
+        lock = threading.Lock()
+
+        def measured_upload(*args, **kwargs):
+            with lock:
+                running.append(None)
+                concurrency.append(len(running))
+            # keeps the upload running long enough to overlap with the others
+            time.sleep(0.01)
+            try:
+                return upload_file(*args, **kwargs)
+            finally:
+                with lock:
+                    running.pop()
+
+        with mock.patch.object(repository, "_upload_file", side_effect=measured_upload):
+            published_version = work.publish()
+        self.assertGreater(max(concurrency), 1)
+        self.assertLessEqual(max(concurrency), repository.sessions)
+
+        destination = os.path.join(utils.test_data_output_path, "download")
+        published_version.download(destination_folder=destination)
+        for index in range(200):
+            filepath = os.path.join(destination, "cache", "part" + str(index % 10), str(index) + ".abc")
+            with open(filepath) as f:
+                self.assertEqual(f.read(), str(index) * 1000)
+
+    def test_temporary_errors_keep_the_session(self):
+        repository = self.cnx.repositories["main_storage"]
+        repository._run(lambda ftp_connection: ftp_connection.voidcmd("NOOP"))
+        calls = []
+
+        def busy(ftp_connection):
+            calls.append(ftp_connection)
+            raise ftplib.error_temp("450 file busy")
+
+        def closing(ftp_connection):
+            calls.append(ftp_connection)
+            if len(calls) == 1:
+                raise ftplib.error_temp("421 service not available")
+            return True
+
+        with self.assertRaises(ftplib.error_temp):
+            repository._run(busy)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(repository._sessions_count, 1)
+        self.assertIs(repository._idle_sessions.get_nowait(), calls[0])
+        repository._release(calls[0])
+
+        calls.clear()
+        self.assertTrue(repository._run(closing))
+        self.assertEqual(len(calls), 2)
+        self.assertIsNot(calls[0], calls[1])
+        self.assertEqual(repository._sessions_count, 1)
+
+    def test_resumed_download(self):
+        repository = self.cnx.repositories["main_storage"]
+        source = os.path.join(utils.test_data_output_path, "big_file")
+        with open(source, "wb") as f:
+            f.write(b"0123456789" * 1000)
+        repository._upload_file(source, "/remote_file")
+        # the first half was received by an interrupted download, the rest is requested from this offset
+        destination = os.path.join(utils.test_data_output_path, "downloaded_file")
+        with open(destination + fu.PARTIAL_SUFFIX, "wb") as f:
+            f.write(b"x" * 5000)
+        repository._download_file("/remote_file", destination, 10000)
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(), b"x" * 5000 + b"0123456789" * 500)
+        self.assertFalse(os.path.exists(destination + fu.PARTIAL_SUFFIX))
+
+    def test_resumed_upload(self):
+        resource = self.prj.create_resource("joe-mdl")
+        work = resource.checkout()
+        for filename, content in [("work.blend", "complete content"), ("notes.txt", "new notes"), ("kept.txt", "kept")]:
+            with open(os.path.join(work.directory, filename), "w") as f:
+                f.write(content)
+        work_files = fu.get_file_list(work.directory)
+        # an interrupted upload left a truncated file whose start is journaled, a file journaled as complete, and
+        # a file of the same size as the new one but from another content
+        staging = os.path.join(
+            utils.file_storage_path, "main_storage", test_project_name, "joe-mdl", "1" + fu.STAGING_SUFFIX)
+        os.makedirs(os.path.join(staging, "work"))
+        for filename, content in [("work.blend", "COMPLETE"), ("notes.txt", "old notes"), ("kept.txt", "KEPT")]:
+            with open(os.path.join(staging, "work", filename), "w") as f:
+                f.write(content)
+        with open(os.path.join(staging, ftp.JOURNAL_FILENAME), "w") as f:
+            for record in [
+                ["started", "/work/work.blend", fu.checksum_key(work_files["/work.blend"])],
+                ["done", "/work/kept.txt", fu.checksum_key(work_files["/kept.txt"])],
+                ["done", "/work/notes.txt", "another checksum"]
+            ]:
+                f.write(json.dumps(record) + "\n")
+        work.publish()
+
+        # only the journaled files are resumed or kept, the other one is uploaded again
+        version_directory = staging[:-len(fu.STAGING_SUFFIX)]
+        for filename, content in [("work.blend", "COMPLETE content"), ("notes.txt", "new notes"), ("kept.txt", "KEPT")]:
+            with open(os.path.join(version_directory, "work", filename)) as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(staging))
+        self.assertFalse(os.path.exists(os.path.join(version_directory, ftp.JOURNAL_FILENAME)))
+
+    def test_journaled_files_are_not_uploaded_again(self):
+        self.cnx.add_repository(
+            name="compressed_storage",
+            adapter="ftp",
+            login="tester",
+            password="secret",
+            host="127.0.0.1",
+            port=self.ftp_port,
+            root="/repos/compressed_storage",
+            compression="auto"
+        )
+        repository = self.cnx.repositories["compressed_storage"]
+        work_directory = os.path.join(utils.test_data_output_path, "staged_work")
+        with open(utils.add_file_to_directory(work_directory, "work.blend"), "wb") as f:
+            f.write(b"mesh data " * 10000)
+        with open(utils.add_file_to_directory(work_directory, "noise.bin"), "wb") as f:
+            f.write(os.urandom(50000))
+        work_files = fu.get_file_list(work_directory)
+        repository.stage_resource_commit(test_project_name, "anna-mdl@2", work_directory, work_files, "", {})
+        # the staging is interrupted before its promotion, the next one finds all the files complete
+        with mock.patch.object(repository, "_upload_file", wraps=repository._upload_file) as upload_file:
+            repository.stage_resource_commit(test_project_name, "anna-mdl@2", work_directory, work_files, "", {})
+        self.assertEqual(upload_file.call_count, 0)
+        staging_work = os.path.join(
+            utils.file_storage_path, "compressed_storage", test_project_name, "anna-mdl", "2" + fu.STAGING_SUFFIX,
+            "work"
+        )
+        self.assertEqual(sorted(os.listdir(staging_work)), ["noise.bin", "work.blend" + compression.COMPRESSED_SUFFIX])
+
+    def test_compressed_transfers(self):
+        self.cnx.add_repository(
+            name="compressed_storage",
+            adapter="ftp",
+            login="tester",
+            password="secret",
+            host="127.0.0.1",
+            port=self.ftp_port,
+            root="/repos/compressed_storage",
+            compression="auto"
+        )
+        self._test_compressed_storage("compressed_storage")
+        stored_files = []
+        for root, directories, files in os.walk(os.path.join(utils.file_storage_path, "compressed_storage")):
+            stored_files.extend(files)
+        self.assertIn("noise.bin", stored_files)
+        self.assertIn("work.blend" + compression.COMPRESSED_SUFFIX, stored_files)
+
+    def test_lost_sessions_are_replaced(self):
+        repository = self.cnx.repositories["main_storage"]
+        self.assertGreater(repository._idle_sessions.qsize(), 0)
+        # the server closes the idle sessions
+        self.ftp_server.handler.timeout = 0.5
+        try:
+            time.sleep(1.5)
+            self.anna_mdl_work.trash()
+            self.anna_mdl.checkout()
+        finally:
+            self.ftp_server.handler.timeout = 300
+        self.assertTrue(os.path.exists(os.path.join(self.anna_mdl_work.directory, "work.blend")))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
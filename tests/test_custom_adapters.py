@@ -75,10 +75,10 @@ class TestResourcesSQL(standard_test.TestResources):
             password=utils_ca.mysql_settings['password']
         )
         self.assertEqual(project.list_works(), ['anna-mdl'])
-        project.cnx.db.connection.close()
+        project.cnx.db.close()
 
     def tearDown(self):
-        self.cnx.db.connection.close()
+        self.cnx.db.close()
 
 
 class TestFTP(unittest.TestCase):
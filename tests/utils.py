@@ -5,6 +5,7 @@ import subprocess
 
 test_data_output_path = os.path.join(os.path.dirname(__file__), "data", "out")
 json_db_path = os.path.join(test_data_output_path, "DB")
+sqlite_db_path = os.path.join(test_data_output_path, "DB", "pulse.sqlite")
 sandbox_work_path = os.path.join(test_data_output_path, "works")
 sandbox_products_path = os.path.join(test_data_output_path, "products")
 file_storage_path = os.path.join(test_data_output_path, "repos").replace("\\", "/")
@@ -38,3 +39,134 @@ def add_file_to_directory(directory, filename="any_file.txt", source_filepath=No
         target = os.path.join(directory, os.path.basename(source_filepath))
         shutil.copy(source_filepath, target)
     return target
+
+
+def start_ftp_server(root, login, password):
+    """
+    serve a directory with a local ftp server running in a thread, return the server and its port.
+    needs pyftpdlib (pip install pyftpdlib)
+    """
+    import threading
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(login, password, root, perm="elradfmwMT")
+    handler = type("TestFTPHandler", (FTPHandler,), {"authorizer": authorizer})
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"timeout": 0.1}, daemon=True)
+    thread.start()
+    return server, server.address[1]
+
+
+def publish_concurrently(adapter, db_path, project_name, resource_name, publish_count, input_uri):
+    """checkout a new resource, publish it several times and add it an input. Run in a separate process"""
+    from pulse.api import Connection
+    prj = Connection(adapter=adapter, path=db_path).get_project(project_name)
+    work = prj.create_resource(resource_name).checkout()
+    for index in range(publish_count):
+        add_file_to_directory(work.directory, "file_" + str(index) + ".txt")
+        work.publish()
+    work.add_input(input_uri)
+
+
+def increment_counter(filepath, count):
+    """increment a json counter file, run in a separate process"""
+    import pulse.file_utils as fu
+    for index in range(count):
+        fu.update_data(filepath, lambda x: x + 1, 0)
+
+
+def publish_in_user_sandbox(adapter, db_path, project_name, resource_uri, user_var, start_barrier, results):
+    """
+    checkout a resource in a user sandbox, and publish it once all the processes are ready.
+    The user is put in the results queue if the publish succeeds. Run in a separate process
+    """
+    os.environ["USER_VAR"] = user_var
+    from pulse.api import Connection
+    from pulse.exception import PulseError
+    prj = Connection(adapter=adapter, path=db_path).get_project(project_name)
+    work = prj.get_resource(resource_uri).checkout()
+    add_file_to_directory(work.directory, user_var + ".txt")
+    start_barrier.wait()
+    try:
+        work.publish()
+    except PulseError:
+        return
+    results.put(user_var)
+
+
+def try_lock_concurrently(adapter, db_path, project_name, resource_uri, user, start_barrier, results):
+    """try to lock a resource once all the processes are ready, and put the result in the queue"""
+    from pulse.api import Connection
+    db = Connection(adapter=adapter, path=db_path).db
+    start_barrier.wait()
+    results.put((user, db.try_lock(project_name, resource_uri, user)))
+
+
+class FakeMysqlServer:
+    """
+    stands for a mysql server, in place of mysql.connector.connect. The statements are answered by a handler, and
+    the connection can be lost on the next statements
+
+    :param handler: called with each statement and its parameters, returns a (column names, rows, row count) tuple
+    """
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda cmd, parameters: ([], [], 0))
+        self.connections = []
+        self.statements = []
+        # errors raised by the next statements, as (error, applied) tuples. An applied statement is answered
+        # before its error is raised
+        self.failures = []
+        self.closed_cursors = 0
+
+    def connect(self, **kwargs):
+        connection = FakeMysqlConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    def execute(self, cmd, parameters):
+        error, applied = self.failures.pop(0) if self.failures else (None, True)
+        result = ([], [], 0)
+        if applied:
+            self.statements.append(cmd)
+            result = self.handler(cmd, parameters)
+        if error:
+            raise error
+        return result
+
+
+class FakeMysqlConnection:
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+        self.pings = 0
+
+    def cursor(self, prepared=False):
+        return FakeMysqlCursor(self.server)
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMysqlCursor:
+    def __init__(self, server):
+        self.server = server
+        self.description = None
+        self.column_names = []
+        self.rowcount = -1
+        self._rows = []
+
+    def execute(self, cmd, parameters=()):
+        self.column_names, self._rows, self.rowcount = self.server.execute(cmd, parameters)
+        self.description = [(name,) for name in self.column_names] or None
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        self.server.closed_cursors += 1